@@ -0,0 +1,70 @@
+"""
+Compare DRAM upload rates of the katcp write_dram, ssh/dd and persistent channel paths
+
+Each path loads the same random data, at several sizes, through RoachInterface._load_dram, and the
+achieved rate is printed in MB/s. Run on the readout computer with the ROACH programmed:
+
+    python benchmark_dram_upload.py
+
+or with 'mock' as argument to exercise the katcp path against mock_roach.MockFpgaClient and the
+channel path against a locally built ppc/dram_loader writing to a file, which checks the harness
+and the helper without hardware.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from kid_readout.utils import roach_interface, dram_upload
+from kid_readout.utils.mock_roach import MockFpgaClient, MockValon
+
+sizes_mb = [1,8,64]
+repeats = 3
+
+def measure(ri,method,nbytes):
+    data = np.random.randint(-2**15,2**15,size=nbytes/2).astype('>i2')
+    ri.dram_upload_method = method
+    rates = []
+    for k in range(repeats):
+        tic = time.time()
+        ri._load_dram(data,fast=(method != 'katcp'))
+        rates.append(nbytes/2.0**20/(time.time()-tic))
+    return np.median(rates)
+
+mock = 'mock' in sys.argv[1:]
+tmpdir = None
+if mock:
+    # CONFIG_FILE_NAME is not written by _load_dram, so no state is saved
+    ri = roach_interface.RoachBaseband(roach=MockFpgaClient(boffile='mock.bof',latency={'write_dram':0.01}),
+                                       adc_valon=MockValon(),initialize=False)
+    tmpdir = tempfile.mkdtemp()
+    helper = os.path.join(tmpdir,'dram_loader')
+    subprocess.check_call(['cc','-O2','-o',helper,os.path.join(os.path.dirname(__file__),'..','ppc','dram_loader.c')])
+    dram = os.path.join(tmpdir,'dram_memory')
+    np.zeros((64*2**20,),dtype=np.uint8).tofile(dram)
+    ri._dram_channel = dram_upload.DramChannel([helper,dram],bof_pid=ri.bof_pid)
+    methods = ['katcp','channel']
+else:
+    ri = roach_interface.RoachBaseband(initialize=False)
+    ri._update_bof_pid()
+    methods = ['katcp','ssh','channel']
+
+results = {}
+try:
+    for method in methods:
+        for size in sizes_mb:
+            results[method,size] = measure(ri,method,size*2**20)
+finally:
+    if getattr(ri,'_dram_channel',None) is not None:
+        ri._dram_channel.close()
+    if tmpdir is not None:
+        shutil.rmtree(tmpdir)
+
+print
+print "%-10s" % "MB/s" + ''.join(["%10d MB" % size for size in sizes_mb])
+for method in methods:
+    print "%-10s" % method + ''.join(["%13.1f" % results[method,size] for size in sizes_mb])
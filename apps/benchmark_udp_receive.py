@@ -0,0 +1,69 @@
+"""
+Compare sustained UDP receive rates of the recv_into loop and the batched recvmmsg path
+
+Several processes run the ROACH packet stream emulator at full speed against a loopback port while
+this process receives the packets with each backend of udp_catcher.recv_packets in turn. More than one
+sender is used so that the receiver, not the python emulator, is the bottleneck.
+"""
+import multiprocessing
+import socket
+import time
+
+import numpy as np
+
+from kid_readout.utils import udp_catcher, recvmmsg
+from kid_readout.utils.udp_emulator import RoachUdpEmulator
+
+addr = ('127.0.0.1',12346)
+duration = 5.0 # seconds per backend
+npkts = 16*16*8 # packets per recv_packets call, 8 reads of 16 channels
+nsenders = min(3,max(1,multiprocessing.cpu_count()-1))
+
+def sender(stop):
+    emulator = RoachUdpEmulator(np.arange(16),2**11,addr=addr,streamid=1)
+    emulator.run(stop)
+
+def measure(s):
+    pkts = np.empty((npkts,),dtype=udp_catcher.pkt_dtype)
+    lengths = np.zeros((npkts,),dtype=np.int32)
+    total = 0
+    ncalls = 0
+    tic = time.time()
+    while time.time() - tic < duration:
+        total += udp_catcher.recv_packets(s,pkts,lengths)
+        ncalls += 1
+    elapsed = time.time() - tic
+    return total/elapsed, ncalls
+
+s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+s.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,2**24)
+s.bind(addr)
+s.settimeout(1)
+
+stop = multiprocessing.Event()
+procs = [multiprocessing.Process(target=sender,args=(stop,)) for k in range(nsenders)]
+for proc in procs:
+    proc.start()
+time.sleep(0.5)
+
+results = {}
+backends = [('recv_into loop',False)]
+if recvmmsg.available:
+    backends.append(('recvmmsg',True))
+else:
+    print "recvmmsg not available on this system, only measuring the recv_into loop"
+for name,use_recvmmsg in backends:
+    udp_catcher.use_recvmmsg = use_recvmmsg
+    udp_catcher.flush_socket(s)
+    s.settimeout(1)
+    rate,ncalls = measure(s)
+    results[name] = rate
+    print "%-16s %10.0f packets per second (%.1f MB/s) in %d calls" % (name, rate, rate*udp_catcher.pkt_size/1e6, ncalls)
+
+stop.set()
+for proc in procs:
+    proc.join()
+s.close()
+
+if len(results) == 2:
+    print "recvmmsg speedup: %.2f" % (results['recvmmsg']/results['recv_into loop'])
@@ -0,0 +1,25 @@
+"""
+Decode and demodulate a raw UDP capture written by kid_readout.utils.raw_capture.capture_raw
+
+usage: python decode_raw_capture.py <capture basename> [block samples]
+
+The capture is read a chunk at a time and written as timestream blocks to a new DataFile, so the
+capture does not need to fit in memory.
+"""
+import sys
+import os
+
+from kid_readout.utils import data_file
+from kid_readout.utils.raw_capture import RawCapture
+
+basename = sys.argv[1]
+block_samples = 2**16
+if len(sys.argv) > 2:
+    block_samples = int(sys.argv[2])
+
+capture = RawCapture(basename)
+df = data_file.DataFile(suffix='raw_' + os.path.basename(basename))
+capture.to_data_file(df,block_samples=block_samples)
+df.nc.sync()
+print "wrote",df.filename
+df.nc.close()
@@ -37,6 +37,8 @@ start = time.time()
 
 measured_freqs = sweeps.prepare_sweep(ri,f0s,offsets,nsamp=2**21)
 print "loaded waveforms in", (time.time()-start),"seconds"
+# the tones fit at each attenuation replace the ones before, in a bank after the sweep banks
+retune_bank = ri.tone_bins.shape[0]
 
 sys.stdout.flush()
 time.sleep(1)
@@ -69,8 +71,8 @@ for atten in atten_list:
         idx = np.unravel_index(abs(measured_freqs - meas_cfs[-1]).argmin(),measured_freqs.shape)
         idxs.append(idx)
     print meas_cfs
-    ri.add_tone_freqs(np.array(meas_cfs))
-    ri.select_bank(ri.tone_bins.shape[0]-1)
+    ri.add_tone_freqs(np.array(meas_cfs),bank=retune_bank)
+    ri.select_bank(retune_bank)
     ri._sync()
     time.sleep(0.5)
     
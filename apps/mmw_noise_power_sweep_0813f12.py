@@ -85,7 +85,7 @@ while True:
         source_off()
         print "setting attenuator to",atten
         ri.set_dac_attenuator(atten)
-        measured_freqs = sweeps.prepare_sweep(ri,f0binned,offsets,nsamp=nsamp)
+        measured_freqs = sweeps.prepare_sweep(ri,f0binned,offsets,nsamp=nsamp,phase_seed=0)
         print "loaded waveforms in", (time.time()-start),"seconds"
 
         sweep_data = sweeps.do_prepared_sweep(ri, nchan_per_step=atonce, reads_per_step=1)
@@ -231,7 +231,7 @@ while True:
         source_on()
         print "setting attenuator to",atten
         ri.set_dac_attenuator(atten)
-        measured_freqs = sweeps.prepare_sweep(ri,f0binned,offsets,nsamp=nsamp)
+        measured_freqs = sweeps.prepare_sweep(ri,f0binned,offsets,nsamp=nsamp,phase_seed=0)
         print "loaded waveforms in", (time.time()-start),"seconds"
 
         sweep_data = sweeps.do_prepared_sweep(ri, nchan_per_step=atonce, reads_per_step=1)
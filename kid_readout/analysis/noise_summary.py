@@ -182,7 +182,7 @@ class NoiseMeasurement(object):
         fs = tsg.variables['fs'][:]
         fmeas = fs*tones/nsamp
         tone_index = np.argmin(abs(fmeas-self.fr.mean()))
-        ts = tsg.variables['data'][tone_index,:].view('complex128')
+        ts = tsg.variables['data'][tone_index,:].view(tsg.variables['data'].datatype.name)
         self.fs = fs[tone_index]
         self.nfft = tsg.variables['nfft'][tone_index]
         window = int(2**np.ceil(np.log2(self.fs*1e6/(2*self.nfft))))
@@ -193,7 +193,8 @@ class NoiseMeasurement(object):
         self.s21 = np.hstack((self.s21,[ts[:2048].mean()]))
         
         blkidx = swg.groups['datablocks'].variables['sweep_index'][:]
-        blks = swg.groups['datablocks'].variables['data'][:][blkidx==index,:].view('complex')
+        blkvar = swg.groups['datablocks'].variables['data']
+        blks = blkvar[:][blkidx==index,:].view(blkvar.datatype.name)
         errors = blks.real.std(1) + 1j*blks.imag.std(1)
         self.errors = errors
         self.errors = np.hstack((self.errors,[ts[:2048].real.std()+ts[:2048].imag.std()]))
@@ -396,7 +397,7 @@ def plot_noise(swg,tsg,hwg,chip,index=0,phasecorr=phasecorr,scale=scale,filtlen=
     s21 = s21[idx==index][1:]
     rr = Resonator(fr,s21)
     
-    ts = tsg.variables['data'][:].view('complex128')
+    ts = tsg.variables['data'][:].view(tsg.variables['data'].datatype.name)
     ch = tsg.variables['tone'][0]
     nsamp = tsg.variables['nsamp'][0]
     fs = tsg.variables['fs'][0]
@@ -7,6 +7,10 @@ import fftfilt
 
 lpf = scipy.signal.firwin(256,1/256.)
 
+# dtype of readout samples from acquisition through to storage. The ADC data are 16 bit, so complex64
+# is exact; analysis code upcasts where it needs more precision.
+sample_dtype = np.dtype('complex64')
+
 class DataBlock():
     def __init__(self, data, tone, fftbin, 
                      nsamp, nfft, wavenorm, t0 = 0, fs = 512e6,
@@ -49,6 +53,8 @@ class SweepData():
         self.blocks = []
         self._freqs = []
         self._sweep_indexes = []
+        # time taken by each step of the sweep, see sweeps.run_sweep
+        self.step_timing = []
     def add_block(self,block):
         f = (block.fs*block.tone)/block.nsamp
         idx = bisect.bisect(self._freqs, f)
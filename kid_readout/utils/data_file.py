@@ -4,6 +4,7 @@ import os
 import numpy as np
 from kid_readout.utils.valon import check_output
 from kid_readout.utils import data_block
+from kid_readout.utils import instrumentation
 
 import socket
 #readout has run out of disk space on /home/data, so we start storing data in /home/data2
@@ -28,6 +29,7 @@ class DataFile():
         fn += '.nc'
         fn = os.path.join(base_dir,fn)
         self.filename = fn
+        self.timers = instrumentation.OperationTimers()
         self.nc = netCDF4.Dataset(fn,mode='w')
         try:
             dname = os.path.split(__file__)[0]
@@ -38,6 +40,7 @@ class DataFile():
         self.sweeps = self.nc.createGroup('sweeps')
         self.timestreams = self.nc.createGroup('timestreams')
         self.cryo = self.nc.createGroup('cryo')
+        self.capture_health = self.nc.createGroup('capture_health')
         self.hw_state = self.nc.createGroup('hw_state')
         self.hw_state.createDimension('time',None)
         self.hw_epoch = self.hw_state.createVariable('epoch',np.float64,dimensions=('time',))
@@ -61,13 +64,43 @@ class DataFile():
         self.nc.close()        
     def sync(self):
         self.nc.sync()
-    def log_hw_state(self,ri):
+    def log_hw_state(self,ri,timing=False):
+        """
+        Append the attenuator settings and number of tones of *ri* to the hw_state group
+        
+        timing : if True, also record the accumulated timers and counters of *ri* (see
+            RoachInterface.get_timing) and of the netCDF writes of this file (prefixed with
+            netcdf_). A variable is created for each the first time it appears.
+        """
         idx = len(self.hw_state.dimensions['time'])
         t0 = time.time()
         self.hw_epoch[idx] = t0
         self.hw_adc_atten[idx] = ri.adc_atten
         self.hw_dac_atten[idx] = ri.dac_atten
         self.hw_ntones[idx] = ri.tone_bins.shape[1]
+        if timing:
+            timing = ri.get_timing()
+            timing.update(self.timers.as_dict(prefix='netcdf_'))
+            for name,value in timing.items():
+                if name not in self.hw_state.variables:
+                    self.hw_state.createVariable(name,np.float64,dimensions=('time',))
+                self.hw_state.variables[name][idx] = value
+        
+    def log_capture_health(self,health):
+        """
+        Append the counters of a udp_catcher.CaptureHealth (for example ri.capture_health) to the
+        capture_health group
+        """
+        if health is None:
+            return
+        if not self.capture_health.variables:
+            self.capture_health.createDimension('epoch',None)
+            self.capture_health.createVariable('epoch',np.float64,('epoch',))
+            for name in health.counters:
+                self.capture_health.createVariable(name,np.int32,('epoch',))
+        idx = len(self.capture_health.dimensions['epoch'])
+        for name,val in health.as_dict().items():
+            self.capture_health.variables[name][idx] = val
         
     def log_adc_snap(self,ri):
         t0 = time.time()
@@ -78,6 +111,7 @@ class DataFile():
         self.adc_snaps_data[idx,1,:] = y
 
     def add_sweep(self, sweep_data):
+        tic = time.time()
         name = time.strftime('sweep_%Y%m%d%H%M%S')
         swg = self.sweeps.createGroup(name)
         swg.createDimension('frequency',None)
@@ -99,7 +133,7 @@ class DataFile():
         dt = dbg.createVariable('dt',np.float64,('epoch',))
         fs = dbg.createVariable('fs',np.float64,('epoch',))
         wavenorm = dbg.createVariable('wavenorm',np.float64,('epoch'))
-        data = dbg.createVariable('data',self.cdf128,('epoch','sample'))
+        data = dbg.createVariable('data',self.cdf64,('epoch','sample'))
         sweep_index = dbg.createVariable('sweep_index',np.int32,('epoch'))
         
         blocks = sweep_data.blocks
@@ -109,10 +143,10 @@ class DataFile():
             if blk.data.shape[0] >= blen:
                 blocklist.append(blk.data[None,:blen])
             else:
-                newblk = np.zeros((1,blen),dtype=blk.data.dtype)
+                newblk = np.zeros((1,blen),dtype=data_block.sample_dtype)
                 newblk[0,:blk.data.shape[0]] = blk.data[:]
                 blocklist.append(newblk)
-        data[:] = np.concatenate(blocklist,axis=0).astype('complex128').view(self.c128)
+        data[:] = np.concatenate(blocklist,axis=0).astype(data_block.sample_dtype).view(self.c64)
         fs[:] = np.array([x.fs for x in blocks])
         t0[:] = np.array([x.t0 for x in blocks])
         tone[:] = np.array([x.tone for x in blocks])
@@ -122,7 +156,7 @@ class DataFile():
         dt[:] = np.array([x.dt for x in blocks])
         fftbin[:] = np.array([x.fftbin for x in blocks])
         sweep_index[:] = np.array([x.sweep_index for x in blocks])
-        
+        self.timers.add('add_sweep',time.time()-tic)
         return name
     
     def add_timestream_data(self, data, ri, t0, tsg=None, mmw_source_freq=0.0, mmw_source_modulation_freq=0.0,
@@ -139,6 +173,7 @@ class DataFile():
         return tsg
 
     def add_block_to_timestream(self, block, tsg = None):
+        tic = time.time()
         if tsg is not None and tsg.variables['data'].shape[1] != block.data.shape[0]:
             print "Warning! Timestream data cannot be added to", tsg.path, "because dimension does not agree."
             print "New timestream group will be created"
@@ -176,7 +211,7 @@ class DataFile():
             zbd_power_dbm = tsg.variables['zbd_power_dbm']
             data = tsg.variables['data']
         idx = len(tsg.dimensions['epoch'])
-        data[idx] = block.data.astype('complex64').view(self.c64)
+        data[idx] = block.data.astype(data_block.sample_dtype).view(self.c64)
         t0[idx] = block.t0
         fs[idx] = block.fs
         tone[idx] = block.tone
@@ -189,6 +224,8 @@ class DataFile():
         mmw_source_modulation_freq[idx] = block.mmw_source_modulation_freq
         zbd_power_dbm[idx] = block.zbd_power_dbm
         zbd_voltage[idx] = block.zbd_voltage
+        self.timers.add('add_block',time.time()-tic)
+        self.timers.count('samples_written',block.data.shape[0])
         return tsg
     
     def add_cryo_data(self,cryod):
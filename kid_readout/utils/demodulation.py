@@ -0,0 +1,210 @@
+"""
+Vectorized demodulation of the channels read out from the FFT bins
+
+The readout classes reduce their tone configuration to per channel arrays (see
+RoachInterface._demodulation_parameters) and demodulate() applies them to a whole (nsamples,nchan)
+block at once:
+
+    demod[:,n] = wc[n]*exp(sign[n]*1j*(2*pi*foffs[n]*t + phi0[n])) * data[:,n]
+    demod[:,n] = conj(demod[:,n])   where conj[n]
+
+The conjugation is folded into the phasor, conj(a*b) = conj(a)*conj(b), so each sample is touched by
+a single complex multiply. The phasor tables are kept in an LRU cache (phasor_cache), since the tone
+configuration and block length rarely change between reads. The table of the first chunk includes
+the starting phase of each tone; later chunks of a stream share a zero phase table, which is rotated
+to the current phase a cache sized block at a time, so the data is still traversed once. When a
+table is not cached, numexpr is used if it is installed. A Demodulator carries the phase from one
+chunk to the next, so streams can be demodulated incrementally.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+try:
+    import numexpr
+    have_numexpr = True
+except ImportError:
+    have_numexpr = False
+
+# number of rows processed at once, which bounds the size of the temporary phase arrays
+block_rows = 2**14
+# size of the block of a zero phase table rotated at once for a later chunk of a stream
+rotate_bytes = 2**18
+
+class PhasorCache(object):
+    def __init__(self,max_bytes=2**28):
+        """
+        Least recently used cache of phasor tables, limited to *max_bytes* in total
+        
+        Tables are keyed on the per channel demodulation parameters, which are fixed by the readout
+        configuration (bank, readout_selection, tone_bins, phases, tone_nsamp), and the block
+        length.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tables = collections.OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self,omega,phase0,wc,nrows):
+        """
+        Get the table wc*exp(1j*(omega*t + phase0)) for t = 0 to nrows-1, computing it if needed
+        
+        returns : complex64 array of shape (nrows,nchan), or None if it is larger than max_bytes
+        """
+        nbytes = nrows*omega.shape[0]*np.dtype(np.complex64).itemsize
+        if nbytes > self.max_bytes:
+            return None
+        key = (omega.tostring(),phase0.tostring(),wc.tostring(),nrows)
+        with self._lock:
+            table = self._tables.pop(key,None)
+            if table is not None:
+                self._tables[key] = table
+                self.hits += 1
+                return table
+            self.misses += 1
+        table = np.empty((nrows,omega.shape[0]),dtype=np.complex64)
+        for start in range(0,nrows,block_rows):
+            t = np.arange(start,min(start+block_rows,nrows),dtype=np.float64)
+            table[start:start+block_rows] = phasors(t,omega,phase0,wc)
+        with self._lock:
+            if key not in self._tables:
+                while self._tables and self.nbytes + nbytes > self.max_bytes:
+                    _,evicted = self._tables.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+                    self.evictions += 1
+                self._tables[key] = table
+                self.nbytes += nbytes
+        return table
+    
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.nbytes = 0
+
+phasor_cache = PhasorCache()
+
+def demodulate(data,foffs,wc,sign,phi0,conj,t0=0,inplace=False,cache=True):
+    """
+    Demodulate a block of channel data
+
+    data : complex array of shape (nsamples,nchan)
+    foffs : offset frequency of each channel's tone from its FFT bin center, in cycles per sample
+    wc : window correction factor for each channel
+    sign : +1 or -1 for each channel, the sign of the demodulation phase
+    phi0 : initial phase of each tone
+    conj : boolean array, True for channels whose result is conjugated
+    t0 : sample index of the first row of *data*
+    inplace : if True and *data* is complex64, overwrite it with the result
+    cache : if True, use (and fill) phasor_cache
+
+    returns : complex64 array of the same shape as *data*
+    """
+    demodulator = Demodulator(foffs,wc,sign,phi0,conj,t0=t0,cache=cache)
+    return demodulator.demodulate(data,inplace=inplace)
+
+class Demodulator(object):
+    def __init__(self,foffs,wc,sign,phi0,conj,t0=0,cache=True,renormalize_every=16):
+        """
+        Demodulate a stream of channel data a chunk at a time
+        
+        The phase of each channel at the start of the next chunk is carried as a unit phasor,
+        advanced by exp(1j*omega*nsamples) after every chunk and renormalized every
+        *renormalize_every* chunks so rounding errors cannot build up. The table of the first chunk
+        includes the starting phase; later chunks rotate a table starting at zero phase, so the
+        tables in phasor_cache are shared by every later chunk of the same length. Concatenating the
+        outputs gives the one-shot result to within single precision rounding.
+        
+        See demodulate for the arguments. The parameters are usually obtained with
+        RoachInterface.get_demodulator.
+        """
+        self.conj = np.asarray(conj,dtype='bool')
+        # conj(wc*exp(1j*s*phase)*d) = wc*exp(-1j*s*phase)*conj(d)
+        s = np.where(self.conj,-1.0,1.0)*sign
+        self.omega = s*2*np.pi*np.asarray(foffs,dtype=np.float64)
+        self.phase0 = s*np.asarray(phi0,dtype=np.float64)
+        self.wc = np.asarray(wc,dtype=np.float64)
+        self.cache = cache
+        self.renormalize_every = renormalize_every
+        self.reset(t0)
+        
+    def reset(self,t0=0):
+        """
+        Restart the stream at sample index *t0*
+        """
+        self.sample = t0
+        self.chunks = 0
+        self.start_phase = np.remainder(self.omega*t0 + self.phase0,2*np.pi)
+        self.rotation = np.exp(1j*self.start_phase)
+        
+    def demodulate(self,data,inplace=False):
+        """
+        Demodulate the next chunk of the stream
+        
+        data : complex array of shape (nsamples,nchan)
+        inplace : if True and *data* is complex64, overwrite it with the result
+        
+        returns : complex64 array of the same shape as *data*
+        """
+        if inplace and data.dtype == np.complex64:
+            demod = data
+        else:
+            demod = data.astype(np.complex64)
+        nrows = demod.shape[0]
+        if nrows == 0:
+            return demod
+        if self.conj.any():
+            iq = demod.view(np.float32).reshape(demod.shape + (2,))
+            iq[:,self.conj,1] *= -1
+        table = None
+        if self.cache:
+            # the first chunk starts at a phase fixed by the configuration, so every one shot
+            # demodulation of the same configuration shares its table
+            phase = self.start_phase if self.chunks == 0 else np.zeros_like(self.phase0)
+            table = phasor_cache.get(self.omega,phase,self.wc,nrows)
+        if table is not None and self.chunks == 0:
+            demod *= table
+        elif table is not None:
+            rotation = self.rotation.astype(np.complex64)
+            step = max(1,rotate_bytes//table[0].nbytes)
+            rotated = np.empty((min(step,nrows),table.shape[1]),dtype=np.complex64)
+            for start in range(0,nrows,step):
+                block = table[start:start+step]
+                np.multiply(block,rotation,out=rotated[:block.shape[0]])
+                demod[start:start+step] *= rotated[:block.shape[0]]
+        else:
+            omega = self.omega
+            wc = self.wc
+            phase = np.angle(self.rotation)
+            for start in range(0,nrows,block_rows):
+                rows = demod[start:start+block_rows]
+                t = np.arange(start,start+rows.shape[0],dtype=np.float64)
+                if have_numexpr:
+                    t = t[:,None]
+                    numexpr.evaluate('rows*wc*exp(1j*(omega*t + phase))',out=rows,casting='same_kind')
+                else:
+                    rows *= phasors(t,omega,phase,wc)
+        self.rotation *= np.exp(1j*np.remainder(self.omega*nrows,2*np.pi))
+        self.sample += nrows
+        self.chunks += 1
+        if self.chunks % self.renormalize_every == 0:
+            self.rotation /= np.abs(self.rotation)
+        return demod
+
+def phasors(t,omega,phase0,wc):
+    """
+    Compute wc*exp(1j*(omega*t + phase0)) as a complex64 array of shape (len(t),nchan)
+
+    The phase is evaluated in double precision, so long captures keep their phase accuracy.
+    """
+    phase = np.multiply.outer(t,omega)
+    phase += phase0
+    result = np.empty(phase.shape,dtype=np.complex64)
+    np.cos(phase,out=result.real)
+    np.sin(phase,out=result.imag)
+    result *= wc.astype(np.float32)
+    return result
@@ -0,0 +1,168 @@
+"""
+Persistent channel for uploading waveforms to the ROACH DRAM
+
+The ssh/dd path (RoachInterface._load_dram_ssh) writes every 64 MB bank to the NFS exported root and
+starts a new ssh session to dd it into the DRAM, so connection setup dominates small and medium
+loads. DramChannel instead starts the ppc/dram_loader helper on the ROACH once, through a single ssh
+session, and streams each piece of data with its offset over the session's stdin:
+
+    channel = DramChannel(ssh_command('roach'))
+    seconds = channel.write(offset_bytes,data)
+    print channel.rate
+
+The helper writes to the DRAM bank currently selected by the dram_controller register, which the
+readout sets over katcp as for the other paths. See ppc/dram_loader.c for the record format.
+
+The data uploaded by every path is a DramImage: a memory mapped staging file holding the DRAM image,
+into which the waveform samples are written already byte swapped and in their wafer's slots, so the
+bytes uploaded are the very buffer the waveform was quantized into:
+
+    image = DramImage(2*nsamples)
+    image.place(wafer,0,wave)
+    ri._load_dram(image.data)
+    image.release()
+"""
+
+import os
+import struct
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+default_helper = '/boffiles/udp/dram_loader'
+
+# size of the writes to the ssh pipe
+piece_bytes = 2**20
+
+def ssh_command(roachip,helper=default_helper,bof_pid=None):
+    """
+    Command starting the helper on *roachip*
+
+    bof_pid : process id of the running boffile. If None, it is looked up on the ROACH by the same
+        ssh session, saving a round trip.
+    """
+    if bof_pid is None:
+        target = '$(pgrep -f bof$)'
+    else:
+        target = '%d' % bof_pid
+    return ['ssh','root@%s' % roachip,'exec %s %s' % (helper,target)]
+
+class DramChannel(object):
+    def __init__(self,command,bof_pid=None):
+        """
+        Start the upload helper
+
+        command : argument list starting the helper, usually from ssh_command. For testing it can run
+            a locally built helper on a file.
+        bof_pid : process id the helper writes to, recorded so the readout can tell when the boffile
+            was restarted and a new channel is needed
+        """
+        self.command = command
+        self.bof_pid = bof_pid
+        self.bytes = 0
+        self.seconds = 0.0
+        self.process = subprocess.Popen(command,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    @property
+    def rate(self):
+        """
+        Average upload rate through this channel in MB/s
+        """
+        if self.seconds == 0:
+            return 0.0
+        return self.bytes/2.0**20/self.seconds
+
+    def write(self,offset_bytes,data):
+        """
+        Write the bytes of array *data* at *offset_bytes* in the selected DRAM bank
+
+        returns : seconds taken, including the helper's acknowledgement
+        """
+        raw = np.ascontiguousarray(data).view(np.uint8)
+        tic = time.time()
+        try:
+            self.process.stdin.write(struct.pack('>II',offset_bytes,raw.shape[0]))
+            for start in range(0,raw.shape[0],piece_bytes):
+                self.process.stdin.write(buffer(raw,start,piece_bytes))
+            self.process.stdin.flush()
+            ack = self.process.stdout.read(4)
+        except IOError,e:
+            raise RuntimeError("DRAM upload helper failed: %s" % e)
+        if len(ack) != 4:
+            raise RuntimeError("DRAM upload helper exited with code %s" % self.process.poll())
+        written, = struct.unpack('>I',ack)
+        if written != raw.shape[0]:
+            raise RuntimeError("DRAM upload helper could not write %d bytes at offset %d" % (raw.shape[0],offset_bytes))
+        elapsed = time.time() - tic
+        self.bytes += raw.shape[0]
+        self.seconds += elapsed
+        return elapsed
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.write(struct.pack('>II',0,0))
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.wait()
+
+class DramImage(object):
+    def __init__(self,nentries,directory=None):
+        """
+        Create a zeroed staging file for a DRAM image of *nentries* '>i2' entries and map it
+
+        directory : where the staging file is created, None for the system temporary directory. The
+            ssh path stages in the NFS exported root, so dd on the ROACH reads the file directly.
+        """
+        fd,self.path = tempfile.mkstemp(prefix='dram_',suffix='.bin',dir=directory)
+        os.close(fd)
+        # a new file is extended with zeros, so the slots of the other wafers need no writing
+        self.data = np.memmap(self.path,dtype='>i2',mode='w+',shape=(nentries,))
+
+    def slots(self,wafer):
+        """
+        returns : view of shape (nentries/4,2) of the entries holding the DAC samples of *wafer*,
+            which the DRAM interleaves in pairs: [w0 w0 w1 w1 w0 w0 w1 w1 ...]
+        """
+        return self.data.reshape((-1,4))[:,2*wafer:2*wafer+2]
+
+    def place(self,wafer,start,wave):
+        """
+        Write the samples *wave* of *wafer* starting at sample *start* (both even)
+
+        *wave* may be of any numeric dtype, for example the rounded floating point output of the
+        synthesis: the assignment converts, byte swaps and interleaves it in a single pass.
+        """
+        self.slots(wafer)[start/2:(start+wave.shape[0])/2] = wave.reshape((-1,2))
+
+    def extract(self,wafer):
+        """
+        returns : copy of the samples of *wafer*, dtype '>i2'
+        """
+        return self.slots(wafer).flatten()
+
+    def offset_of(self,data):
+        """
+        returns : byte offset in the staging file of *data*, a contiguous part of self.data, or None
+            if *data* does not lie in this image
+        """
+        low,high = np.byte_bounds(self.data)
+        data_low,data_high = np.byte_bounds(data)
+        if not data.flags.c_contiguous or data_low < low or data_high > high:
+            return None
+        return data_low - low
+
+    def release(self):
+        """
+        Delete the staging file. The mapping, and so self.data, remains valid until it is dropped.
+        """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,91 @@
+"""
+Lightweight timers and counters for the readout hot paths
+
+Each RoachInterface has an OperationTimers instance (ri.timers) which accumulates the wall time of
+the operations it performs, and the katcp client wrapper (register_shadow.ShadowedFpgaClient) has one
+for the katcp requests:
+
+    with self.timers.timed('dram_load'):
+        ...
+    self.timers.count('dram_load_bytes',data.nbytes)
+
+ri.get_timing() returns everything as a flat dictionary, for example
+
+    {'dram_load_calls': 3, 'dram_load_seconds': 4.2, 'dram_load_max_seconds': 1.6,
+     'dram_load_bytes': 201326592, 'katcp_write_int_calls': 412, ...}
+
+which DataFile.log_hw_state can append to the hw_state group. Timing an operation costs two calls
+to time.time(), which is negligible next to any of the operations timed.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+class OperationTimers(object):
+    def __init__(self):
+        """
+        Accumulated wall time and call counts of named operations, plus free form counters
+        """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = collections.defaultdict(int)
+            self.seconds = collections.defaultdict(float)
+            self.max_seconds = collections.defaultdict(float)
+            self.counters = collections.defaultdict(int)
+
+    def add(self,name,seconds):
+        """
+        Record one call of operation *name* which took *seconds*
+        """
+        with self._lock:
+            self.calls[name] += 1
+            self.seconds[name] += seconds
+            if seconds > self.max_seconds[name]:
+                self.max_seconds[name] = seconds
+
+    @contextlib.contextmanager
+    def timed(self,name):
+        """
+        Time the enclosed block as one call of operation *name*. The time is recorded even if the
+        block raises an exception.
+        """
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.add(name,time.time()-tic)
+
+    def count(self,name,n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def as_dict(self,prefix=''):
+        """
+        returns : dictionary with <name>_calls, <name>_seconds and <name>_max_seconds for each
+            operation, and the value of each counter, all keys prefixed with *prefix*
+        """
+        with self._lock:
+            d = {}
+            for name in self.calls:
+                d[prefix + name + '_calls'] = self.calls[name]
+                d[prefix + name + '_seconds'] = self.seconds[name]
+                d[prefix + name + '_max_seconds'] = self.max_seconds[name]
+            for name,value in self.counters.items():
+                d[prefix + name] = value
+        return d
+
+    def summary(self):
+        """
+        returns : one line per operation, slowest total first
+        """
+        with self._lock:
+            names = sorted(self.calls,key=lambda name: -self.seconds[name])
+            lines = ["%-30s %8d calls %10.3f s total %10.3f ms mean %10.3f ms max" %
+                     (name,self.calls[name],self.seconds[name],1e3*self.seconds[name]/self.calls[name],
+                      1e3*self.max_seconds[name]) for name in names]
+        return '\n'.join(lines)
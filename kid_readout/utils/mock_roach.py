@@ -0,0 +1,213 @@
+"""
+In process stand-ins for the ROACH FpgaClient and the Valon synthesizer
+
+MockFpgaClient implements the parts of corr.katcp_wrapper.FpgaClient used by roach_interface and
+single_pixel, so the tone setting, sweep and readout code can be exercised and profiled without
+hardware:
+
+    ri = roach_interface.RoachBaseband(roach=MockFpgaClient(),adc_valon=MockValon(),initialize=False)
+
+Registers are kept in a dictionary, DRAM is modeled as a set of 64 MB banks selected by the
+dram_controller register, and the ping-pong output buffers (ppout0, ppout1) toggle their address
+register as if the FPGA were filling them. Every call can be given a latency to mimic the katcp round
+trip, and the number of calls to each method is counted in self.calls.
+"""
+
+import collections
+import time
+
+import numpy as np
+
+dram_bank_size = 64*2**20
+frame_samples = 2**12
+
+class MockFpgaClient(object):
+    def __init__(self,latency=0.0,frame_rate=None,polls_per_frame=2,chan_offset=2,clock_mhz=256.0,
+                 emulator=None,boffile=None,seed=None):
+        """
+        latency : seconds slept on each call, either a single value or a dictionary of values by method
+            name (for example {'write_int':1e-3,'write_dram':0.5}). Methods not in the dictionary have
+            no latency.
+        frame_rate : rate at which the ppout buffers are filled, in frames per second. If None, a new
+            frame is ready after every *polls_per_frame* reads of the address register, which makes
+            reads deterministic and as fast as possible.
+        chan_offset : offset subtracted from the FPGA channel indexes written to the 'chans' BRAM
+            (2 for the baseband readouts, 4 for the heterodyne readout). Used to report the channel
+            register value.
+        clock_mhz : value returned by est_brd_clk
+        emulator : optional udp_emulator.RoachUdpEmulator, which follows the 'streamid' register
+        boffile : name of the boffile considered already programmed, or None for an unprogrammed board
+        """
+        self.latency = latency
+        self.frame_rate = frame_rate
+        self.polls_per_frame = polls_per_frame
+        self.chan_offset = chan_offset
+        self.clock_mhz = clock_mhz
+        self.emulator = emulator
+        self.random = np.random.RandomState(seed)
+        self.calls = collections.defaultdict(int)
+        self.boffile = None
+        self.registers = {}
+        self.brams = {}
+        self.dram = {}
+        self._frames = collections.defaultdict(int)
+        self._polls = collections.defaultdict(int)
+        self._t0 = time.time()
+        if boffile is not None:
+            self.progdev(boffile)
+
+    def _call(self,name):
+        self.calls[name] += 1
+        if isinstance(self.latency,dict):
+            latency = self.latency.get(name,0)
+        else:
+            latency = self.latency
+        if latency:
+            time.sleep(latency)
+
+    def _check_programmed(self):
+        if not self.boffile:
+            raise RuntimeError("FPGA is not programmed")
+
+    def is_connected(self):
+        return True
+
+    def progdev(self,boffile):
+        """
+        Program *boffile*, or deprogram if it is empty. Programming clears the registers and memories.
+        """
+        self._call('progdev')
+        self.boffile = boffile or None
+        self.registers = {}
+        self.brams = {}
+        self.dram = {}
+        self._frames.clear()
+        self._polls.clear()
+        self._t0 = time.time()
+        return 'ok'
+
+    def est_brd_clk(self):
+        self._call('est_brd_clk')
+        return self.clock_mhz
+
+    def write_int(self,reg,value,blindwrite=False,offset=0):
+        self._call('write_int')
+        self._check_programmed()
+        self.registers[reg] = int(value) & 0xFFFFFFFF
+        if reg == 'streamid' and self.emulator is not None:
+            self.emulator.streamid = int(value)
+
+    def read_uint(self,reg,offset=0):
+        self._call('read_uint')
+        self._check_programmed()
+        return self._read_register(reg)
+
+    def read_int(self,reg):
+        self._call('read_int')
+        self._check_programmed()
+        value = self._read_register(reg)
+        if value >= 2**31:
+            value -= 2**32
+        return value
+
+    def _read_register(self,reg):
+        if reg.endswith('_addr'):
+            return self._buffer_addr(reg[:-len('_addr')])
+        if reg.endswith('_chan') and reg not in self.registers:
+            return self._channel_id()
+        return self.registers.get(reg,0)
+
+    def _buffer_addr(self,bufname):
+        """
+        Address register of a ping-pong buffer. Bit 0x1000 selects the bank being written, so it
+        toggles each time a frame is completed.
+        """
+        if self.frame_rate:
+            frames = (time.time() - self._t0)*self.frame_rate
+        else:
+            self._polls[bufname] += 1
+            frames = self._polls[bufname]/float(self.polls_per_frame)
+        self._frames[bufname] = int(frames)
+        return int(frames*frame_samples) % (2*frame_samples)
+
+    def _channel_id(self):
+        """
+        Channel register: the channel id of the last channel written to the 'chans' BRAM
+        """
+        binsel = np.fromstring(self.brams.get('chans',''),dtype='>i4')
+        binsel = binsel[:np.flatnonzero(binsel == -1)[0]] if (binsel == -1).any() else binsel
+        if binsel.shape[0] == 0:
+            return 0
+        return int(binsel[-1]) + self.chan_offset + 1
+
+    def read(self,name,size,offset=0):
+        self._call('read')
+        self._check_programmed()
+        if name.startswith('ppout') and name[-2:] in ('_a','_b'):
+            return self.frame_data(name[:-2],size)
+        if name in ('i0_bram','q0_bram') and name not in self.brams:
+            adc = self.random.randint(-2**11,2**11,size=size/2)*16
+            return adc.astype('>i2').tostring()
+        data = self.brams.get(name,'')[offset:offset+size]
+        return data + '\x00'*(size-len(data))
+
+    def frame_data(self,bufname,size):
+        """
+        Contents of a ping-pong buffer bank: the real part of each sample counts samples within the
+        frame and the imaginary part is the frame number
+        """
+        iq = np.empty((size/2,),dtype='>i2')
+        iq[0::2] = np.arange(size/4) % 2**15
+        iq[1::2] = self._frames[bufname] % 2**15
+        return iq.tostring()
+
+    def write(self,name,data,offset=0):
+        self._call('write')
+        self._check_programmed()
+        old = self.brams.get(name,'')
+        if len(old) < offset:
+            old = old + '\x00'*(offset-len(old))
+        self.brams[name] = old[:offset] + data + old[offset+len(data):]
+
+    def blindwrite(self,name,data,offset=0):
+        self.write(name,data,offset=offset)
+
+    def write_dram(self,data,offset=0,verbose=False):
+        """
+        Write to the 64 MB DRAM bank selected by the dram_controller register
+        """
+        self._call('write_dram')
+        self._check_programmed()
+        if offset + len(data) > dram_bank_size:
+            raise RuntimeError("DRAM write of %d bytes at offset %d exceeds the bank size" % (len(data),offset))
+        bank = self.registers.get('dram_controller',0)
+        if bank not in self.dram:
+            self.dram[bank] = np.zeros((dram_bank_size,),dtype=np.uint8)
+        self.dram[bank][offset:offset+len(data)] = np.fromstring(data,dtype=np.uint8)
+
+    def read_dram_bank(self,bank,size,offset=0):
+        """
+        Contents of DRAM bank *bank* (not part of the FpgaClient interface)
+        """
+        if bank not in self.dram:
+            return np.zeros((size,),dtype=np.uint8)
+        return self.dram[bank][offset:offset+size].copy()
+
+class MockValon(object):
+    def __init__(self,frequency=512.0):
+        """
+        Stand-in for valon.Synthesizer, keeping the frequencies of both outputs in MHz
+        """
+        self.frequency = {'a':frequency,'b':frequency}
+
+    def get_frequency_a(self):
+        return self.frequency['a']
+
+    def get_frequency_b(self):
+        return self.frequency['b']
+
+    def set_frequency_a(self,freq,chan_spacing=2.0):
+        self.frequency['a'] = freq
+
+    def set_frequency_b(self,freq,chan_spacing=2.0):
+        self.frequency['b'] = freq
@@ -0,0 +1,185 @@
+"""
+Tone phases with a low crest factor for the multitone waveforms played from the DRAM
+
+The waveform is normalized by its peak (wavenorm), so the lower the ratio of peak to RMS (the crest
+factor) the more of the DAC range each tone gets. Random phases give a crest factor of about 4.5
+for a few hundred tones. optimize_phases lowers it by iterative clipping:
+
+    start from Newman phases, pi*k**2/ntones with k the rank of the tone frequency
+    repeat:
+        synthesize the waveform of every bank, a few banks at a time
+        clip it at a fraction of its peak
+        move each tone's phasor away from the spectrum of the clipped excess at its bins
+
+keeping the phases with the lowest peak over all banks, since every bank shares the same phases and
+the same wavenorm. As in RoachInterface._synthesize_banks, only banks_per_chunk banks are
+synthesized at once, so a prepared sweep of many large banks needs no more memory than one chunk.
+With more than one chunk the clipping level comes from the peak of the previous iteration, since the
+peak of the current one is not known until its last chunk. Only a few samples exceed the clipping
+level, so the spectrum of the excess at the tone bins is usually computed directly from them rather
+than with a forward FFT. For tones on a regular grid Newman phases alone give about 1.9 and the
+iterations about 1.6. For tones at arbitrary bins the iterations typically take the crest factor
+from about 4.5 to 3, a gain of 3 to 4 dB in power per tone.
+
+Results are kept in an LRU cache (phase_cache) keyed on the bins, amplitudes and parameters, so
+setting the same tones again costs nothing.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+# included in the cache keys, and by the readout in the waveform_cache keys, to be incremented
+# whenever the optimization changes the phases produced
+optimizer_version = 2
+
+def newman_phases(bins):
+    """
+    Newman phases, pi*k**2/ntones, with k the rank of each tone in the first bank
+
+    returns : array of ntones phases
+    """
+    bins = np.atleast_2d(bins)
+    ntones = bins.shape[1]
+    rank = np.empty((ntones,))
+    rank[np.argsort(bins[0],kind='mergesort')] = np.arange(ntones)
+    return np.pi*rank**2/ntones
+
+def waveform_rms(nsamp,amps,ntones):
+    """
+    RMS of the irfft of *ntones* tones of amplitude *amps* in a spectrum of nsamp/2+1 points
+    """
+    amps = np.ones((ntones,))*amps
+    return np.sqrt(2*np.sum(amps**2))/nsamp
+
+def crest_factor(bins,nsamp,phases,amps=1.0):
+    """
+    Peak over all banks of the waveform of tones *bins* (nwaves,ntones) divided by its RMS
+    """
+    bins = np.atleast_2d(bins)
+    spec = np.zeros((bins.shape[0],nsamp/2+1),dtype='complex')
+    spec[np.arange(bins.shape[0])[:,None],bins] = amps*np.exp(1j*phases)
+    return np.abs(np.fft.irfft(spec,axis=1)).max()/waveform_rms(nsamp,amps,bins.shape[1])
+
+def _excess_spectrum(wave,level,bins,nsamp):
+    """
+    Spectrum at *bins* (nwaves,ntones) of the excess of *wave* (nwaves,nsamp) over +-*level*,
+    summed over banks
+    """
+    total = np.zeros((bins.shape[1],),dtype='complex')
+    for k in range(bins.shape[0]):
+        t = np.flatnonzero(np.abs(wave[k]) > level)
+        excess = wave[k,t] - np.clip(wave[k,t],-level,level)
+        if t.shape[0]*bins.shape[1] > nsamp/4:
+            full = np.zeros((nsamp,))
+            full[t] = excess
+            total += np.fft.rfft(full)[bins[k]]
+        elif t.shape[0]:
+            total += np.dot(np.exp((-2j*np.pi/nsamp)*np.outer(bins[k],t)),excess)
+    return total
+
+class PhaseCache(object):
+    def __init__(self,max_entries=256):
+        """
+        Least recently used cache of optimized phases, limited to *max_entries* bin sets
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._phases = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        with self._lock:
+            value = self._phases.pop(key,None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._phases[key] = value
+            self.hits += 1
+            return value
+
+    def put(self,key,value):
+        with self._lock:
+            self._phases.pop(key,None)
+            while self._phases and len(self._phases) >= self.max_entries:
+                self._phases.popitem(last=False)
+            self._phases[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._phases.clear()
+
+phase_cache = PhaseCache()
+
+def optimize_phases(bins,nsamp,amps=1.0,iterations=50,max_seconds=2.0,clip=0.8,step=0.5,cache=True,
+                    banks_per_chunk=1):
+    """
+    Find tone phases with a low crest factor
+
+    bins : array of tone bins (ntones,) or (nwaves,ntones), as for RoachBaseband.set_tone_bins
+    nsamp : number of samples in each bank
+    amps : amplitude of the tones, a scalar or an array of ntones
+    iterations : maximum number of clipping iterations
+    max_seconds : time budget, after which the best phases so far are returned. Each iteration
+        takes an irfft of all banks, so large multi-bank waveforms get fewer iterations.
+    clip : clipping level, as a fraction of the current peak
+    step : size of the phasor update, relative to the largest tone amplitude
+    cache : if True, use (and fill) phase_cache. The time budget makes the result depend on the
+        speed of the machine, so results are only reproducible through the cache.
+    banks_per_chunk : number of banks synthesized at once, which sets the peak memory
+
+    returns : phases,crest with *phases* an array of ntones and *crest* their crest factor
+    """
+    bins = np.atleast_2d(bins)
+    nwaves,ntones = bins.shape
+    amps = np.ones((ntones,))*amps
+    if cache:
+        h = hashlib.sha1()
+        h.update(repr((optimizer_version,bins.shape,int(nsamp),iterations,clip,step,banks_per_chunk)))
+        h.update(np.asarray(bins,dtype=np.int64).tostring())
+        h.update(amps.tostring())
+        key = h.hexdigest()
+        cached = phase_cache.get(key)
+        if cached is not None:
+            phases,crest = cached
+            return phases.copy(),crest
+    tic = time.time()
+    rms = waveform_rms(nsamp,amps,ntones)
+    banks_per_chunk = min(banks_per_chunk,nwaves)
+    rows = np.arange(banks_per_chunk)[:,None]
+    # reused for every chunk: only the tone bins are set, and cleared again after the irfft
+    spec = np.zeros((banks_per_chunk,nsamp/2+1),dtype='complex')
+    phases = newman_phases(bins)
+    best_phases,best_peak = phases,np.inf
+    peak = None
+    for k in range(iterations+1):
+        tones = amps*np.exp(1j*phases)
+        level = None if banks_per_chunk == nwaves else peak
+        peak = 0.0
+        excess = np.zeros((ntones,),dtype='complex')
+        for start in range(0,nwaves,banks_per_chunk):
+            chunk_bins = bins[start:start+banks_per_chunk]
+            chunk_rows = rows[:chunk_bins.shape[0]]
+            spec[chunk_rows,chunk_bins] = tones
+            wave = np.fft.irfft(spec[:chunk_bins.shape[0]],axis=1)
+            spec[chunk_rows,chunk_bins] = 0
+            peak = max(peak,wave.max(),-wave.min())
+            if k < iterations:
+                excess += _excess_spectrum(wave,clip*(peak if level is None else level),chunk_bins,nsamp)
+            del wave
+        if peak < best_peak:
+            best_phases,best_peak = phases,peak
+        if k == iterations or time.time() - tic > max_seconds:
+            break
+        largest = np.abs(excess).max()
+        if largest == 0:
+            break
+        phases = np.angle(tones - (step*amps.max()/largest)*excess)
+    crest = best_peak/rms
+    if cache:
+        phase_cache.put(key,(best_phases.copy(),crest))
+    return best_phases,crest
@@ -0,0 +1,173 @@
+"""
+Raw capture of the ROACH UDP stream to disk, and offline decoding of such captures
+
+capture_raw receives the datagrams straight into memory mapped .npy files with no decoding or
+demodulation, so a capture can be far larger than RAM and the acquisition host does little more than
+copy packets. The readout configuration needed to demodulate the data later is saved alongside:
+
+    <basename>.npy          packets, dtype udp_catcher.pkt_dtype
+    <basename>_lengths.npy  received size of each packet
+    <basename>_config.npz   tone_bins, phases, fft_bins, readout_selection and the other readout state
+
+RawCapture reads the files back and decodes and demodulates them a chunk at a time.
+"""
+
+import socket
+import time
+
+import numpy as np
+
+import udp_catcher
+
+# readout state needed to decode and demodulate a capture
+config_attributes = ['tone_bins','phases','fft_bins','readout_selection','fpga_fft_readout_indexes','bank',
+                     'tone_nsamp','nfft','fs','wavenorm','wafer','_window_mag']
+
+def save_config(ri,filename,**kwargs):
+    """
+    Save the readout configuration of *ri* to the .npz file *filename*
+
+    Additional keyword arguments are saved as well.
+    """
+    config = dict([(name,getattr(ri,name)) for name in config_attributes if getattr(ri,name,None) is not None])
+    config['readout_class'] = ri.__class__.__name__
+    config.update(kwargs)
+    np.savez(filename,**config)
+
+def capture_raw(ri,basename,nread,streamid=1,addr=None):
+    """
+    Capture *nread* 4096 sample frames from the UDP stream of *ri* to disk without decoding them
+
+    ri : RoachBaseband (or subclass) instance, with select_fft_bins already called
+    basename : path of the capture, without extension
+    nread : number of 4096 sample frames to read, as for get_data_udp
+
+    returns : number of packets received
+    """
+    if addr is None:
+        addr = (ri.host_ip,12345)
+    nch = ri.fpga_fft_readout_indexes.shape[0]
+    npkts = nread*16*nch
+    save_config(ri,basename + '_config.npz',streamid=streamid,epoch=time.time(),npkts=npkts)
+    pkts = np.lib.format.open_memmap(basename + '.npy',mode='w+',dtype=udp_catcher.pkt_dtype,shape=(npkts,))
+    lengths = np.lib.format.open_memmap(basename + '_lengths.npy',mode='w+',dtype=np.int32,shape=(npkts,))
+    try:
+        udp_catcher.get_udp_packets(ri,npkts,streamid,addr=addr,pkts=pkts,lengths=lengths)
+        nrecv = npkts
+    except socket.timeout, e:
+        print e
+        nrecv = np.count_nonzero(lengths)
+    finally:
+        pkts.flush()
+        lengths.flush()
+        del pkts,lengths
+    return nrecv
+
+class RawCapture(object):
+    def __init__(self,basename):
+        """
+        A raw capture written by capture_raw, opened read only with memory mapping
+        """
+        self.basename = basename
+        self.pkts = np.load(basename + '.npy',mmap_mode='r')
+        self.lengths = np.load(basename + '_lengths.npy',mmap_mode='r')
+        npz = np.load(basename + '_config.npz')
+        self.config = dict([(name,npz[name]) for name in npz.files])
+        npz.close()
+        self.streamid = int(self.config['streamid'])
+        self.epoch = float(self.config['epoch'])
+        self.chans = self.config['fpga_fft_readout_indexes'] + 1
+        self.nfft = int(self.config['nfft'])
+        self.chan_rate = float(self.config['fs'])*1e6/(2*self.nfft)
+
+    def get_readout(self):
+        """
+        Rebuild the readout object the capture was made with, without connecting to any hardware
+
+        The returned object has the saved configuration, which is enough for demodulate_data and
+        DataFile.add_timestream_data.
+        """
+        import roach_interface
+        cls = getattr(roach_interface,str(self.config['readout_class']))
+        ri = cls.__new__(cls)
+        for name in config_attributes:
+            if name in self.config:
+                value = self.config[name]
+                if value.ndim == 0:
+                    value = value.item()
+                setattr(ri,name,value)
+        return ri
+
+    def iter_chunks(self,chunk_packets=2**16,demod=True):
+        """
+        Decode the capture a chunk at a time
+
+        chunk_packets : number of packets read from disk per chunk
+        demod : if True, demodulate each chunk, keeping the phase continuous across chunks
+
+        yields : data,t0,health
+            data : complex array of shape (nsamples,nchan). Chunks are contiguous in time, with missing
+                packets filled with zeros as by udp_catcher.decode_packets
+            t0 : time of the first sample of the chunk (seconds since the epoch)
+            health : udp_catcher.CaptureHealth for the packets of the chunk
+        """
+        decoder = udp_catcher.PacketDecoder(self.streamid,self.chans,self.nfft)
+        if demod:
+            demodulator = self.get_readout().get_demodulator()
+        for start in range(0,self.pkts.shape[0],chunk_packets):
+            stop = min(start+chunk_packets,self.pkts.shape[0])
+            health = udp_catcher.CaptureHealth()
+            health.epoch = self.epoch
+            lengths = np.asarray(self.lengths[start:stop])
+            if not lengths.any():
+                break # capture timed out before here
+            good = lengths == udp_catcher.pkt_size
+            health.packets = stop - start
+            health.size_mismatch = (~good).sum()
+            pkts = np.asarray(self.pkts[start:stop])
+            if health.size_mismatch:
+                pkts = pkts[good]
+            sample = decoder.samples
+            data,seqnos = decoder.decode(pkts,health=health)
+            if demod:
+                data = demodulator.demodulate(data,inplace=True)
+            yield data,self.epoch + sample/self.chan_rate,health
+
+    def decode(self,demod=True,chunk_packets=2**16):
+        """
+        Decode the whole capture into memory
+
+        returns : data,health
+        """
+        health = udp_catcher.CaptureHealth()
+        health.epoch = self.epoch
+        chunks = []
+        for data,t0,chunk_health in self.iter_chunks(chunk_packets=chunk_packets,demod=demod):
+            chunks.append(data)
+            health.accumulate(chunk_health)
+        return np.concatenate(chunks,axis=0),health
+
+    def to_data_file(self,df,block_samples=2**16,demod=True):
+        """
+        Decode the capture into timestream blocks of *block_samples* samples in DataFile *df*
+
+        Only complete blocks are written. Capture health is logged for every chunk read.
+        """
+        ri = self.get_readout()
+        tsg = None
+        pending = []
+        npending = 0
+        t0 = None
+        for data,chunk_t0,health in self.iter_chunks(demod=demod):
+            df.log_capture_health(health)
+            if t0 is None:
+                t0 = chunk_t0
+            pending.append(data)
+            npending += data.shape[0]
+            while npending >= block_samples:
+                buf = np.concatenate(pending,axis=0)
+                tsg = df.add_timestream_data(buf[:block_samples],ri,t0,tsg=tsg)
+                pending = [buf[block_samples:]]
+                npending -= block_samples
+                t0 += block_samples/self.chan_rate
+        return tsg
@@ -0,0 +1,118 @@
+"""
+Batched UDP receive using the Linux recvmmsg system call through ctypes
+
+recv_packets has the same interface as udp_catcher.recv_packets, but receives as many datagrams as
+are waiting with a single system call. If recvmmsg is not available (non-Linux hosts, old kernels or
+libc), *available* is False and udp_catcher falls back to its recv_into loop.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import threading
+
+import numpy as np
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.c_void_p),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+# numpy views of the C structures, so the message vectors can be filled without a python loop
+iovec_dtype = np.dtype({'names':['base','len'],
+                        'formats':[np.uintp,np.uintp],
+                        'offsets':[iovec.iov_base.offset,iovec.iov_len.offset],
+                        'itemsize':ctypes.sizeof(iovec)})
+mmsghdr_dtype = np.dtype({'names':['iov','iovlen','flags','len'],
+                          'formats':[np.uintp,np.uintp,np.int32,np.uint32],
+                          'offsets':[msghdr.msg_iov.offset,msghdr.msg_iovlen.offset,msghdr.msg_flags.offset,
+                                     mmsghdr.msg_len.offset],
+                          'itemsize':ctypes.sizeof(mmsghdr)})
+
+MSG_DONTWAIT = getattr(socket,'MSG_DONTWAIT',0x40)
+MSG_TRUNC = getattr(socket,'MSG_TRUNC',0x20)
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+    available = True
+except (OSError, AttributeError, TypeError):
+    _recvmmsg = None
+    available = False
+
+# maximum number of datagrams per recvmmsg call. The message vectors are allocated once per thread at
+# this size, so receiving into a very large buffer (such as a memory mapped raw capture) costs no extra memory
+max_batch = 1024
+
+_local = threading.local()
+
+def _get_vectors():
+    """
+    Get this thread's iovec and mmsghdr arrays, each with max_batch entries
+    """
+    if not hasattr(_local,'msgs'):
+        iovs = np.zeros((max_batch,),dtype=iovec_dtype)
+        msgs = np.zeros((max_batch,),dtype=mmsghdr_dtype)
+        msgs['iov'] = iovs.ctypes.data + np.arange(max_batch,dtype=np.uintp)*iovec_dtype.itemsize
+        msgs['iovlen'] = 1
+        _local.iovs = iovs
+        _local.msgs = msgs
+        _local.offsets = np.arange(max_batch,dtype=np.uintp)
+    return _local.iovs,_local.msgs,_local.offsets
+
+def recv_packets(s,pkts,lengths,start=0):
+    """
+    Receive packets from socket *s* into the preallocated pkts and lengths arrays with recvmmsg
+    
+    Slots from *start* onwards are filled until the arrays are full or the socket timeout (as set
+    with s.settimeout) expires while waiting for more packets. If the kernel turns out not to support
+    recvmmsg, *available* is cleared and the function returns early so the caller can fall back.
+    
+    returns : index one past the last filled slot
+    """
+    global available
+    if not available:
+        raise RuntimeError("recvmmsg is not available on this system")
+    iovs,msgs,offsets = _get_vectors()
+    itemsize = pkts.dtype.itemsize
+    iovs['len'] = itemsize
+    base = pkts.ctypes.data
+    timeout = s.gettimeout()
+    fd = s.fileno()
+    nrecv = start
+    while nrecv < pkts.shape[0]:
+        ready,_,_ = select.select([s],[],[],timeout)
+        if not ready:
+            break
+        nbatch = min(max_batch,pkts.shape[0]-nrecv)
+        iovs['base'][:nbatch] = base + (nrecv + offsets[:nbatch])*itemsize
+        nmsg = _recvmmsg(fd, msgs.ctypes.data, nbatch, MSG_DONTWAIT | MSG_TRUNC, None)
+        if nmsg < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                continue
+            if err == errno.ENOSYS:
+                # libc has the wrapper but the kernel does not support the call
+                available = False
+                break
+            raise socket.error(err, os.strerror(err))
+        lengths[nrecv:nrecv+nmsg] = msgs['len'][:nmsg]
+        nrecv += nmsg
+    return nrecv
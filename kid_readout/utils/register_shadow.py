@@ -0,0 +1,154 @@
+"""
+Shadow copy of the ROACH software registers, to avoid redundant katcp round trips
+
+Every katcp request is a network round trip of a few milliseconds. Much of the register traffic
+writes values the register already holds: the attenuator GPIO bit banging in set_attenuator writes
+the same data value several times in a row, and the sync pulse starts by writing 0 to a register that
+is already 0. ShadowedFpgaClient wraps an FpgaClient, remembers the last value written to each
+register with write_int, and skips writes that would not change it:
+
+    r = register_shadow.shadowed(FpgaClient('roach'))
+    with r.operation('set_dac_attenuator'):
+        ...
+    print r.operations['set_dac_attenuator']
+
+Only registers written by software are involved, so the shadow stays valid until the FPGA is
+reprogrammed (progdev clears it) or another client writes to the board. Call invalidate() or pass
+force=True to write_int in that case. Reads always go to the hardware.
+
+Devices programmed through registers, such as the attenuators, can record their last setting in
+the latched dictionary, which is cleared along with the register shadow, and skip setting it again.
+
+Round trips and elided writes are counted in total and for each named operation, and the katcp
+requests are timed in self.timers (an instrumentation.OperationTimers).
+"""
+
+import collections
+import contextlib
+import weakref
+
+import instrumentation
+
+# FpgaClient methods which make a katcp request, and so are counted as round trips
+katcp_methods = set(['read','read_int','read_uint','write','blindwrite','write_dram','read_dram','est_brd_clk',
+                     'listdev','listbof','status','ping','tap_start','tap_stop','config_10gbe_core'])
+
+_shadowed_clients = weakref.WeakKeyDictionary()
+
+def shadowed(client):
+    """
+    Get the ShadowedFpgaClient for *client*, creating it if needed
+
+    All readouts sharing an FpgaClient share a single shadow, so a write through one of them is
+    seen by the others.
+    """
+    if isinstance(client,ShadowedFpgaClient):
+        return client
+    try:
+        return _shadowed_clients[client]
+    except KeyError:
+        shadow = ShadowedFpgaClient(client)
+        _shadowed_clients[client] = shadow
+        return shadow
+
+class OperationCounts(object):
+    def __init__(self):
+        """
+        Katcp traffic of one named operation, accumulated over every time it was performed
+        """
+        self.calls = 0
+        self.round_trips = 0
+        self.elided = 0
+
+    def __repr__(self):
+        return "OperationCounts(calls=%d, round_trips=%d, elided=%d)" % (self.calls,self.round_trips,self.elided)
+
+class ShadowedFpgaClient(object):
+    def __init__(self,client):
+        """
+        Wrap *client*, an FpgaClient (or an object with the same interface), with a register shadow
+
+        Attributes not handled here are passed through to *client*.
+        """
+        self.client = client
+        self.shadow = {}
+        self.latched = {}
+        self.round_trips = 0
+        self.elided = 0
+        self.operations = collections.defaultdict(OperationCounts)
+        self.timers = instrumentation.OperationTimers()
+        self._active = []
+
+    def __getattr__(self,name):
+        attr = getattr(self.client,name)
+        if name in katcp_methods:
+            def counted(*args,**kwargs):
+                self._count(round_trips=1)
+                with self.timers.timed(name):
+                    return attr(*args,**kwargs)
+            return counted
+        return attr
+
+    def _count(self,round_trips=0,elided=0):
+        self.round_trips += round_trips
+        self.elided += elided
+        for name in self._active:
+            self.operations[name].round_trips += round_trips
+            self.operations[name].elided += elided
+
+    @contextlib.contextmanager
+    def operation(self,name):
+        """
+        Attribute the round trips made within the block to the operation *name*
+
+        Operations can be nested; traffic is counted in every enclosing operation.
+        """
+        self.operations[name].calls += 1
+        self._active.append(name)
+        try:
+            yield self.operations[name]
+        finally:
+            self._active.remove(name)
+
+    def reset_counts(self):
+        self.round_trips = 0
+        self.elided = 0
+        self.operations.clear()
+        self.timers.reset()
+
+    def invalidate(self,reg=None):
+        """
+        Forget the shadowed value of *reg*, or of all registers and latched settings if *reg* is None
+        """
+        if reg is None:
+            self.shadow.clear()
+            self.latched.clear()
+        else:
+            for key in self.shadow.keys():
+                if key[0] == reg:
+                    del self.shadow[key]
+
+    def write_int(self,reg,value,blindwrite=False,offset=0,force=False):
+        """
+        Write *value* to register *reg*, unless the shadow shows it already holds that value
+
+        force : if True, always write
+        """
+        key = (reg,offset)
+        value = int(value)
+        if not force and self.shadow.get(key) == value & 0xFFFFFFFF:
+            self._count(elided=1)
+            self.timers.count('write_int_elided')
+            return
+        self._count(round_trips=1)
+        # if the write fails the register state is unknown
+        self.shadow.pop(key,None)
+        with self.timers.timed('write_int'):
+            self.client.write_int(reg,value,blindwrite=blindwrite,offset=offset)
+        self.shadow[key] = value & 0xFFFFFFFF
+
+    def progdev(self,boffile):
+        self._count(round_trips=1)
+        self.invalidate()
+        with self.timers.timed('progdev'):
+            return self.client.progdev(boffile)
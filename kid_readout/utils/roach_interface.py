@@ -7,18 +7,23 @@ import time
 import sys
 import os
 import socket
+import threading
+import Queue
 import borph_utils
+import dram_upload
 import udp_catcher
+import udp_stream
+import demodulation
+import data_block
+import register_shadow
+import instrumentation
+import waveform_cache
+import tone_banks
+import phase_optimizer
 
 from roach_utils import ntone_power_correction
 
 import scipy.signal
-
-try:
-    import numexpr
-    have_numexpr = True
-except ImportError:
-    have_numexpr = False
 CONFIG_FILE_NAME = '/home/data/roach_config.npz'
 
 def compute_window(npfb=2**15,taps = 2, wfunc = scipy.signal.flattop):
@@ -30,15 +35,131 @@ def compute_window(npfb=2**15,taps = 2, wfunc = scipy.signal.flattop):
     return mag
     
 
+def get_data_udp_multi(readouts,nread=2,demod=True):
+    """
+    Capture from baseband readouts on several ROACHs in the same acquisition window
+    
+    Each readout's stream is identified by its streamid attribute and received on (host_ip,udp_port),
+    so readouts sending to the same port must use distinct stream ids. The two wafers of one ROACH
+    can not be captured together: they share the streamid register, and the PPC server only streams
+    the ppout0 buffer.
+    
+    readouts : list of RoachBaseband instances, with select_fft_bins already called
+    nread : number of 4096 sample frames to read from each readout
+    demod : should the data be demodulated before returning? Default, yes
+    
+    returns : list of (data,seqnos), one per readout, as from RoachBaseband.get_data_udp
+    """
+    chan_offset = 1
+    results = udp_catcher.get_udp_data_multi(readouts,
+                                             npkts=[nread*16*ri.fpga_fft_readout_indexes.shape[0] for ri in readouts],
+                                             streamids=[ri.streamid for ri in readouts],
+                                             chans=[ri.fpga_fft_readout_indexes+chan_offset for ri in readouts],
+                                             nffts=[ri.nfft for ri in readouts],
+                                             stream_regs=[ri.stream_reg for ri in readouts],
+                                             addrs=[(ri.host_ip,ri.udp_port) for ri in readouts])
+    output = []
+    for ri,(data,seqnos,health) in zip(readouts,results):
+        ri.capture_health = health
+        if demod:
+            data = ri.demodulate_data(data,inplace=True)
+        output.append((data,seqnos))
+    return output
+
+def prefetch(iterable,depth=1):
+    """
+    Iterate over *iterable* in a worker thread, keeping up to *depth* items ready ahead of the
+    consumer, so producing the next item overlaps with using the current one
+    
+    Exceptions raised by the producer are raised again in the consumer. If the consumer stops
+    early, the worker is stopped as well.
+    
+    yields : the items of *iterable*, each with the time in seconds the worker spent producing it
+    """
+    queue = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item,timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            tic = time.time()
+            for item in iterable:
+                if not put((item,time.time()-tic)):
+                    return
+                tic = time.time()
+            put((done,None))
+        except Exception:
+            put((done,sys.exc_info()))
+    worker = threading.Thread(target=produce)
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            item,produce_time = queue.get()
+            if item is done:
+                if produce_time is not None:
+                    raise produce_time[0],produce_time[1],produce_time[2]
+                return
+            yield item,produce_time
+    finally:
+        stop.set()
+        worker.join()
+
 class RoachInterface(object):
     """
     Base class for readout systems.
     These methods define an abstract interface that can be relied on to be consistent between
     the baseband and heterodyne readout systems
     """
+    # how _load_dram uploads when fast=True: 'channel' streams through a persistent
+    # dram_upload.DramChannel, 'ssh' runs ssh and dd for every 64 MB bank. A readout whose ROACH can
+    # not run the channel's helper switches itself to 'ssh'.
+    dram_upload_method = 'channel'
+    dram_helper = dram_upload.default_helper
+    # where DRAM images are staged for the katcp and channel paths, None for the system temporary
+    # directory. The ssh path stages in roach_root, which the ROACH mounts over NFS.
+    dram_staging_dir = None
+    roach_root = '/srv/roach_boot/etch'
+    # size of the DRAM, which limits the number of tone banks
+    dram_bytes = 2**30
+    
     def __init__(self):
         raise NotImplementedError("Abstract class, instantiate a subclass instead of this class")
     
+    @property
+    def timers(self):
+        """
+        instrumentation.OperationTimers for the operations of this readout
+        """
+        try:
+            return self._timers
+        except AttributeError:
+            self._timers = instrumentation.OperationTimers()
+            return self._timers
+    
+    def get_timing(self):
+        """
+        Timers and counters of this readout and of its katcp requests (prefixed with katcp_)
+        
+        returns : flat dictionary, see instrumentation.OperationTimers.as_dict
+        """
+        timing = self.timers.as_dict()
+        if isinstance(getattr(self,'r',None),register_shadow.ShadowedFpgaClient):
+            timing.update(self.r.timers.as_dict(prefix='katcp_'))
+        return timing
+    
+    def reset_timing(self):
+        self.timers.reset()
+        if isinstance(getattr(self,'r',None),register_shadow.ShadowedFpgaClient):
+            self.r.timers.reset()
+    
     # FPGA Functions
     def _update_bof_pid(self):
         if self.bof_pid:
@@ -200,10 +321,12 @@ class RoachInterface(object):
     def _unpause_dram(self):
         self.r.write_int('dram_rst',2)
     def _load_dram(self,data, start_offset=0, fast=True):
-        if fast:
+        if not fast:
+            load_dram = self._load_dram_katcp
+        elif self.dram_upload_method == 'ssh':
             load_dram = self._load_dram_ssh
         else:
-            load_dram = self._load_dram_katcp
+            load_dram = self._load_dram_channel
         nbytes = data.nbytes
         bank_size = (64*2**20)  # PPC can only access 64MB at a time, so need to break the data into chunks of this size
         nbanks,rem = divmod(nbytes,bank_size)
@@ -217,16 +340,118 @@ class RoachInterface(object):
         bank_offset = start_offset_bytes // bank_size
         start_offset_bytes = start_offset_bytes - bank_size * bank_offset
         print "bank_offset=",bank_offset,"start_offset=",start_offset,"start_offset_bytes=",start_offset_bytes
-        for bank in range(nbanks):
-            print "writing DRAM bank",(bank+bank_offset)
-            self.r.write_int('dram_controller', bank + bank_offset)
-            load_dram(data[bank*bank_size_units:(bank+1)*bank_size_units],offset_bytes=start_offset_bytes)
+        # every wafer's samples are interleaved in the image, so none of the resident waveforms survive
+        for latch in [latch for latch in self.r.latched if latch[0] == 'dram']:
+            del self.r.latched[latch]
+        with self.timers.timed('dram_load'):
+            for bank in range(nbanks):
+                print "writing DRAM bank",(bank+bank_offset)
+                self.r.write_int('dram_controller', bank + bank_offset)
+                load_dram(data[bank*bank_size_units:(bank+1)*bank_size_units],offset_bytes=start_offset_bytes)
+        self.timers.count('dram_load_bytes',nbytes)
+        
+    def _new_dram_image(self,nentries,fast=True):
+        """
+        Create the staging file for a DRAM image of *nentries* entries, in the NFS exported root if
+        it is to be loaded with ssh
+        
+        returns : dram_upload.DramImage
+        """
+        if fast and self.dram_upload_method == 'ssh':
+            directory = os.path.join(self.roach_root,'boffiles')
+        else:
+            directory = self.dram_staging_dir
+        return dram_upload.DramImage(nentries,directory=directory)
+    
+    def _load_dram_stream(self,banks,fast=True,size=None,pipeline=True,verbose=True):
+        """
+        Load a DRAM image given as an iterable of consecutive parts, so the upload can start before
+        the image is complete
+        
+        Each part is loaded by _load_dram as soon as it is produced. With *pipeline*, the parts (and
+        so any waveform synthesis behind them) are produced on a worker thread, so the next DRAM
+        bank is prepared while the current one is uploading. The time spent preparing, uploading and
+        waiting for each bank is accumulated in self.timers as dram_prepare, dram_upload and
+        dram_wait.
         
-    def _load_dram_katcp(self,data,tries=2):
+        banks : iterable of start,buf with buf a '>i2' array, usually part of a DramImage, to be
+            loaded at DRAM position *start* in '>i2' entries, as produced by _stage_dram_banks
+        size : total number of entries in *banks*, if known, for the progress report
+        verbose : print the progress and timings of each DRAM bank
+        """
+        if pipeline:
+            banks = prefetch(banks)
+        else:
+            banks = self._timed_items(banks)
+        loaded = 0
+        tic = time.time()
+        wait_tic = time.time()
+        try:
+            for (start,buf),prepare_time in banks:
+                wait_time = time.time() - wait_tic
+                self.timers.add('dram_prepare',prepare_time)
+                if pipeline:
+                    self.timers.add('dram_wait',wait_time)
+                upload_tic = time.time()
+                self._load_dram(buf,start_offset=start,fast=fast)
+                upload_time = time.time() - upload_tic
+                self.timers.add('dram_upload',upload_time)
+                loaded += buf.shape[0]
+                if verbose:
+                    if size:
+                        progress = "%.0f%%" % (100.0*loaded/size)
+                    else:
+                        progress = "%.1f MB" % (loaded*2/2.0**20)
+                    print ("loaded %s of waveform, %.1f MB/s: prepare %.2f s, wait %.2f s, upload %.2f s" %
+                           (progress,loaded*2/2.0**20/(time.time()-tic),prepare_time,wait_time,upload_time))
+                wait_tic = time.time()
+        finally:
+            # stops the worker thread if the upload failed
+            banks.close()
+        
+    def _stage_dram_banks(self,image,wafer,waves,start_offset=0):
+        """
+        Place consecutive pieces of the waveform of *wafer* into *image*, a DramImage to be loaded at
+        DRAM position *start_offset*
+        
+        waves : iterable of arrays of samples, each of even length, of any dtype DramImage.place
+            accepts
+        
+        yields : start,buf for each 64 MB DRAM bank (or part of a bank at either end of the image) as
+            soon as it is filled, with buf a view of image.data and *start* its DRAM position in '>i2'
+            entries
+        """
+        bank_units = (64*2**20)/2
+        filled = 0  # entries of the image filled so far
+        done = 0    # entries of the image yielded so far
+        for wave in waves:
+            pos = 0
+            while pos < wave.shape[0]:
+                room = bank_units - (start_offset + filled) % bank_units
+                n = min(wave.shape[0]-pos,room/2)
+                image.place(wafer,filled/2,wave[pos:pos+n])
+                filled += 2*n
+                pos += n
+                if (start_offset + filled) % bank_units == 0:
+                    yield start_offset + done,image.data[done:filled]
+                    done = filled
+        if filled > done:
+            yield start_offset + done,image.data[done:filled]
+    
+    def _timed_items(self,iterable):
+        """
+        yields : the items of *iterable*, each with the time in seconds spent producing it, as prefetch
+        """
+        tic = time.time()
+        for item in iterable:
+            yield item,time.time()-tic
+            tic = time.time()
+        
+    def _load_dram_katcp(self,data,offset_bytes=0,tries=2):
         while tries > 0:
             try:
                 self._pause_dram()
-                self.r.write_dram(data.tostring())
+                self.r.write_dram(data.tostring(),offset=offset_bytes)
                 self._unpause_dram()
                 return
             except Exception, e:
@@ -234,42 +459,118 @@ class RoachInterface(object):
 #                print e
             tries = tries - 1
         raise Exception("Writing to dram failed!")
-    def _load_dram_ssh(self,data,offset_bytes=0,roach_root='/srv/roach_boot/etch',datafile='boffiles/dram.bin'):
+    def _get_dram_channel(self):
+        """
+        Get the persistent DRAM upload channel, starting it if it is not running or the boffile
+        has been restarted since it was started
+        """
+        channel = getattr(self,'_dram_channel',None)
+        if channel is not None and (not channel.alive() or channel.bof_pid != self.bof_pid):
+            channel.close()
+            channel = None
+        if channel is None:
+            command = dram_upload.ssh_command(self.roachip,helper=self.dram_helper,bof_pid=self.bof_pid)
+            channel = dram_upload.DramChannel(command,bof_pid=self.bof_pid)
+            self._dram_channel = channel
+        return channel
+    
+    def _load_dram_channel(self,data,offset_bytes=0,tries=2):
+        """
+        Load *data* through the persistent upload helper. If the helper can not be run at all (it
+        has not been built for this ROACH, say), this readout falls back to the ssh method.
+        """
+        never_ran = True
+        while tries > 0:
+            channel = None
+            self._pause_dram()
+            try:
+                channel = self._get_dram_channel()
+                elapsed = channel.write(offset_bytes,data)
+                print "uploaded %.1f MB in %.2f s, %.1f MB/s" % (data.nbytes/2.0**20,elapsed,data.nbytes/2.0**20/elapsed)
+                self.timers.add('dram_channel_write',elapsed)
+                self.timers.count('dram_channel_bytes',data.nbytes)
+                return
+            except (RuntimeError,OSError), e:
+                print e
+                if channel is not None:
+                    never_ran = never_ran and channel.bytes == 0
+                    channel.close()
+                self._dram_channel = None
+            finally:
+                self._unpause_dram()
+            tries = tries - 1
+        if never_ran:
+            print "could not run the DRAM upload helper %s, falling back to ssh" % self.dram_helper
+            self.dram_upload_method = 'ssh'
+            self.timers.count('dram_channel_fallback')
+            return self._load_dram_ssh(data,offset_bytes=offset_bytes)
+        raise Exception("Writing to dram failed!")
+    
+    def _load_dram_ssh(self,data,offset_bytes=0,roach_root=None,datafile='boffiles/dram.bin'):
+        """
+        Load *data* with dd over ssh. If *data* is part of the DramImage staged in *roach_root*, dd
+        reads it from the staging file, otherwise it is first written to *datafile*.
+        """
+        if roach_root is None:
+            roach_root = self.roach_root
         offset_blocks = offset_bytes/512  #dd uses blocks of 512 bytes by default
         self._update_bof_pid()
         self._pause_dram()
-        data.tofile(os.path.join(roach_root,datafile))
         dram_file = '/proc/%d/hw/ioreg/dram_memory' % self.bof_pid
-        datafile = '/' + datafile
-        result = borph_utils.check_output(('ssh root@%s "dd seek=%d if=%s of=%s"' % (self.roachip,offset_blocks,datafile,dram_file)),shell=True)
+        image = getattr(self,'dram_image',None)
+        skip = None
+        if image is not None and os.path.dirname(image.path).startswith(roach_root) and data.nbytes % 512 == 0:
+            skip = image.offset_of(data)
+        if skip is not None and skip % 512 == 0:
+            datafile = image.path[len(roach_root):]
+            image.data.flush()
+            command = 'dd seek=%d skip=%d count=%d if=%s of=%s' % (offset_blocks,skip/512,data.nbytes/512,datafile,dram_file)
+        else:
+            data.tofile(os.path.join(roach_root,datafile))
+            datafile = '/' + datafile
+            command = 'dd seek=%d if=%s of=%s' % (offset_blocks,datafile,dram_file)
+        result = borph_utils.check_output(('ssh root@%s "%s"' % (self.roachip,command)),shell=True)
         print result
         self._unpause_dram()    
         
     def _sync(self):
-        self.r.write_int('sync',0)
-        self.r.write_int('sync',1)
-        self.r.write_int('sync',0)
+        with self.r.operation('sync'):
+            self.r.write_int('sync',0)
+            self.r.write_int('sync',1)
+            self.r.write_int('sync',0)
     
     ### Other hardware functions (attenuator, valon)
     def set_attenuator(self,attendb,gpio_reg='gpioa',data_bit=0x08,clk_bit=0x04,le_bit=0x02):
+        """
+        Shift *attendb* into an attenuator by bit banging *gpio_reg*
+        
+        Consecutive writes of the same GPIO value are elided by the register shadow, so a setting
+        takes between 14 and 21 round trips depending on its bit pattern, and none if the attenuator
+        already holds it.
+        """
         atten = int(attendb*2)
-        try:
+        latch = ('attenuator',gpio_reg,le_bit)
+        with self.r.operation('set_attenuator'):
+            if self.r.latched.get(latch) == atten:
+                return
+            try:
+                self.r.write_int(gpio_reg, 0x00)
+            except RuntimeError:
+                print "ROACH not programmed, cannot set attenuators"
+                return
+            mask = 0x20
+            for j in range(6):
+                if atten & mask:
+                    data=data_bit
+                else:
+                    data = 0x00
+                mask = mask>>1
+                self.r.write_int(gpio_reg, data)
+                self.r.write_int(gpio_reg, data | clk_bit)
+                self.r.write_int(gpio_reg, data)
+            self.r.write_int(gpio_reg, le_bit)
             self.r.write_int(gpio_reg, 0x00)
-        except RuntimeError:
-            print "ROACH not programmed, cannot set attenuators"
-            return
-        mask = 0x20
-        for j in range(6):
-            if atten & mask:
-                data=data_bit
-            else:
-                data = 0x00
-            mask = mask>>1
-            self.r.write_int(gpio_reg, data)
-            self.r.write_int(gpio_reg, data | clk_bit)
-            self.r.write_int(gpio_reg, data)
-        self.r.write_int(gpio_reg, le_bit)
-        self.r.write_int(gpio_reg, 0x00)
+            self.r.latched[latch] = atten
         
     def set_adc_attenuator(self,attendb):
         print "Warning! ADC attenuator is no longer adjustable. Value will be fixed at 31.5 dB"
@@ -289,8 +590,9 @@ class RoachInterface(object):
         else:
             attena = attendb
             attenb = 0
-        self.set_attenuator(attena,le_bit=0x01)
-        self.set_attenuator(attenb,le_bit=0x02)
+        with self.r.operation('set_dac_attenuator'):
+            self.set_attenuator(attena,le_bit=0x01)
+            self.set_attenuator(attenb,le_bit=0x02)
         self.dac_atten = int(attendb*2)/2.0
         self.save_state()
         
@@ -305,6 +607,43 @@ class RoachInterface(object):
         """
         raise NotImplementedError
     
+    def _demodulation_parameters(self):
+        """
+        Per channel demodulation parameters for the channels in self.readout_selection
+        
+        returns : foffs,wc,sign,phi0,conj as used by demodulation.demodulate
+        """
+        raise NotImplementedError
+    
+    def demodulate_data(self,data,t0=0,inplace=False):
+        """
+        Demodulate the data from the FFT bin
+        
+        This function assumes that self.select_fft_bins was called to set up the necessary class attributes
+        
+        data : array of complex data
+        t0 : sample index of the first row of *data*, so the chunks of a long capture can be demodulated
+            separately with continuous phase
+        inplace : if True and *data* is complex64, it is overwritten with the result
+        
+        returns : demodulated data in a complex64 array of the same shape as *data*
+        """
+        with self.timers.timed('demodulate'):
+            foffs,wc,sign,phi0,conj = self._demodulation_parameters()
+            demod = demodulation.demodulate(data,foffs,wc,sign,phi0,conj,t0=t0,inplace=inplace)
+        self.timers.count('demodulated_samples',data.size)
+        return demod
+    
+    def get_demodulator(self,t0=0):
+        """
+        Get a demodulation.Demodulator for the current readout configuration, to demodulate a
+        continuous stream a chunk at a time
+        
+        t0 : sample index of the first chunk
+        """
+        foffs,wc,sign,phi0,conj = self._demodulation_parameters()
+        return demodulation.Demodulator(foffs,wc,sign,phi0,conj,t0=t0)
+    
     def _window_response(self,fr):
         res = np.interp(np.abs(fr)*2**7, np.arange(2**7), self._window_mag)
         res = 1/res
@@ -315,20 +654,33 @@ class RoachInterface(object):
     def _read_data(self,nread,bufname,verbose=False):
         """
         Low level data reading loop, common to both readouts
+        
+        The output is preallocated and each 4096 sample frame is decoded into it as soon as it is read.
+        The time at which each frame was read and the number of address register polls spent waiting
+        for the next frame are stored in self.read_frame_times and self.read_idle_polls.
+        
+        returns : dout,addrs,chans
+            dout : complex64 array of the samples of all frames read
+            addrs : address register value when each frame was read
+            chans : channel register value when each frame was read
         """
         regname = '%s_addr' % bufname
         chanreg = '%s_chan' % bufname
+        frame_samples = 2**12
         a = self.r.read_uint(regname) & 0x1000
         addr = self.r.read_uint(regname) 
         b = addr & 0x1000
         while a == b:
             addr = self.r.read_uint(regname)
             b = addr & 0x1000
-        data = []
-        addrs = []
-        chans = []
+        dout = np.empty((nread*frame_samples,),dtype=data_block.sample_dtype)
+        iq = dout.view('float32')
+        addrs = np.zeros((nread,),dtype=np.int64)
+        chans = np.zeros((nread,),dtype=np.int64)
+        frame_times = np.zeros((nread,))
+        idle_polls = np.zeros((nread,),dtype=np.int64)
         tic = time.time()
-        idle = 0
+        nframes = 0
         try:
             for n in range(nread):
                 a = b
@@ -336,16 +688,20 @@ class RoachInterface(object):
                     bram = '%s_a' % bufname
                 else:
                     bram = '%s_b' % bufname
-                data.append(self.r.read(bram,4*2**12))
-                addrs.append(addr)
-                chans.append(self.r.read_int(chanreg))
+                iq[n*2*frame_samples:(n+1)*2*frame_samples] = np.frombuffer(self.r.read(bram,4*frame_samples),dtype='>i2')
+                frame_times[n] = time.time()
+                addrs[n] = addr
+                chans[n] = self.r.read_int(chanreg)
+                nframes = n + 1
                 
                 addr = self.r.read_uint(regname)
                 b = addr & 0x1000
+                idle = 0
                 while a == b:
                     addr = self.r.read_uint(regname)
                     b = addr & 0x1000
                     idle += 1
+                idle_polls[n] = idle
                 if verbose:
                     print ("\r got %d" % n),
                 sys.stdout.flush()
@@ -354,11 +710,14 @@ class RoachInterface(object):
             print e
             print "\n"
         tot = time.time()-tic
-        print "\rread %d in %.1f seconds, %.2f samples per second, idle %.2f per read" % (nread, tot, (nread*2**12/tot),idle/(nread*1.0))
-        dout = np.concatenate(([np.fromstring(x,dtype='>i2').astype('float').view('complex') for x in data]))
-        addrs = np.array(addrs)
-        chans = np.array(chans)
-        return dout,addrs,chans
+        print "\rread %d in %.1f seconds, %.2f samples per second, idle %.2f per read" % (nread, tot, (nread*2**12/tot),idle_polls.sum()/(nread*1.0))
+        # not katcp_*, which get_timing uses for the register shadow's per request timers
+        self.timers.add('bram_read',tot)
+        self.timers.count('bram_frames',nframes)
+        self.timers.count('bram_idle_polls',idle_polls.sum())
+        self.read_frame_times = frame_times[:nframes]
+        self.read_idle_polls = idle_polls[:nframes]
+        return dout[:nframes*frame_samples],addrs[:nframes],chans[:nframes]
 
 
     def _cont_read_data(self,callback,bufname, verbose=False):
@@ -448,6 +807,7 @@ class RoachBaseband(RoachInterface):
                 if (time.time()-t1) > timeout:
                     raise Exception("Connection timeout to roach")
                 time.sleep(0.1)
+        self.r = register_shadow.shadowed(self.r)
                 
         if adc_valon is None:
             import valon
@@ -488,6 +848,8 @@ class RoachBaseband(RoachInterface):
         self.phases = None
         self.bof_pid = None
         self.roachip = roachip
+        self.udp_stream = None
+        self.capture_health = None
 #        self.boffile = 'bb2xpfb14mcr5_2013_Jul_31_1301.bof'
 #        self.boffile = 'bb2xpfb14mcr7_2013_Oct_31_1332.bof'
         self.boffile = 'bb2xpfb14mcr11_2014_Jan_17_1721.bof'
@@ -502,6 +864,9 @@ class RoachBaseband(RoachInterface):
             print "warning couldn't get valon frequency, assuming 512 MHz"
             self.fs = 512.0
         self.wafer = wafer
+        self.streamid = 1 # stream id tagging the UDP packets; the PPC server only streams ppout0
+        self.stream_reg = 'streamid'
+        self.udp_port = 12345
         self.dac_ns = 2**16 # number of samples in the dac buffer
         self.raw_adc_ns = 2**12 # number of samples in the raw ADC buffer
         self.nfft = 2**14
@@ -532,24 +897,73 @@ class RoachBaseband(RoachInterface):
         self._unpause_dram()
         self.bank = bank
 
-    def load_waveform(self,wave,start_offset=0, fast=True):
+    def load_waveform(self,wave,start_offset=0, fast=True, key=None, size=None):
         """
         Load waveform
         
-        wave : array of 16-bit (dtype='i2') integers with waveform
-        
+        wave : array of 16-bit (dtype='i2') integers with waveform, or an iterable of arrays of
+            quantized samples (each of even length) to be loaded one after the other, such as the
+            banks produced by _synthesize_banks
+        start_offset : index of the bank at which to load *wave*, which must then be an array
+            holding one bank
         fast : boolean
             decide what method for loading the dram 
-        """
-        data = np.zeros((2*wave.shape[0],),dtype='>i2')
-        offset = self.wafer*2
-        data[offset::4] = wave[::2]
-        data[offset+1::4] = wave[1::2]
-        start_offset = start_offset * data.shape[0]
+        key : optional waveform_cache key identifying *wave*. If the DRAM already holds this
+            waveform for this wafer, nothing is loaded.
+        size : number of samples in *wave*, required if it is an iterable
+        
+        The samples are written straight into this wafer's slots of a DramImage, which is uploaded
+        a DRAM bank at a time as it fills. The pieces of an iterable *wave* are produced on a worker
+        thread while the previous DRAM bank uploads (see _load_dram_stream). Any work done before the
+        first piece, such as the norm pass of _synthesize_banks, is not overlapped.
+        
+        returns : the DramImage loaded, its staging file already deleted, or None if nothing was
+            loaded
+        """
+        resident = ('dram',self.wafer)
+        if key is not None and start_offset == 0 and self.r.latched.get(resident) == key:
+            self.timers.count('dram_load_skipped')
+            return None
+        if isinstance(wave,np.ndarray):
+            size = wave.shape[0]
+            start_offset = start_offset * 2*size
+            pieces = [wave]
+        elif size is None:
+            raise ValueError("size must be given when wave is an iterable")
+        else:
+            pieces = wave
 #        self.r.write_int('dram_mask', data.shape[0]/4 - 1)
-        self._load_dram(data,start_offset=start_offset, fast=fast)
+        image = self._new_dram_image(2*size,fast=fast)
+        self.dram_image = image
+        try:
+            self._load_dram_stream(self._stage_dram_banks(image,self.wafer,pieces,start_offset),
+                                   fast=fast, size=2*size)
+        finally:
+            image.release()
+            self.dram_image = None
+        if key is not None and start_offset == 0:
+            self.r.latched[resident] = key
+        return image
+    
+    @property
+    def qwave(self):
+        """
+        Quantized waveform of all banks, dtype '>i2'. A waveform synthesized straight into a DRAM
+        image is only extracted from it when this is first used.
+        """
+        qwave = getattr(self,'_qwave',None)
+        image = getattr(self,'_qwave_image',None)
+        if qwave is None and image is not None:
+            qwave = image.extract(self.wafer)
+            self.qwave = qwave
+        return qwave
+    
+    @qwave.setter
+    def qwave(self,qwave):
+        self._qwave = qwave
+        self._qwave_image = None
         
-    def set_tone_freqs(self,freqs,nsamp,amps=None,load=True,normfact = None):
+    def set_tone_freqs(self,freqs,nsamp,amps=None,load=True,normfact = None,phase_seed=None,optimize_phases=False):
         """
         Set the stimulus tones to generate
         
@@ -562,13 +976,16 @@ class RoachBaseband(RoachInterface):
             of the spectrum with no stimulus tone.
         load : bool (debug only). 
             If false, don't actually load the waveform, just calculate it.
+        phase_seed : optional seed for the random tone phases, see set_tone_bins
+        optimize_phases : if True, use phases with a low crest factor, see set_tone_bins
                     
         returns:
         actual_freqs : array of the actual frequencies after quantization based on nsamp
         """        
         bins = np.round((freqs/self.fs)*nsamp).astype('int')
         actual_freqs = self.fs*bins/float(nsamp)
-        self.set_tone_bins(bins, nsamp,amps=amps,load=load,normfact=normfact)
+        self.set_tone_bins(bins, nsamp,amps=amps,load=load,normfact=normfact,phase_seed=phase_seed,
+                           optimize_phases=optimize_phases)
         self.fft_bins = self.calc_fft_bins(bins, nsamp)
         if self.fft_bins.shape[1] > 8:
             readout_selection = range(8)
@@ -580,18 +997,26 @@ class RoachBaseband(RoachInterface):
         self.save_state()
         return actual_freqs
     
-    def add_tone_freqs(self,freqs,amps=None):
+    def add_tone_freqs(self,freqs,amps=None,bank=None):
+        """
+        Put a set of tones in a single DRAM bank, see add_tone_bins
+        
+        returns : actual_freqs, as set_tone_freqs
+        """
         if freqs.shape[0] != self.tone_bins.shape[1]:
             raise ValueError("freqs array must contain same number of tones as original waveforms")
         nsamp = self.tone_nsamp
         bins = np.round((freqs/self.fs)*nsamp).astype('int')
         actual_freqs = self.fs*bins/float(nsamp)
-        self.add_tone_bins(bins, amps=amps)
-        self.fft_bins = np.vstack((self.fft_bins,self.calc_fft_bins(bins, nsamp)))
+        bank = self.add_tone_bins(bins, amps=amps, bank=bank)
+        if bank == self.fft_bins.shape[0]:
+            self.fft_bins = np.vstack((self.fft_bins,self.calc_fft_bins(bins, nsamp)))
+        else:
+            self.fft_bins[bank] = self.calc_fft_bins(bins, nsamp)
         self.save_state()
         return actual_freqs
 
-    def set_tone_bins(self,bins,nsamp,amps=None,load=True,normfact=None):
+    def set_tone_bins(self,bins,nsamp,amps=None,load=True,normfact=None,phase_seed=None,optimize_phases=False):
         """
         Set the stimulus tones by specific integer bins
         
@@ -604,50 +1029,215 @@ class RoachBaseband(RoachInterface):
             specify the relative amplitude of each tone. Can set to zero to read out a portion
             of the spectrum with no stimulus tone.
         load : bool (debug only). If false, don't actually load the waveform, just calculate it.
+        normfact : optional fixed normalization of the waveform. Without it the waveform is scaled by
+            its peak over all banks, which is only known once every bank has been synthesized, so
+            the DRAM upload waits for that first pass (see _synthesize_banks).
+        phase_seed : optional seed for the random tone phases. With a seed the waveform is determined
+            by the arguments, so it is not loaded again if it is already in the DRAM, and is taken
+            from waveform_cache.cache if that is enabled and it was synthesized before.
+        optimize_phases : if True, use phases with a low crest factor found by
+            phase_optimizer.optimize_phases instead of random phases, giving each tone more of the DAC
+            range. The phases are cached for each set of bins, as is the waveform, in place of a
+            phase_seed.
         """
         
         if bins.ndim == 1:
             bins.shape = (1,bins.shape[0])
-        nwaves = bins.shape[0]
-        spec = np.zeros((nwaves,nsamp/2+1),dtype='complex')
         self.tone_bins = bins.copy()
         self.tone_nsamp = nsamp
-        phases = np.random.random(bins.shape[1])*2*np.pi
-        self.phases = phases.copy()
         if amps is None:
             amps = 1.0
         self.amps = amps
-        for k in range(nwaves):
-            spec[k,bins[k,:]] = amps*np.exp(1j*phases)
-        wave = np.fft.irfft(spec,axis = 1)
-        self.wavenorm = np.abs(wave).max()
-        if normfact is not None:
-            wn = (2.0/normfact)*len(bins)/float(nsamp)
-            print "ratio of current wavenorm to optimal:",self.wavenorm/wn
-            self.wavenorm = wn
-        qwave = np.round((wave/self.wavenorm)*(2**15-1024)).astype('>i2')
-        qwave.shape = (qwave.shape[0]*qwave.shape[1],)
-        self.qwave = qwave
+        key = None
+        cached = None
+        if optimize_phases:
+            phase_seed = ('optimized',phase_optimizer.optimizer_version)
+        if phase_seed is not None:
+            key = waveform_cache.waveform_key('baseband',bins,nsamp,amps,phase_seed,normfact)
+            cached = waveform_cache.cache.get(key)
+        if cached is not None:
+            qwave,phases,self.wavenorm = cached
+            self.timers.count('waveform_cache_hits')
+            if load:
+                self.load_waveform(qwave,key=key)
+        else:
+            wavenorm = None
+            if optimize_phases:
+                with self.timers.timed('phase_optimization'):
+                    phases,crest = phase_optimizer.optimize_phases(bins,nsamp,amps)
+                print "crest factor of the optimized phases: %.2f" % crest
+                if normfact is None:
+                    # the peak is already known, so the norm pass over all banks is not needed
+                    wavenorm = crest*phase_optimizer.waveform_rms(nsamp,amps,bins.shape[1])
+            elif phase_seed is None:
+                phases = np.random.random(bins.shape[1])*2*np.pi
+            else:
+                phases = np.random.RandomState(phase_seed).random_sample(bins.shape[1])*2*np.pi
+            # each bank is quantized straight into the DRAM image and loaded as soon as it is
+            # synthesized, with the next bank synthesized while it uploads
+            size = bins.shape[0]*nsamp
+            banks = self._synthesize_banks(bins,nsamp,amps,phases,normfact,wavenorm=wavenorm)
+            image = None
+            if load:
+                image = self.load_waveform(banks,key=key,size=size)
+            if image is None:
+                image = self._new_dram_image(2*size)
+                image.release()
+                for bank in self._stage_dram_banks(image,self.wafer,banks):
+                    pass
+            qwave = None
+            if key is not None:
+                qwave = waveform_cache.cache.open(key,(size,))
+                if qwave is not None:
+                    qwave.reshape((-1,2))[:] = image.slots(self.wafer)
+                    waveform_cache.cache.put(key,qwave,phases,self.wavenorm)
+        self.phases = phases.copy()
+        keys = [None]*bins.shape[0]
         if load:
-            self.load_waveform(qwave)
+            keys = [tone_banks.tone_bank_key(row,nsamp,amps,phases,self.wavenorm) for row in bins]
+        self._bank_allocator = tone_banks.ToneBankAllocator(self._max_tone_banks(nsamp),keys=keys)
+        if cached is None and qwave is None:
+            self.qwave = None
+            self._qwave_image = image
+        else:
+            self.qwave = qwave
         self.save_state()
         
-    def add_tone_bins(self,bins,amps=None):
+    def _synthesize_banks(self,bins,nsamp,amps,phases,normfact=None,banks_per_chunk=1,wavenorm=None):
+        """
+        Compute the quantized waveform for the tones *bins* (nwaves,ntones) with *phases* a few banks
+        at a time, setting self.wavenorm before the first chunk is produced
+        
+        Peak memory is set by *banks_per_chunk*, not by the number of banks. Unless *normfact* is
+        given, the norm is the largest magnitude over all banks, so each bank is synthesized twice:
+        once to find the norm and once to quantize it, unless the norm is given as *wavenorm*.
+        
+        All banks share one norm, so no chunk can be yielded until the first pass is complete. A
+        consumer such as load_waveform therefore only overlaps the second pass with the upload;
+        with *normfact* or *wavenorm* given, the upload starts after the first chunk.
+        
+        The samples are rounded in place in the floating point synthesis output, rather than
+        converted to a new '>i2' array, since the consumer converts them anyway when it places them
+        in the DRAM image.
+        
+        yields : quantized waveform of each chunk of banks_per_chunk banks, concatenated, as rounded
+            float64 values
+        """
+        tic = time.time()
+        nwaves = bins.shape[0]
+        tones = amps*np.exp(1j*phases)
+        def waves():
+            for start in range(0,nwaves,banks_per_chunk):
+                stop = min(start+banks_per_chunk,nwaves)
+                spec = np.zeros((stop-start,nsamp/2+1),dtype='complex')
+                for k in range(start,stop):
+                    spec[k-start,bins[k,:]] = tones
+                yield np.fft.irfft(spec,axis=1)
+        if wavenorm is not None:
+            self.wavenorm = wavenorm
+        elif normfact is None:
+            self.wavenorm = max([np.abs(wave).max() for wave in waves()])
+        else:
+            self.wavenorm = (2.0/normfact)*len(bins)/float(nsamp)
+        wavemax = 0
+        for wave in waves():
+            wavemax = max(wavemax,np.abs(wave).max())
+            wave /= self.wavenorm
+            wave *= (2**15-1024)
+            qwave = np.round(wave,out=wave)
+            qwave.shape = (qwave.shape[0]*qwave.shape[1],)
+            toc = time.time()
+            yield qwave
+            tic += time.time() - toc # don't count the time spent by the consumer
+        if normfact is not None:
+            print "ratio of current wavenorm to optimal:",wavemax/self.wavenorm
+        self.timers.add('waveform_synthesis',time.time()-tic)
+        
+    def _store_banks(self,out,chunks):
+        """
+        Copy each chunk of waveform into *out* as it passes through
+        """
+        start = 0
+        for chunk in chunks:
+            out[start:start+chunk.shape[0]] = chunk
+            start += chunk.shape[0]
+            yield chunk
+        
+    def _synthesize_waveform(self,bins,nsamp,amps,phases,normfact=None):
+        """
+        Compute the quantized waveform for the tones *bins* (nwaves,ntones) with *phases*, and set
+        self.wavenorm
+        
+        returns : qwave, the waveforms of all banks concatenated, dtype '>i2'
+        """
+        qwave = np.empty((bins.shape[0]*nsamp,),dtype='>i2')
+        for chunk in self._store_banks(qwave,self._synthesize_banks(bins,nsamp,amps,phases,normfact)):
+            pass
+        return qwave
+        
+    def _max_tone_banks(self,nsamp):
+        return self.dram_bytes/(4*nsamp)
+    
+    @property
+    def bank_allocator(self):
+        """
+        tone_banks.ToneBankAllocator recording the tones in each DRAM bank. Banks whose tones were
+        not set by this readout, for example after restoring the state, are of unknown contents.
+        """
+        allocator = getattr(self,'_bank_allocator',None)
+        if allocator is None or allocator.nbanks != self.tone_bins.shape[0]:
+            allocator = tone_banks.ToneBankAllocator(self._max_tone_banks(self.tone_nsamp),
+                                                     keys=[None]*self.tone_bins.shape[0])
+            self._bank_allocator = allocator
+        return allocator
+    
+    def free_tone_bank(self,bank):
+        """
+        Release *bank* for reuse by the next add_tone_bins. It keeps its tones until then.
+        """
+        self.bank_allocator.free(bank)
+    
+    def add_tone_bins(self,bins,amps=None,bank=None):
+        """
+        Put a set of tones in a single DRAM bank, synthesizing and loading only that bank
+        
+        bins : array of bins, as many as in each of the existing banks. The tones take the phases
+            and wavenorm of the existing banks.
+        bank : bank to replace in place, or the number of banks to add a bank at the end. If None,
+            the lowest bank released by free_tone_bank is reused, or a bank is added if there is
+            none.
+        
+        If the bank already holds these tones, nothing is synthesized or loaded.
+        
+        returns : the bank used, for select_bank
+        """
         nsamp = self.tone_nsamp
-        spec = np.zeros((nsamp/2+1,),dtype='complex')
-        self.tone_bins = np.vstack((self.tone_bins,bins))
         phases = self.phases
         if amps is None:
             amps = 1.0
 #        self.amps = amps  # TODO: Need to figure out how to deal witht his
-        
-        spec[bins] = amps*np.exp(1j*phases)
-        wave = np.fft.irfft(spec)
-        qwave = np.round((wave/self.wavenorm)*(2**15-1024)).astype('>i2')
-        #self.qwave = qwave  # TODO: Deal with this, if we ever use it
-        start_offset = self.tone_bins.shape[0] - 1 
-        self.load_waveform(qwave,start_offset=start_offset)      
+        key = tone_banks.tone_bank_key(bins,nsamp,amps,phases,self.wavenorm)
+        bank,changed = self.bank_allocator.allocate(key,bank)
+        if bank == self.tone_bins.shape[0]:
+            self.tone_bins = np.vstack((self.tone_bins,bins))
+        else:
+            self.tone_bins[bank] = bins
+        if changed:
+            tic = time.time()
+            spec = np.zeros((nsamp/2+1,),dtype='complex')
+            spec[bins] = amps*np.exp(1j*phases)
+            wave = np.fft.irfft(spec)
+            # rounded in place; load_waveform converts to '>i2' as it places the samples
+            wave /= self.wavenorm
+            wave *= (2**15-1024)
+            qwave = np.round(wave,out=wave)
+            self.timers.add('waveform_synthesis',time.time()-tic)
+            #self.qwave = qwave  # TODO: Deal with this, if we ever use it
+            self.load_waveform(qwave,start_offset=bank)
+        else:
+            self.timers.count('tone_bank_unchanged')
         self.save_state()
+        return bank
         
     def calc_fft_bins(self,tone_bins,nsamp):
         """
@@ -702,44 +1292,60 @@ class RoachBaseband(RoachInterface):
         binsel[-1] = -1
         self.r.write('chans',binsel.tostring())
         
-    def demodulate_data(self,data):
+    def _demodulation_parameters(self):
+        bank = self.bank
+        k = self.tone_bins[bank,self.readout_selection]
+        m = self.fft_bins[bank,self.readout_selection]
+        nfft = self.nfft
+        ns = self.tone_nsamp
+        foffs = (2*k*nfft - m*ns)/float(ns)
+        wc = self._window_response(foffs/2.0)*(self.tone_nsamp/2.0**18)
+        upper = m >= self.nfft/2
+        sign = np.where(upper,1.0,-1.0)
+        phi0 = self.phases[self.readout_selection]
+        return foffs,wc,sign,phi0,upper
+    
+    def start_udp_stream(self,reads_per_chunk=1):
         """
-        Demodulate the data from the FFT bin
+        Start a continuous UDP stream
         
-        This function assumes that self.select_fft_bins was called to set up the necessary class attributes
+        While the stream is running, get_data_udp reads from it instead of opening a socket for each
+        capture. Other consumers can call self.udp_stream.subscribe() to receive the decoded chunks.
         
-        data : array of complex data
+        reads_per_chunk : number of 4096 sample frames per chunk delivered to subscribers
         
-        returns : demodulated data in an array of the same shape and dtype as *data*
+        returns : the UdpStream instance, also stored as self.udp_stream
         """
-        bank = self.bank
-        demod = np.zeros_like(data)
-        t = np.arange(data.shape[0])
-        for n,ich in enumerate(self.readout_selection):
-            phi0 = self.phases[ich]
-            k = self.tone_bins[bank,ich]
-            m = self.fft_bins[bank,ich]
-            if m >= self.nfft/2:
-                sign = 1.0
-            else:
-                sign = -1.0
-            nfft = self.nfft
-            ns = self.tone_nsamp
-            foffs = (2*k*nfft - m*ns)/float(ns)
-            wc = self._window_response(foffs/2.0)*(self.tone_nsamp/2.0**18)
-            demod[:,n] = wc*np.exp(sign*1j*(2*np.pi*foffs*t + phi0)) * data[:,n]
-            if m >= self.nfft/2:
-                demod[:,n] = np.conjugate(demod[:,n])
-        return demod
+        self.stop_udp_stream()
+        chan_offset = 1
+        self.udp_stream = udp_stream.UdpStream(self, chans=self.fpga_fft_readout_indexes+chan_offset, nfft=self.nfft,
+                                               streamid=self.streamid, stream_reg=self.stream_reg,
+                                               addr=(self.host_ip,self.udp_port),
+                                               reads_per_chunk=reads_per_chunk)
+        self.udp_stream.start()
+        return self.udp_stream
+    
+    def stop_udp_stream(self):
+        if self.udp_stream is not None:
+            self.udp_stream.stop()
+            self.udp_stream = None
     
     def get_data_udp(self,nread=2,demod=True):
         chan_offset = 1
         nch = self.fpga_fft_readout_indexes.shape[0]
-        data,seqnos = udp_catcher.get_udp_data(self, npkts=nread*16*nch, streamid=1, 
-                                        chans=self.fpga_fft_readout_indexes+chan_offset,
-                                        nfft=self.nfft,addr=(self.host_ip,12345)) #, stream_reg, addr)
+        chans = self.fpga_fft_readout_indexes+chan_offset
+        with self.timers.timed('udp_capture'):
+            if self.udp_stream is not None and self.udp_stream.running:
+                nchunks = int(np.ceil(nread/float(self.udp_stream.reads_per_chunk)))
+                data,seqnos,health = self.udp_stream.read(nchunks,chans=chans)
+            else:
+                data,seqnos,health = udp_catcher.get_udp_data(self, npkts=nread*16*nch, streamid=self.streamid,
+                                                chans=chans, nfft=self.nfft, stream_reg=self.stream_reg,
+                                                addr=(self.host_ip,self.udp_port))
+        self.timers.count('udp_packets',health.packets)
+        self.capture_health = health
         if demod:
-            data = self.demodulate_data(data)
+            data = self.demodulate_data(data,inplace=True)
         return data,seqnos
     
     def get_data(self,nread=2,demod=True):
@@ -777,7 +1383,7 @@ class RoachBaseband(RoachInterface):
         returns  dout,addrs
 
         dout: complex data stream. Real and imaginary parts are each 16 bit signed
-            integers (but cast to numpy complex)
+            integers (but cast to numpy complex64)
 
         addrs: counter values when each frame was read. Can be used to check that
             frames are contiguous
@@ -796,7 +1402,7 @@ class RoachBaseband(RoachInterface):
         shift = np.flatnonzero(self.fpga_fft_readout_indexes==(ch[0]-chan_offset))[0] - (nch-1)
         dout = np.roll(dout,shift,axis=1)
         if demod:
-            dout = self.demodulate_data(dout)
+            dout = self.demodulate_data(dout,inplace=True)
         return dout,addr
     
     def _set_fs(self,fs,chan_spacing=2.0):
@@ -845,6 +1451,7 @@ class RoachBasebandWide(RoachBaseband):
                 if (time.time()-t1) > timeout:
                     raise Exception("Connection timeout to roach")
                 time.sleep(0.1)
+        self.r = register_shadow.shadowed(self.r)
                 
         if adc_valon is None:
             import valon
@@ -886,12 +1493,17 @@ class RoachBasebandWide(RoachBaseband):
         self.phases = None
         self.bof_pid = None
         self.roachip = roachip
+        self.udp_stream = None
+        self.capture_health = None
         try:
             self.fs = self.adc_valon.get_frequency_a()
         except:
             print "warning couldn't get valon frequency, assuming 512 MHz"
             self.fs = 512.0
         self.wafer = wafer
+        self.streamid = 1 # stream id tagging the UDP packets; the PPC server only streams ppout0
+        self.stream_reg = 'streamid'
+        self.udp_port = 12345
         self.dac_ns = 2**16 # number of samples in the dac buffer
         self.raw_adc_ns = 2**12 # number of samples in the raw ADC buffer
         self.nfft = 2**11
@@ -903,43 +1515,6 @@ class RoachBasebandWide(RoachBaseband):
         self.bufname = 'ppout%d' % wafer
         self._window_mag = compute_window(npfb = 2*self.nfft, taps= 2, wfunc = scipy.signal.flattop)
 
-    def demodulate_data(self,data):
-        """
-        Demodulate the data from the FFT bin
-        
-        This function assumes that self.select_fft_bins was called to set up the necessary class attributes
-        
-        data : array of complex data
-        
-        returns : demodulated data in an array of the same shape and dtype as *data*
-        """
-        bank = self.bank
-        demod = np.zeros_like(data)
-        t = np.arange(data.shape[0])
-        for n,ich in enumerate(self.readout_selection):
-            phi0 = self.phases[ich]
-            k = self.tone_bins[bank,ich]
-            m = self.fft_bins[bank,ich]
-            if m >= self.nfft/2:
-                sign = 1.0
-            else:
-                sign = -1.0
-            nfft = self.nfft
-            ns = self.tone_nsamp
-            foffs = (2*k*nfft - m*ns)/float(ns)
-            wc = self._window_response(foffs/2)*(self.tone_nsamp/2.0**18)
-            if have_numexpr:
-                pi = np.pi
-                this_data = data[:,n]
-                demod[:,n] = numexpr.evaluate('wc*exp(sign*1j*(2*pi*foffs*t + phi0)) * this_data')
-                if m >= self.nfft/2:
-                    np.conj(demod[:,n],out=demod[:,n])
-            else:
-                demod[:,n] = wc*np.exp(sign*1j*(2*np.pi*foffs*t + phi0)) * data[:,n]
-                if m >= self.nfft/2:
-                    demod[:,n] = np.conjugate(demod[:,n])
-        return demod
-    
 class RoachBasebandWide10(RoachBasebandWide):
     def __init__(self,roach=None,wafer=0,roachip='roach',adc_valon=None):
         """
@@ -972,6 +1547,7 @@ class RoachBasebandWide10(RoachBasebandWide):
                 if (time.time()-t1) > timeout:
                     raise Exception("Connection timeout to roach")
                 time.sleep(0.1)
+        self.r = register_shadow.shadowed(self.r)
                 
         if adc_valon is None:
             import valon
@@ -1000,47 +1576,24 @@ class RoachBasebandWide10(RoachBasebandWide):
         self.dac_atten = -1
         self.bof_pid = None
         self.roachip = roachip
+        self.udp_stream = None
+        self.capture_health = None
         try:
             self.fs = self.adc_valon.get_frequency_a()
         except:
             print "warning couldn't get valon frequency, assuming 512 MHz"
             self.fs = 512.0
         self.wafer = wafer
+        self.streamid = 1 # stream id tagging the UDP packets; the PPC server only streams ppout0
+        self.stream_reg = 'streamid'
+        self.udp_port = 12345
         self.dac_ns = 2**16 # number of samples in the dac buffer
         self.raw_adc_ns = 2**12 # number of samples in the raw ADC buffer
         self.nfft = 2**10
         #self.boffile = 'bb2xpfb10mcr8_2013_Nov_18_0706.bof'
         self.boffile = 'bb2xpfb10mcr11_2014_Jan_20_1049.bof'
         self.bufname = 'ppout%d' % wafer
-        self._window_mag = compute_window(npfb = 2*self.nfft, taps= 2, wfunc = scipy.signal.flattop)    
-    def demodulate_data(self,data):
-        """
-        Demodulate the data from the FFT bin
-        
-        This function assumes that self.select_fft_bins was called to set up the necessary class attributes
-        
-        data : array of complex data
-        
-        returns : demodulated data in an array of the same shape and dtype as *data*
-        """
-        demod = np.zeros_like(data)
-        t = np.arange(data.shape[0])
-        for n,ich in enumerate(self.readout_selection):
-            phi0 = self.phases[ich]
-            k = self.tone_bins[ich]
-            m = self.fft_bins[ich]
-            if m >= self.nfft/2:
-                sign = 1.0
-            else:
-                sign = -1.0
-            nfft = self.nfft
-            ns = self.tone_nsamp
-            foffs = (2*k*nfft - m*ns)/float(ns)
-            wc = self._window_response(foffs/2)*(self.tone_nsamp/2.0**18)
-            demod[:,n] = wc*np.exp(sign*1j*(2*np.pi*foffs*t + phi0)) * data[:,n]
-            if m >= self.nfft/2:
-                demod[:,n] = np.conjugate(demod[:,n])
-        return demod
+        self._window_mag = compute_window(npfb = 2*self.nfft, taps= 2, wfunc = scipy.signal.flattop)
 
 
 class RoachHeterodyne(RoachInterface):
@@ -1074,6 +1627,7 @@ class RoachHeterodyne(RoachInterface):
                 if (time.time()-t1) > timeout:
                     raise Exception("Connection timeout to roach")
                 time.sleep(0.1)
+        self.r = register_shadow.shadowed(self.r)
                 
         if adc_valon is None:
             import valon
@@ -1124,13 +1678,17 @@ class RoachHeterodyne(RoachInterface):
         fast : boolean
             decide what method for loading the dram 
         """
-        data = np.zeros((2*i_wave.shape[0],),dtype='>i2')
-        data[0::4] = i_wave[::2]
-        data[1::4] = i_wave[1::2]
-        data[2::4] = q_wave[::2]
-        data[3::4] = q_wave[1::2]
-        self.r.write_int('dram_mask', data.shape[0]/4 - 1)
-        self._load_dram(data,fast=fast)
+        # the I and Q DACs take the slots of wafers 0 and 1 in the DRAM image
+        image = self._new_dram_image(2*i_wave.shape[0],fast=fast)
+        image.place(0,0,i_wave)
+        image.place(1,0,q_wave)
+        self.r.write_int('dram_mask', image.data.shape[0]/4 - 1)
+        self.dram_image = image
+        try:
+            self._load_dram(image.data,fast=fast)
+        finally:
+            image.release()
+            self.dram_image = None
         
     def set_tone_freqs(self,freqs,nsamp,amps=None):
         """
@@ -1176,6 +1734,7 @@ class RoachHeterodyne(RoachInterface):
             of the spectrum with no stimulus tone.
         """
         
+        tic = time.time()
         spec = np.zeros((nsamp,),dtype='complex')
         self.tone_bins = bins.copy()
         self.tone_nsamp = nsamp
@@ -1191,6 +1750,7 @@ class RoachHeterodyne(RoachInterface):
         q_wave = np.round((wave.imag/self.wavenorm)*(2**15-1024)).astype('>i2')
         self.i_wave = i_wave
         self.q_wave = q_wave
+        self.timers.add('waveform_synthesis',time.time()-tic)
         self.load_waveforms(i_wave,q_wave)
         
     def calc_fft_bins(self,tone_bins,nsamp):
@@ -1245,35 +1805,16 @@ class RoachHeterodyne(RoachInterface):
         binsel[-1] = -1
         self.r.write('chans',binsel.tostring())
         
-    def demodulate_data(self,data):
-        """
-        Demodulate the data from the FFT bin
-        
-        This function assumes that self.select_fft_bins was called to set up the necessary class attributes
-        
-        data : array of complex data
-        
-        returns : demodulated data in an array of the same shape and dtype as *data*
-        """
-        demod = np.zeros_like(data)
-        t = np.arange(data.shape[0])
-        for n,ich in enumerate(self.readout_selection):
-            phi0 = self.phases[ich]
-            k = self.tone_bins[ich]
-            m = self.fft_bins[ich]
-            if m >= self.nfft/2:
-                sign = -1.0
-                doconj = True
-            else:
-                sign = -1.0
-                doconj = False
-            nfft = self.nfft
-            ns = self.tone_nsamp
-            foffs = (k*nfft - m*ns)/float(ns)
-            demod[:,n] = np.exp(sign*1j*(2*np.pi*foffs*t + phi0)) * data[:,n]
-            if doconj:
-                demod[:,n] = np.conjugate(demod[:,n])
-        return demod
+    def _demodulation_parameters(self):
+        k = self.tone_bins[self.readout_selection]
+        m = self.fft_bins[self.readout_selection]
+        nfft = self.nfft
+        ns = self.tone_nsamp
+        foffs = (k*nfft - m*ns)/float(ns)
+        wc = np.ones(foffs.shape)
+        sign = -np.ones(foffs.shape)
+        phi0 = self.phases[self.readout_selection]
+        return foffs,wc,sign,phi0,m >= self.nfft/2
                 
     def get_data(self,nread=10,demod=True):
         """
@@ -1286,7 +1827,7 @@ class RoachHeterodyne(RoachInterface):
         returns  dout,addrs
 
         dout: complex data stream. Real and imaginary parts are each 16 bit signed 
-                integers (but cast to numpy complex)
+                integers (but cast to numpy complex64)
 
         addrs: counter values when each frame was read. Can be used to check that 
                 frames are contiguous
@@ -1306,7 +1847,7 @@ class RoachHeterodyne(RoachInterface):
         print shift
         dout = np.roll(dout,shift,axis=1)
         if demod:
-            dout = self.demodulate_data(dout)
+            dout = self.demodulate_data(dout,inplace=True)
         return dout,addr
     
     def set_lo(self,lomhz=1200.0,chan_spacing=2.0):
@@ -1327,8 +1868,9 @@ class RoachHeterodyne(RoachInterface):
         else:
             attena = attendb
             attenb = 0
-        self.set_attenuator(attena,le_bit=0x01)
-        self.set_attenuator(attenb,le_bit=0x80)
+        with self.r.operation('set_dac_attenuator'):
+            self.set_attenuator(attena,le_bit=0x01)
+            self.set_attenuator(attenb,le_bit=0x80)
         self.dac_atten = int(attendb*2)/2.0
         
     def set_adc_attenuator(self,attendb):
@@ -1,8 +1,223 @@
 import numpy as np
+import os
+import sys
 import time
+import threading
+import Queue
 
+import demodulation
+import roach_interface
 from data_block import DataBlock, SweepData
 
+# seconds to wait after changing the channel selection before capturing, by boffile, as measured by
+# measure_settle_time. The measurements are saved in settle_times.npz next to the readout state file
+# (roach_interface.CONFIG_FILE_NAME), so they outlive the session. Firmware which has not been
+# measured gets default_settle_time.
+default_settle_time = 0.2
+settle_times = {}
+
+def _settle_times_file():
+    return os.path.join(os.path.dirname(roach_interface.CONFIG_FILE_NAME),'settle_times.npz')
+
+def load_settle_times():
+    """
+    Add the settle times saved by earlier sessions to settle_times, keeping any already there
+    """
+    try:
+        saved = np.load(_settle_times_file())
+        for boffile,seconds in zip(saved['boffiles'],saved['seconds']):
+            settle_times.setdefault(str(boffile),float(seconds))
+    except IOError:
+        pass
+
+def save_settle_time(boffile,seconds):
+    """
+    Record the settle time of *boffile* in settle_times and in the file of saved settle times
+    """
+    load_settle_times()
+    settle_times[boffile] = seconds
+    saved = dict([(key,value) for key,value in settle_times.items() if key is not None])
+    try:
+        np.savez(_settle_times_file(),boffiles=np.array(saved.keys()),seconds=np.array(saved.values()))
+    except IOError,e:
+        print "could not save the settle time:",e
+
+def settle_time(ri):
+    boffile = getattr(ri,'boffile',None)
+    if boffile not in settle_times:
+        load_settle_times()
+    return settle_times.get(boffile,default_settle_time)
+
+def measure_settle_time(ri,selections=None,reads=2,trials=4,waits=(0,0.002,0.005,0.01,0.02,0.05,0.1,0.2),
+                        margin=1.5):
+    """
+    Measure how long the readout needs after a change of channel selection before every packet
+    captured carries the new channels, and record it in settle_times for ri.boffile
+    
+    The selection alternates between two sets of channels; a capture is clean when the decoder saw no
+    channel changes or mcnt jumps (see udp_catcher.CaptureHealth). The settle time is the shortest of
+    *waits* for which all *trials* captures were clean, times *margin*. The tones must be set, and the
+    readout must capture with UDP. The result is saved for later sessions, see save_settle_time.
+    
+    selections : two lists of indexes into ri.fft_bins[ri.bank], by default the first channels split
+        into even and odd
+    
+    returns : the settle time in seconds
+    """
+    if selections is None:
+        nchan = min(ri.fft_bins.shape[1],16)
+        selections = [range(0,nchan,2),range(1,nchan,2)]
+    for wait in waits:
+        clean = 0
+        for trial in range(trials):
+            ri.select_fft_bins(selections[trial % 2])
+            ri._sync()
+            time.sleep(wait)
+            ri.get_data(reads,demod=False)
+            health = getattr(ri,'capture_health',None)
+            if health is None:
+                raise ValueError("the settle time can only be measured with the UDP readout")
+            if health.channel_changes == 0 and health.mcnt_jumps == 0:
+                clean += 1
+        if clean == trials:
+            settle = wait*margin
+            save_settle_time(getattr(ri,'boffile',None),settle)
+            print "settle time for %s: %.3f s" % (getattr(ri,'boffile',None),settle)
+            return settle
+    print "captures were not clean after waiting %.3f s, keeping the default settle time" % waits[-1]
+    return default_settle_time
+
+def run_sweep(ri,steps,reads_per_step=2,sweep_data=None,callback=None,settle=None,pipeline=True,verbose=True):
+    """
+    Capture the channels of each step of a sweep, demodulating and storing the data of each step while
+    the next one is selected and captured
+    
+    steps : sequence of (bank,selection) with *selection* a list of indexes into ri.fft_bins[bank]
+    sweep_data : SweepData to add the blocks to, by default a new one
+    callback : called with each DataBlock, on the processing thread if *pipeline*. If it returns
+        True the sweep stops, after the step being captured.
+    settle : seconds to wait after selecting the channels, by default settle_time(ri)
+    pipeline : if False, each step is processed before the next is captured
+    verbose : print a timing summary at the end
+    
+    The time taken by each step is appended to sweep_data.step_timing as a dictionary with select
+    (selecting the bank and channels, and the sync), settle, capture, wait (for the processing of the
+    previous step) and process, all in seconds. See sweep_timing_summary.
+    
+    returns : sweep_data
+    """
+    if sweep_data is not None:
+        swp = sweep_data
+    else:
+        swp = SweepData()
+    if settle is None:
+        settle = settle_time(ri)
+    nsamp = ri.tone_nsamp
+    nstep = len(steps)
+    abort = threading.Event()
+    failure = []
+    
+    def process(item):
+        timing,k,bank,data,params,chids,tones,selection,epoch = item
+        tic = time.time()
+        with ri.timers.timed('demodulate'):
+            data = demodulation.demodulate(data,*params,inplace=True)
+        ri.timers.count('demodulated_samples',data.size)
+        for m in range(len(chids)):
+            block = DataBlock(data = data[:,m], tone=tones[m], fftbin = chids[m],
+                     nsamp = nsamp, nfft = ri.nfft, wavenorm = ri.wavenorm, t0 = epoch, fs = ri.fs,
+                     sweep_index=selection[m])
+            block.progress = (k+1)/float(nstep)
+            swp.add_block(block)
+            if callback and callback(block):
+                abort.set()
+        timing['process'] = time.time() - tic
+        ri.timers.add('sweep_process',timing['process'])
+        
+    queue = Queue.Queue(maxsize=1)
+    def work():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            try:
+                if not failure:
+                    process(item)
+            except Exception:
+                failure.append(sys.exc_info())
+    if pipeline:
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+    tic = time.time()
+    selected_bank = None
+    try:
+        for k,(bank,selection) in enumerate(steps):
+            if abort.is_set() or failure:
+                break
+            timing = {}
+            step_tic = time.time()
+            # selecting a bank pauses the DRAM, which interrupts the tones, so it is only done when
+            # the sweep moves on to a new bank
+            if bank != selected_bank:
+                ri.select_bank(bank)
+                selected_bank = bank
+            ri.select_fft_bins(selection)
+            ri._sync()
+            timing['select'] = time.time() - step_tic
+            time.sleep(settle)
+            timing['settle'] = settle
+            epoch = time.time()
+            try:
+                data,addr = ri.get_data(reads_per_step,demod=False)
+            except Exception,e:
+                print e
+                continue
+            timing['capture'] = time.time() - epoch
+            ri.timers.add('sweep_capture',timing['capture'])
+            # snapshot of the configuration, which the next step changes while this one is processed
+            item = (timing,k,bank,data,ri._demodulation_parameters(),ri.fpga_fft_readout_indexes+1,
+                    ri.tone_bins[bank,ri.readout_selection],ri.readout_selection.copy(),epoch)
+            wait_tic = time.time()
+            if pipeline:
+                queue.put(item)
+            else:
+                process(item)
+            timing['wait'] = time.time() - wait_tic
+            swp.step_timing.append(timing)
+    finally:
+        if pipeline:
+            queue.put(None)
+            worker.join()
+    if failure:
+        raise failure[0][0],failure[0][1],failure[0][2]
+    if verbose:
+        summary = sweep_timing_summary(swp,time.time()-tic)
+        print ("sweep of %(steps)d steps took %(seconds).2f s, %(capture_seconds).2f s capturing "
+               "(%(capture_fraction).0f%%), %(settle_seconds).2f s settling, %(select_seconds).2f s selecting, "
+               "%(wait_seconds).2f s waiting for processing" % summary)
+    return swp
+
+def sweep_timing_summary(swp,seconds=None):
+    """
+    Totals of the step timings of a sweep made by run_sweep
+    
+    seconds : wall time of the sweep, by default the sum of the step times
+    
+    returns : dictionary with steps, seconds, the total of each timing as <name>_seconds, and
+        capture_fraction, the percentage of the time spent capturing. The sweep can be no shorter
+        than capture_seconds.
+    """
+    names = ['select','settle','capture','wait','process']
+    summary = {'steps':len(swp.step_timing)}
+    for name in names:
+        summary[name + '_seconds'] = sum([timing.get(name,0) for timing in swp.step_timing])
+    if seconds is None:
+        seconds = sum([summary[name + '_seconds'] for name in names if name != 'process'])
+    summary['seconds'] = seconds
+    summary['capture_fraction'] = 100.0*summary['capture_seconds']/seconds if seconds else 0.0
+    return summary
+
 default_segments_hz = [#np.arange(0,200e3,8e3)-490e3,
                        #np.arange(200e3,360e3,4e3)-490e3,
                        #np.arange(360e3,440e3,2e3)-490e3,
@@ -24,66 +239,140 @@ def segmented_fine_sweep(ri,center_freqs,segments=default_segments_mhz,nchan_per
     return swp
     
 
-def prepare_sweep(ri,center_freqs,offsets,nsamp=2**21):
+def prepare_sweep(ri,center_freqs,offsets,nsamp=2**21,phase_seed=None,optimize_phases=False):
     if nsamp*4*len(offsets) > 2**29:
         raise ValueError("total number of waveforms (%d) times number of samples (%d) exceeds DRAM capacity" % (len(offsets),nsamp))
     freqs = center_freqs[None,:] + offsets[:,None]
-    return ri.set_tone_freqs(freqs,nsamp=nsamp)
+    return ri.set_tone_freqs(freqs,nsamp=nsamp,phase_seed=phase_seed,optimize_phases=optimize_phases)
     
-def do_prepared_sweep(ri,nchan_per_step=8,reads_per_step=2,callback = None, sweep_data=None):
-    if sweep_data is not None:
-        swp = sweep_data
-    else:
-        swp = SweepData()
-    nbanks = ri.tone_bins.shape[0]
-    nsamp = ri.tone_nsamp
+# rough cost of selecting the channels of a step (a few register writes and the sync), used by
+# plan_sweep when no measurement is given. sweep_timing_summary of a previous sweep gives a better one.
+default_select_seconds = 0.02
+
+def plan_channel_groups(fpga_indexes,nchan_per_step=8,max_channels=None):
+    """
+    Split the channels of a set of banks into the fewest groups that can be read out at once
+    
+    The same groups are used for every bank, so one plan serves a whole prepared sweep. A group must
+    satisfy the limits of the channel selection:
+        the number of channels is a power of two, since the readout divides the frame counter
+            increment (nfft*2**12) by it and splits each frame evenly among the channels
+        it is no more than nchan_per_step and max_channels
+        no two of its channels have the same FPGA index in any bank, since select_fft_bins sorts the
+            channels by index and the data can not tell them apart
+    When no channels share an index the number of groups is the minimum, nchan//size plus one group
+    for each bit of the remainder. Otherwise the channels sharing an index are spread out first and
+    groups are split until every channel fits, which may use more groups than strictly needed.
+    Successive channels go to different groups, so each group spans the band.
+    
+    fpga_indexes : array (nbanks,nchan) or (nchan,) of the FPGA index of each channel, as given by
+        ri.fft_bin_to_index(ri.fft_bins)
+    nchan_per_step : largest number of channels to read at once
+    max_channels : channel limit of the readout stream, if smaller
+    
+    returns : list of groups, each a sorted list of channel numbers (indexes into the second axis of
+        fpga_indexes)
+    """
+    fpga_indexes = np.atleast_2d(fpga_indexes)
+    nbanks,nchan = fpga_indexes.shape
+    if nchan == 0:
+        return []
+    limit = min(nchan_per_step,nchan)
+    if max_channels is not None:
+        limit = min(limit,max_channels)
+    if limit < 1:
+        raise ValueError("at least one channel must be read at once, not %d" % limit)
+    size = 2**int(np.floor(np.log2(limit)))
+    # sizes of the groups: as many full groups as possible, then the binary digits of the remainder
+    sizes = [size]*(nchan//size)
+    rem = nchan % size
+    while rem:
+        part = 2**int(np.floor(np.log2(rem)))
+        sizes.append(part)
+        rem -= part
+    # channels sharing an index in some bank must all be in different groups
+    shared = np.zeros((nchan,),dtype=np.int64)
+    most = 1
     for bank in range(nbanks):
-        ri.select_bank(bank)
-        nchan = ri.fft_bins.shape[1]
-        nstep = int(np.ceil(nchan/float(nchan_per_step)))
-        toread = set(range(nchan))
-        for k in range(nstep):
-            if len(toread) == 0:
-                break
-            if len(toread) > nchan_per_step:
-                start = k
-                stop = k + (nchan//nstep)*nstep
-                selection = range(start,stop,nchan/nchan_per_step)[:nchan_per_step]
-                toread = toread.difference(set(selection))
-            else:
-                selection = list(toread)
-                toread = set()
-            selection.sort()
-            ri.select_fft_bins(selection)
-            ri.r.write_int('sync',0)
-            ri.r.write_int('sync',1)
-            ri.r.write_int('sync',0)
+        counts = np.bincount(fpga_indexes[bank] - fpga_indexes[bank].min())
+        shared += counts[fpga_indexes[bank] - fpga_indexes[bank].min()] - 1
+        most = max(most,counts.max())
+    while len(sizes) < most:
+        sizes = _split_largest(sizes)
+    order = sorted(range(nchan),key=lambda ch: (-shared[ch],fpga_indexes[0,ch]))
+    while True:
+        groups = _assign_channels(fpga_indexes,order,sizes)
+        if groups is not None:
+            return [sorted(group) for group in groups]
+        sizes = _split_largest(sizes)
+
+def _split_largest(sizes):
+    sizes = sorted(sizes,reverse=True)
+    if sizes[0] == 1:
+        raise ValueError("channels can not be grouped")
+    return [sizes[0]/2,sizes[0]/2] + sizes[1:]
+
+def _assign_channels(fpga_indexes,order,sizes):
+    """
+    Place each channel in *order* in the group with the most room which has none of its FPGA indexes
     
-            time.sleep(0.2)
-            epoch = time.time()
-            try:
-                dmod,addr = ri.get_data(reads_per_step)
-            except Exception,e:
-                print e
-                continue
-    #        dmod = dmod*ri.wavenorm
-            chids = ri.fpga_fft_readout_indexes+1
-            tones = ri.tone_bins[bank,ri.readout_selection]
-            abort = False
-            for m in range(len(chids)):
-                sweep_index = selection[m]# np.abs(actual_freqs - ri.fs*tones[m]/nsamp).argmin()
-                block = DataBlock(data = dmod[:,m], tone=tones[m], fftbin = chids[m], 
-                         nsamp = nsamp, nfft = ri.nfft, wavenorm = ri.wavenorm, t0 = epoch, fs = ri.fs, 
-                         sweep_index=sweep_index)
-                block.progress = (k+1)/float(nstep)
-                swp.add_block(block)
-                if callback:
-                    abort = callback(block)
-    
-            if abort:
-                break
-        
-    return swp
+    returns : list of groups, or None if a channel fits nowhere
+    """
+    groups = [[] for size in sizes]
+    used = [set() for size in sizes]
+    for ch in order:
+        keys = set(enumerate(fpga_indexes[:,ch]))
+        best = None
+        for g,size in enumerate(sizes):
+            room = size - len(groups[g])
+            if room and not (keys & used[g]) and (best is None or room > sizes[best] - len(groups[best])):
+                best = g
+        if best is None:
+            return None
+        groups[best].append(ch)
+        used[best] |= keys
+    return groups
+
+def plan_sweep(ri,nchan_per_step=8,reads_per_step=2,banks=None,settle=None,select_seconds=default_select_seconds,
+               max_channels=None):
+    """
+    Plan the steps of a sweep of the banks loaded in *ri* and estimate how long it will take
+    
+    The channel groups come from plan_channel_groups over all banks of ri.fft_bins. Each step costs
+    select_seconds, the settle time and the capture of reads_per_step reads. A read is 16 packets per
+    channel, 4096 samples of each channel whatever the number of channels, and takes
+    4096/(ri.fs*1e6/(2*ri.nfft)) seconds, so the fewer the groups the shorter the sweep.
+    
+    banks : banks to sweep, by default all of them
+    settle : seconds to wait after each selection, by default settle_time(ri)
+    select_seconds : time taken to select the channels of each step
+    max_channels : channel limit of the readout stream, if smaller than nchan_per_step
+    
+    returns : steps,seconds with *steps* the (bank,selection) list for run_sweep and *seconds* the
+        estimated duration of the sweep
+    """
+    if banks is None:
+        banks = range(np.atleast_2d(ri.fft_bins).shape[0])
+    if settle is None:
+        settle = settle_time(ri)
+    groups = plan_channel_groups(ri.fft_bin_to_index(np.atleast_2d(ri.fft_bins)),nchan_per_step=nchan_per_step,
+                                 max_channels=max_channels)
+    steps = [(bank,selection) for bank in banks for selection in groups]
+    chan_rate = ri.fs*1e6/(2*ri.nfft)
+    read_seconds = 2**12/chan_rate
+    seconds = len(banks)*len(groups)*(select_seconds + settle + reads_per_step*read_seconds)
+    return steps,seconds
+
+def do_prepared_sweep(ri,nchan_per_step=8,reads_per_step=2,callback = None, sweep_data=None, steps=None):
+    """
+    Sweep all the banks loaded by prepare_sweep
+    
+    steps : plan from plan_sweep, to reuse one already made. By default the sweep is planned with
+        nchan_per_step.
+    """
+    if steps is None:
+        steps,seconds = plan_sweep(ri,nchan_per_step=nchan_per_step,reads_per_step=reads_per_step)
+    return run_sweep(ri,steps,reads_per_step=reads_per_step,sweep_data=sweep_data,callback=callback)
         
 
 def fine_sweep(ri,center_freqs, sweep_width = 0.1,npoints =128,nsamp=2**20, sweep_data = None):
@@ -104,52 +393,10 @@ def coarse_sweep(ri,freqs=np.linspace(10,200,384),nsamp=2**15,nchan_per_step=4,r
         data = sweep_data
     else:
         data = SweepData(sweep_id)
-    ri.r.write_int('sync',0)
-    ri.r.write_int('sync',1)
-    ri.r.write_int('sync',0)
+    ri._sync()
     time.sleep(1)
-    nchan = ri.fft_bins.shape[1]
-    nstep = int(np.ceil(nchan/float(nchan_per_step)))
-    toread = set(range(nchan))
-    for k in range(nstep):
-        if len(toread) == 0:
-            break
-        if len(toread) > nchan_per_step:
-            start = k
-            stop = k + (nchan//nstep)*nstep
-            selection = range(start,stop,nchan/nchan_per_step)[:nchan_per_step]
-            toread = toread.difference(set(selection))
-        else:
-            selection = list(toread)
-            toread = set()
-        ri.select_fft_bins(selection)
-        ri.r.write_int('sync',0)
-        ri.r.write_int('sync',1)
-        ri.r.write_int('sync',0)
-
-        time.sleep(0.2)
-        try:
-            dmod,addr = ri.get_data(reads_per_step)
-        except Exception,e:
-            print e
-            continue
-#        dmod = dmod*ri.wavenorm
-        chids = ri.fpga_fft_readout_indexes+1
-        tones = ri.tone_bins[0,ri.readout_selection]
-        abort = False
-        for m in range(len(chids)):
-            sweep_index = selection[m] # np.abs(actual_freqs - ri.fs*tones[m]/nsamp).argmin()
-            block = DataBlock(data = dmod[:,m], tone=tones[m], fftbin = chids[m], 
-                     nsamp = nsamp, nfft = ri.nfft, wavenorm = ri.wavenorm, t0 = time.time(), fs = ri.fs, sweep_index=sweep_index)
-            block.progress = (k+1)/float(nstep)
-            data.add_block(block)
-            if callback:
-                abort = callback(block)
-
-        if abort:
-            break
-        
-    return data
+    steps,seconds = plan_sweep(ri,nchan_per_step=nchan_per_step,reads_per_step=reads_per_step,banks=[0])
+    return run_sweep(ri,steps,reads_per_step=reads_per_step,sweep_data=data,callback=callback)
 
 def reduce_catcher(din):
     chandata = {}
@@ -0,0 +1,114 @@
+import numpy as np
+
+from kid_readout.utils import demodulation, roach_interface
+
+def make_baseband(nfft=2**11,nsamp=2**16,ntones=6,nbanks=2):
+    ri = roach_interface.RoachBaseband.__new__(roach_interface.RoachBaseband)
+    ri.nfft = nfft
+    ri.tone_nsamp = nsamp
+    ri.tone_bins = np.random.randint(1,nsamp/2,size=(nbanks,ntones))
+    ri.fft_bins = ri.calc_fft_bins(ri.tone_bins,nsamp)
+    ri.phases = np.random.uniform(0,2*np.pi,ntones)
+    ri.bank = nbanks-1
+    ri.readout_selection = np.array([4,0,2,5])
+    ri._window_mag = roach_interface.compute_window(npfb=2*nfft,taps=2)
+    return ri
+
+def reference_demodulate(ri,data):
+    """
+    The original per channel baseband demodulation loop
+    """
+    bank = ri.bank
+    demod = np.zeros_like(data)
+    t = np.arange(data.shape[0])
+    for n,ich in enumerate(ri.readout_selection):
+        phi0 = ri.phases[ich]
+        k = ri.tone_bins[bank,ich]
+        m = ri.fft_bins[bank,ich]
+        if m >= ri.nfft/2:
+            sign = 1.0
+        else:
+            sign = -1.0
+        foffs = (2*k*ri.nfft - m*ri.tone_nsamp)/float(ri.tone_nsamp)
+        wc = ri._window_response(foffs/2.0)*(ri.tone_nsamp/2.0**18)
+        demod[:,n] = wc*np.exp(sign*1j*(2*np.pi*foffs*t + phi0)) * data[:,n]
+        if m >= ri.nfft/2:
+            demod[:,n] = np.conjugate(demod[:,n])
+    return demod
+
+def random_data(nsamples,nchan):
+    return (np.random.randn(nsamples,nchan) + 1j*np.random.randn(nsamples,nchan))*1000
+
+def test_matches_reference():
+    ri = make_baseband()
+    # make sure both halves of the spectrum are exercised
+    ri.fft_bins[ri.bank,ri.readout_selection[:2]] = [10,ri.nfft-10]
+    data = random_data(3*demodulation.block_rows/2,4)
+    demod = ri.demodulate_data(data)
+    assert demod.dtype == np.complex64
+    assert np.allclose(demod,reference_demodulate(ri,data),rtol=1e-5,atol=1e-2)
+
+def test_chunks_and_inplace():
+    ri = make_baseband()
+    data = random_data(1000,4).astype('complex64')
+    whole = ri.demodulate_data(data)
+    first = ri.demodulate_data(data[:300].copy(),inplace=True)
+    second = data[300:].copy()
+    result = ri.demodulate_data(second,t0=300,inplace=True)
+    assert result is second
+    assert np.allclose(np.concatenate((first,second)),whole,rtol=1e-5,atol=1e-2)
+
+def test_phasor_cache():
+    ri = make_baseband()
+    data = random_data(1000,4)
+    cache = demodulation.phasor_cache
+    max_bytes = cache.max_bytes
+    cache.clear()
+    try:
+        cache.max_bytes = 0
+        uncached = ri.demodulate_data(data[200:],t0=200)
+        cache.max_bytes = max_bytes
+        first = ri.demodulate_data(data[:800])
+        hits = cache.hits
+        misses = cache.misses
+        # the table includes the starting phase, so repeating a demodulation reuses it
+        again = ri.demodulate_data(data[:800])
+        assert cache.hits == hits + 1
+        assert np.all(again == first)
+        second = ri.demodulate_data(data[200:],t0=200)
+        assert cache.misses == misses + 1
+        assert np.allclose(second,uncached,rtol=1e-5,atol=1e-2)
+        assert np.allclose(first[200:],reference_demodulate(ri,data)[200:800],rtol=1e-5,atol=1e-2)
+        cache.max_bytes = 2*800*4*8
+        ri.phases = ri.phases + 1
+        ri.demodulate_data(data[:800])
+        ri.demodulate_data(data[:900])
+        assert cache.evictions > 0
+        assert cache.nbytes <= cache.max_bytes
+    finally:
+        cache.max_bytes = max_bytes
+        cache.clear()
+
+def test_streaming_demodulator():
+    ri = make_baseband()
+    data = random_data(5000,4)
+    whole = reference_demodulate(ri,data)
+    cache = demodulation.phasor_cache
+    max_bytes = cache.max_bytes
+    try:
+        for cache.max_bytes in [max_bytes,0]:
+            demodulator = ri.get_demodulator()
+            demodulator.renormalize_every = 3
+            bounds = np.concatenate(([0],np.sort(np.random.randint(0,5000,size=20)),[5000]))
+            chunks = [demodulator.demodulate(data[a:b]) for a,b in zip(bounds[:-1],bounds[1:])]
+            assert demodulator.sample == 5000
+            assert np.allclose(np.concatenate(chunks),whole,rtol=1e-5,atol=1e-2)
+    finally:
+        cache.max_bytes = max_bytes
+        cache.clear()
+
+if __name__ == "__main__":
+    test_matches_reference()
+    test_chunks_and_inplace()
+    test_phasor_cache()
+    test_streaming_demodulator()
@@ -0,0 +1,161 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+from kid_readout.utils import dram_upload, roach_interface
+from kid_readout.utils.mock_roach import MockFpgaClient, MockValon
+
+helper_source = os.path.join(os.path.dirname(__file__),'..','..','..','ppc','dram_loader.c')
+
+def build_helper(tmpdir):
+    """
+    Build the upload helper for this machine, returning None if there is no compiler
+    """
+    helper = os.path.join(tmpdir,'dram_loader')
+    try:
+        subprocess.check_call(['cc','-O2','-o',helper,helper_source])
+    except (OSError,subprocess.CalledProcessError):
+        return None
+    return helper
+
+def test_channel():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        helper = build_helper(tmpdir)
+        if helper is None:
+            print "no C compiler, skipping"
+            return
+        dram = os.path.join(tmpdir,'dram_memory')
+        np.zeros((2**21,),dtype=np.uint8).tofile(dram)
+        channel = dram_upload.DramChannel([helper,dram])
+        data = np.arange(2**19,dtype='>i2')
+        channel.write(0,data)
+        channel.write(2**20+6,data[:1000])
+        assert channel.bytes == data.nbytes + 2000
+        assert channel.rate > 0
+        channel.close()
+        assert not channel.alive()
+        result = np.fromfile(dram,dtype=np.uint8)
+        assert np.all(result[:2**20].view('>i2') == data)
+        assert np.all(result[2**20+6:2**20+2006].view('>i2') == data[:1000])
+        # a write the helper cannot complete is reported
+        channel = dram_upload.DramChannel([helper,os.path.join(tmpdir,'missing','dram_memory')])
+        try:
+            channel.write(0,data[:10])
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("failed write was not reported")
+        channel.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_readout_upload():
+    tmpdir = tempfile.mkdtemp()
+    config_file = roach_interface.CONFIG_FILE_NAME
+    roach_interface.CONFIG_FILE_NAME = os.path.join(tmpdir,'roach_config.npz')
+    try:
+        helper = build_helper(tmpdir)
+        if helper is None:
+            print "no C compiler, skipping"
+            return
+        dram = os.path.join(tmpdir,'dram_memory')
+        np.zeros((2**20,),dtype=np.uint8).tofile(dram)
+        ri = roach_interface.RoachBaseband(roach=MockFpgaClient(boffile='test.bof'),adc_valon=MockValon(),
+                                           initialize=False)
+        ri._dram_channel = dram_upload.DramChannel([helper,dram],bof_pid=ri.bof_pid)
+        wave = np.arange(2**16).astype('>i2')
+        ri.load_waveform(wave)
+        result = np.fromfile(dram,dtype='>i2')
+        assert np.all(result[0:2**17:4] == wave[::2])
+        assert np.all(result[1:2**17:4] == wave[1::2])
+        assert ri.get_timing()['dram_channel_bytes'] == 2*wave.nbytes
+        # the same channel is used for the next load
+        channel = ri._dram_channel
+        ri.load_waveform(wave)
+        assert ri._dram_channel is channel
+        channel.close()
+    finally:
+        roach_interface.CONFIG_FILE_NAME = config_file
+        shutil.rmtree(tmpdir)
+
+def test_dram_image():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        image = dram_upload.DramImage(2**12,directory=tmpdir)
+        wave = np.round(np.linspace(-1000,1000,2**11))
+        image.place(1,0,wave[:1024])
+        image.place(1,1024,wave[1024:])
+        assert image.data.dtype == np.dtype('>i2')
+        assert np.all(image.data[2::4] == wave[::2])
+        assert np.all(image.data[3::4] == wave[1::2])
+        assert np.all(image.data[0::4] == 0)
+        assert np.all(image.extract(1) == wave)
+        assert image.offset_of(image.data[1024:2048]) == 2048
+        assert image.offset_of(np.zeros(10,dtype='>i2')) is None
+        image.release()
+        assert not os.path.exists(image.path)
+        assert np.all(image.extract(1) == wave)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_ssh_reads_staged_image():
+    tmpdir = tempfile.mkdtemp()
+    config_file = roach_interface.CONFIG_FILE_NAME
+    roach_interface.CONFIG_FILE_NAME = os.path.join(tmpdir,'roach_config.npz')
+    check_output = roach_interface.borph_utils.check_output
+    commands = []
+    roach_interface.borph_utils.check_output = lambda command,shell=False: commands.append(command) or ''
+    try:
+        os.mkdir(os.path.join(tmpdir,'boffiles'))
+        ri = roach_interface.RoachBaseband(roach=MockFpgaClient(boffile='test.bof'),adc_valon=MockValon(),
+                                           initialize=False)
+        ri.bof_pid = 1234
+        ri.dram_upload_method = 'ssh'
+        ri.roach_root = tmpdir
+        wave = np.arange(2**16).astype('>i2')
+        image = ri.load_waveform(wave)
+        # dd reads the staging file, which is deleted afterwards, rather than a copy of the data
+        assert len(commands) == 1
+        assert ('skip=0 count=%d if=/boffiles/%s' % (2*wave.nbytes/512,os.path.basename(image.path))) in commands[0]
+        assert os.listdir(os.path.join(tmpdir,'boffiles')) == []
+        assert np.all(image.extract(0) == wave)
+    finally:
+        roach_interface.borph_utils.check_output = check_output
+        roach_interface.CONFIG_FILE_NAME = config_file
+        shutil.rmtree(tmpdir)
+
+def test_channel_falls_back_to_ssh():
+    tmpdir = tempfile.mkdtemp()
+    config_file = roach_interface.CONFIG_FILE_NAME
+    roach_interface.CONFIG_FILE_NAME = os.path.join(tmpdir,'roach_config.npz')
+    check_output = roach_interface.borph_utils.check_output
+    commands = []
+    roach_interface.borph_utils.check_output = lambda command,shell=False: commands.append(command) or ''
+    try:
+        os.mkdir(os.path.join(tmpdir,'boffiles'))
+        ri = roach_interface.RoachBaseband(roach=MockFpgaClient(boffile='test.bof'),adc_valon=MockValon(),
+                                           initialize=False)
+        ri.bof_pid = 1234
+        ri.roach_root = tmpdir
+        # a helper which exits at once, as when it is missing on the ROACH
+        ri._get_dram_channel = lambda: dram_upload.DramChannel(['false'])
+        assert ri.dram_upload_method == 'channel'
+        ri.load_waveform(np.arange(2**16).astype('>i2'))
+        assert ri.dram_upload_method == 'ssh'
+        assert len(commands) == 1 and 'dd seek=0' in commands[0]
+        assert ri.timers.as_dict()['dram_channel_fallback'] == 1
+    finally:
+        roach_interface.borph_utils.check_output = check_output
+        roach_interface.CONFIG_FILE_NAME = config_file
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_channel()
+    test_readout_upload()
+    test_dram_image()
+    test_ssh_reads_staged_image()
+    test_channel_falls_back_to_ssh()
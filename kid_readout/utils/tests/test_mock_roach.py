@@ -0,0 +1,381 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from kid_readout.utils import roach_interface, waveform_cache, sweeps
+from kid_readout.utils.mock_roach import MockFpgaClient, MockValon, frame_samples
+
+def make_readout():
+    r = MockFpgaClient(boffile='test.bof',seed=0)
+    ri = roach_interface.RoachBaseband(roach=r,adc_valon=MockValon(),initialize=False)
+    return ri,r
+
+def with_config_dir(func):
+    """
+    Run *func* with the readout state file in a temporary directory
+    """
+    def wrapper():
+        tmpdir = tempfile.mkdtemp()
+        config_file = roach_interface.CONFIG_FILE_NAME
+        roach_interface.CONFIG_FILE_NAME = os.path.join(tmpdir,'roach_config.npz')
+        try:
+            func()
+        finally:
+            roach_interface.CONFIG_FILE_NAME = config_file
+            shutil.rmtree(tmpdir)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+@with_config_dir
+def test_tones_and_katcp_readout():
+    ri,r = make_readout()
+    ri.set_tone_bins(np.array([1000,3000,5000,7000]),2**16,load=False)
+    ri.fft_bins = ri.calc_fft_bins(ri.tone_bins,2**16)
+    ri.select_bank(0)
+    ri.select_fft_bins(range(4))
+    assert r.read_int('dram_mask') == 2**15 - 1
+    data,addrs = ri.get_data_katcp(nread=4,demod=False)
+    assert data.shape == (4*frame_samples/4,4)
+    assert data.dtype == np.complex64
+    # the frame number is in the imaginary part and increases by one per frame
+    frames = data.imag.reshape((4,-1))
+    assert np.all(np.diff(frames[:,0]) == 1)
+    assert np.all(frames == frames[:,:1])
+    demod,addrs = ri.get_data_katcp(nread=2)
+    assert demod.shape == (2*frame_samples/4,4)
+
+@with_config_dir
+def test_dram_and_attenuator():
+    ri,r = make_readout()
+    wave = np.arange(2**12).astype('>i2')
+    ri.load_waveform(wave,fast=False)
+    dram = r.read_dram_bank(0,2*wave.nbytes).view('>i2')
+    assert np.all(dram[0::4] == wave[::2])
+    assert np.all(dram[1::4] == wave[1::2])
+    nwrites = r.calls['write_int']
+    ri.set_dac_attenuator(10.5)
+    assert ri.dac_atten == 10.5
+    # 42 writes without the register shadow
+    assert r.calls['write_int'] - nwrites == 34
+    counts = ri.r.operations['set_dac_attenuator']
+    assert counts.round_trips == 34
+    assert counts.elided == 8
+    # setting the same attenuation again needs no writes at all
+    ri.set_dac_attenuator(10.5)
+    assert r.calls['write_int'] - nwrites == 34
+    assert counts.calls == 2
+
+@with_config_dir
+def test_sync_and_reprogram():
+    ri,r = make_readout()
+    ri._sync()
+    ri._sync()
+    # the register is already 0 at the start of the second pulse
+    assert r.calls['write_int'] == 5
+    assert ri.r.read_uint('sync') == 0
+    ri.r.progdev('test.bof')
+    assert ri.r.shadow == {}
+    ri._sync()
+    assert r.calls['write_int'] == 8
+    # readouts sharing a client share its shadow
+    ri2 = roach_interface.RoachBaseband(roach=r,adc_valon=MockValon(),wafer=1,initialize=False)
+    assert ri2.r is ri.r
+
+@with_config_dir
+def test_timing():
+    ri,r = make_readout()
+    ri.set_tone_bins(np.array([1000,3000]),2**16,load=False)
+    ri.load_waveform(ri.qwave,fast=False)
+    ri.fft_bins = ri.calc_fft_bins(ri.tone_bins,2**16)
+    ri.select_bank(0)
+    ri.select_fft_bins(range(2))
+    ri.get_data_katcp(nread=2)
+    timing = ri.get_timing()
+    for name in ['waveform_synthesis','dram_load','bram_read','demodulate','katcp_read','katcp_write_int',
+                 'katcp_write_dram']:
+        assert timing[name + '_calls'] >= 1
+        assert timing[name + '_seconds'] >= timing[name + '_max_seconds'] >= 0
+    assert timing['dram_load_bytes'] == 2*ri.qwave.nbytes
+    # one capture of two frames, each frame read from a BRAM with one katcp read request
+    assert timing['bram_read_calls'] == 1
+    assert timing['bram_frames'] == 2
+    assert timing['katcp_read_calls'] == r.calls['read'] > 1
+    assert timing['katcp_write_int_calls'] == r.calls['write_int']
+    ri.reset_timing()
+    assert ri.get_timing() == {}
+
+@with_config_dir
+def test_waveform_cache():
+    ri,r = make_readout()
+    ri._load_dram_channel = ri._load_dram_katcp
+    cache = waveform_cache.cache
+    assert cache.directory is None
+    waveform_cache.configure(os.path.join(os.path.dirname(roach_interface.CONFIG_FILE_NAME),'waveforms'))
+    try:
+        bins = np.array([[1000,3000],[1010,3010]])
+        ri.set_tone_bins(bins.copy(),2**16,phase_seed=5)
+        qwave,phases = ri.qwave.copy(),ri.phases.copy()
+        assert r.calls['write_dram'] == 1
+        # unseeded phases bypass the cache and always load
+        ri.set_tone_bins(bins.copy(),2**16)
+        assert r.calls['write_dram'] == 2
+        assert ri.get_timing().get('waveform_cache_hits',0) == 0
+        # the same configuration again comes from disk, and is loaded since the DRAM changed
+        ri.set_tone_bins(bins.copy(),2**16,phase_seed=5)
+        assert np.all(ri.qwave == qwave)
+        assert np.all(ri.phases == phases)
+        assert r.calls['write_dram'] == 3
+        # now it is resident, so nothing is loaded
+        ri.set_tone_bins(bins.copy(),2**16,phase_seed=5)
+        assert r.calls['write_dram'] == 3
+        timing = ri.get_timing()
+        assert timing['waveform_cache_hits'] == 2
+        assert timing['dram_load_skipped'] == 1
+        # a different seed is a different waveform
+        ri.set_tone_bins(bins.copy(),2**16,phase_seed=6)
+        assert not np.all(ri.phases == phases)
+        assert r.calls['write_dram'] == 4
+        # reprogramming forgets what is in the DRAM
+        ri.r.progdev('test.bof')
+        ri.set_tone_bins(bins.copy(),2**16,phase_seed=6)
+        assert r.calls['write_dram'] == 5
+        cache.max_bytes = ri.qwave.nbytes + 4096 # allow for the .npy header
+        cache.evict()
+        assert len([name for name in os.listdir(cache.directory) if name.endswith('.npy')]) == 1
+    finally:
+        waveform_cache.configure(None)
+
+def reference_waveform(bins,nsamp,phases):
+    spec = np.zeros((bins.shape[0],nsamp/2+1),dtype='complex')
+    for k in range(bins.shape[0]):
+        spec[k,bins[k,:]] = np.exp(1j*phases)
+    wave = np.fft.irfft(spec,axis=1)
+    return np.round((wave/np.abs(wave).max())*(2**15-1024)).astype('>i2').flatten()
+
+@with_config_dir
+def test_streaming_synthesis():
+    ri,r = make_readout()
+    ri._load_dram_channel = ri._load_dram_katcp
+    bins = np.array([[1000,3000,5000],[1010,3010,5010],[1020,3020,5020]])
+    ri.set_tone_bins(bins.copy(),2**16,load=False)
+    assert np.all(ri.qwave == reference_waveform(bins,2**16,ri.phases))
+    # 17 banks of 2**20 samples span two 64 MB DRAM banks
+    nsamp = 2**20
+    bins = 1000 + np.arange(17)[:,None] + np.array([0,5000])[None,:]
+    ri.set_tone_bins(bins,nsamp)
+    image = ri.qwave.shape[0]*4
+    dram = np.concatenate((r.read_dram_bank(0,64*2**20),r.read_dram_bank(1,image-64*2**20))).view('>i2')
+    assert np.all(dram[0::4] == ri.qwave[0::2])
+    assert np.all(dram[1::4] == ri.qwave[1::2])
+    assert r.calls['write_dram'] == 2
+
+@with_config_dir
+def test_optimized_phases():
+    ri,r = make_readout()
+    bins = np.array([[1000,3000,5000,7000],[1010,3010,5010,7010]])
+    ri.set_tone_bins(bins.copy(),2**16,load=False,optimize_phases=True)
+    reference = reference_waveform(bins,2**16,ri.phases)
+    assert np.all(np.abs(ri.qwave.astype(int)-reference) <= 1)
+    wavenorm = ri.wavenorm
+    ri.set_tone_bins(bins.copy(),2**16,load=False,phase_seed=0)
+    assert ri.wavenorm > wavenorm
+
+@with_config_dir
+def test_tone_bank_allocation():
+    ri,r = make_readout()
+    ri._load_dram_channel = ri._load_dram_katcp
+    nsamp = 2**16
+    bins = np.array([[1000,3000],[1010,3010]])
+    ri.set_tone_bins(bins.copy(),nsamp)
+    def dram_bank(bank):
+        return r.read_dram_bank(0,4*nsamp,offset=4*nsamp*bank).view('>i2')[0::4]
+    def expected(bank):
+        # added banks take the wavenorm of the waveform set by set_tone_bins
+        spec = np.zeros((nsamp/2+1,),dtype='complex')
+        spec[ri.tone_bins[bank]] = np.exp(1j*ri.phases)
+        wave = np.fft.irfft(spec)
+        return np.round((wave/ri.wavenorm)*(2**15-1024)).astype('>i2')[::2]
+    before = [dram_bank(k).copy() for k in range(2)]
+    nwrites = r.calls['write_dram']
+    assert ri.add_tone_bins(np.array([1020,3020])) == 2
+    assert ri.tone_bins.shape == (3,2)
+    assert np.all(dram_bank(2) == expected(2))
+    # the same tones again leave the bank alone
+    assert ri.add_tone_bins(np.array([1020,3020]),bank=2) == 2
+    assert r.calls['write_dram'] == nwrites + 1
+    # replacing a bank loads only that bank
+    assert ri.add_tone_bins(np.array([1030,3030]),bank=1) == 1
+    assert r.calls['write_dram'] == nwrites + 2
+    assert np.all(dram_bank(0) == before[0])
+    assert not np.all(dram_bank(1) == before[1])
+    assert np.all(dram_bank(1) == expected(1))
+    assert np.all(ri.tone_bins[1] == [1030,3030])
+    # freed banks are reused before new ones are added
+    ri.free_tone_bank(0)
+    assert ri.add_tone_bins(np.array([1040,3040])) == 0
+    assert ri.add_tone_bins(np.array([1050,3050])) == 3
+    assert np.all(dram_bank(3) == expected(3))
+    ri.dram_bytes = 4*4*nsamp
+    try:
+        ri.set_tone_bins(bins.copy(),nsamp,load=False)
+        ri.add_tone_bins(np.array([1020,3020]))
+        ri.add_tone_bins(np.array([1030,3030]))
+        ri.add_tone_bins(np.array([1040,3040]))
+    except ValueError:
+        assert ri.tone_bins.shape[0] == 4
+    else:
+        raise AssertionError("adding more banks than fit in the DRAM should fail")
+
+@with_config_dir
+def test_pipelined_sweep():
+    ri,r = make_readout()
+    ri.get_data = ri.get_data_katcp
+    bins = 1000 + 2000*np.arange(8)[None,:] + 10*np.arange(2)[:,None]
+    ri.set_tone_bins(bins,2**16,load=False,phase_seed=0)
+    ri.fft_bins = ri.calc_fft_bins(ri.tone_bins,2**16)
+    sweeps.settle_times[ri.boffile] = 0
+    try:
+        selected = []
+        select_bank = ri.select_bank
+        ri.select_bank = lambda bank: selected.append(bank) or select_bank(bank)
+        swp = sweeps.do_prepared_sweep(ri,nchan_per_step=4,reads_per_step=2)
+        # the bank is selected when the sweep reaches it, not at every step
+        assert selected == [0,1]
+        assert len(swp.blocks) == 16
+        assert len(swp.step_timing) == 4
+        summary = sweeps.sweep_timing_summary(swp)
+        assert summary['steps'] == 4
+        assert 0 < summary['capture_fraction'] <= 100
+        assert sorted(set(swp.sweep_indexes)) == range(8)
+        # processing on the worker gives the same blocks as processing in line, given the same data
+        captured = {}
+        def get_data(nread,demod=True):
+            key = (ri.bank,tuple(ri.readout_selection))
+            if key not in captured:
+                captured[key] = ri.get_data_katcp(nread,demod=demod)
+            data,addr = captured[key]
+            return data.copy(),addr
+        ri.get_data = get_data
+        ri.select_bank(0)
+        serial = sweeps.run_sweep(ri,[(0,[0,1,2,3]),(1,[0,1,2,3])],pipeline=False)
+        piped = sweeps.run_sweep(ri,[(0,[0,1,2,3]),(1,[0,1,2,3])])
+        assert np.all(serial.freqs == piped.freqs)
+        assert np.allclose(serial.data,piped.data)
+        # a callback returning True stops the sweep
+        swp = sweeps.run_sweep(ri,[(0,[0,1]),(0,[2,3]),(1,[0,1]),(1,[2,3])],callback=lambda block: True)
+        assert len(swp.step_timing) < 4
+    finally:
+        del sweeps.settle_times[ri.boffile]
+
+@with_config_dir
+def test_settle_times_saved():
+    ri,r = make_readout()
+    assert sweeps.settle_time(ri) == sweeps.default_settle_time
+    sweeps.save_settle_time(ri.boffile,0.03)
+    try:
+        # a later session finds the measurement in the file
+        del sweeps.settle_times[ri.boffile]
+        assert sweeps.settle_time(ri) == 0.03
+    finally:
+        sweeps.settle_times.pop(ri.boffile,None)
+
+def test_channel_group_plan():
+    def check(indexes,groups):
+        indexes = np.atleast_2d(indexes)
+        assert sorted(sum(groups,[])) == range(indexes.shape[1])
+        for group in groups:
+            assert len(group) & (len(group)-1) == 0
+            for bank in indexes:
+                assert len(set(bank[group])) == len(group)
+    indexes = np.arange(10)*100 + 3
+    groups = sweeps.plan_channel_groups(indexes,nchan_per_step=4)
+    check(indexes,groups)
+    assert sorted([len(group) for group in groups]) == [2,4,4]
+    # limited by the stream, and rounded down to a power of two
+    groups = sweeps.plan_channel_groups(indexes,nchan_per_step=16,max_channels=6)
+    check(indexes,groups)
+    assert sorted([len(group) for group in groups]) == [2,4,4]
+    groups = sweeps.plan_channel_groups(np.arange(384),nchan_per_step=16)
+    assert len(groups) == 24
+    # three channels share an index in the second bank, so need three groups
+    indexes = np.vstack((np.arange(8),[0,0,0,3,4,5,6,7]))
+    groups = sweeps.plan_channel_groups(indexes,nchan_per_step=8)
+    check(indexes,groups)
+    assert len(groups) == 3
+
+@with_config_dir
+def test_plan_sweep():
+    ri,r = make_readout()
+    bins = 1000 + 2000*np.arange(10)[None,:] + 10*np.arange(3)[:,None]
+    ri.set_tone_bins(bins,2**16,load=False,phase_seed=0)
+    ri.fft_bins = ri.calc_fft_bins(ri.tone_bins,2**16)
+    steps,seconds = sweeps.plan_sweep(ri,nchan_per_step=4,reads_per_step=2,settle=0.1,select_seconds=0)
+    assert len(steps) == 9
+    assert [bank for bank,selection in steps] == [0,0,0,1,1,1,2,2,2]
+    # each read is 16 packets per channel, 4096 samples of every channel of the group
+    read_seconds = 16*256/(ri.fs*1e6/(2*ri.nfft))
+    assert np.allclose(seconds,9*(0.1 + 2*read_seconds))
+    # groups of 8 and 2 take two steps per bank instead of three
+    steps,fewer_seconds = sweeps.plan_sweep(ri,nchan_per_step=8,reads_per_step=2,settle=0.1,select_seconds=0)
+    assert len(steps) == 6
+    assert np.allclose(fewer_seconds,6*(0.1 + 2*read_seconds))
+
+def slow_items(n,delay,fail_at=None):
+    for k in range(n):
+        time.sleep(delay)
+        if k == fail_at:
+            raise ValueError("failed at %d" % k)
+        yield k
+
+def test_prefetch():
+    tic = time.time()
+    items = []
+    for item,produce_time in roach_interface.prefetch(slow_items(4,0.1)):
+        time.sleep(0.1)
+        items.append(item)
+        assert produce_time >= 0.09
+    assert items == range(4)
+    # producing overlaps consuming, 0.5 s rather than 0.8 s
+    assert time.time() - tic < 0.7
+    try:
+        for item,produce_time in roach_interface.prefetch(slow_items(4,0.01,fail_at=2)):
+            pass
+    except ValueError:
+        assert item == 1
+    else:
+        raise AssertionError("exception in the producer was not raised")
+    # stopping early stops the worker
+    items = roach_interface.prefetch(slow_items(100,0.01))
+    items.next()
+    items.close()
+
+def test_unprogrammed():
+    r = MockFpgaClient()
+    try:
+        r.write_int('sync',1)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("writing to an unprogrammed FPGA should fail")
+    r.progdev('test.bof')
+    r.write_int('sync',1)
+    assert r.read_uint('sync') == 1
+
+if __name__ == "__main__":
+    test_tones_and_katcp_readout()
+    test_dram_and_attenuator()
+    test_sync_and_reprogram()
+    test_timing()
+    test_waveform_cache()
+    test_streaming_synthesis()
+    test_optimized_phases()
+    test_tone_bank_allocation()
+    test_pipelined_sweep()
+    test_settle_times_saved()
+    test_channel_group_plan()
+    test_plan_sweep()
+    test_prefetch()
+    test_unprogrammed()
@@ -0,0 +1,47 @@
+import numpy as np
+
+from kid_readout.utils import phase_optimizer
+
+def test_optimize_phases():
+    nsamp = 2**16
+    bins = np.random.RandomState(0).permutation(np.arange(100,nsamp/2-100))[:200]
+    random_crest = phase_optimizer.crest_factor(bins,nsamp,np.random.RandomState(1).random_sample(200)*2*np.pi)
+    phases,crest = phase_optimizer.optimize_phases(bins,nsamp,cache=False)
+    assert phases.shape == (200,)
+    assert np.allclose(crest,phase_optimizer.crest_factor(bins,nsamp,phases))
+    assert crest < 0.8*random_crest
+    # tones on a regular grid start from the Newman phases, which are already good
+    grid = 500 + 37*np.arange(200)
+    newman = phase_optimizer.crest_factor(grid,nsamp,phase_optimizer.newman_phases(grid))
+    assert newman < 2.0
+    assert phase_optimizer.optimize_phases(grid,nsamp,cache=False)[1] <= newman
+
+def test_banks_in_chunks():
+    # a prepared sweep: the same tones offset in each bank, optimized one bank at a time
+    nsamp = 2**14
+    bins = np.random.RandomState(2).permutation(np.arange(100,nsamp/2-100,8))[:60]
+    bins = bins[None,:] + np.arange(6)[:,None]
+    random_crest = phase_optimizer.crest_factor(bins,nsamp,np.random.RandomState(3).random_sample(60)*2*np.pi)
+    for banks_per_chunk in [1,4,6]:
+        phases,crest = phase_optimizer.optimize_phases(bins,nsamp,cache=False,banks_per_chunk=banks_per_chunk)
+        # the crest factor is the one of the worst bank, so the norm derived from it never clips
+        assert np.allclose(crest,phase_optimizer.crest_factor(bins,nsamp,phases))
+        assert crest < 0.8*random_crest
+
+def test_phase_cache():
+    cache = phase_optimizer.phase_cache
+    cache.clear()
+    bins = np.array([[1000,3000,5000],[1010,3010,5010]])
+    phases,crest = phase_optimizer.optimize_phases(bins,2**14,amps=np.array([1.0,0.5,1.0]))
+    hits = cache.hits
+    again,crest_again = phase_optimizer.optimize_phases(bins,2**14,amps=np.array([1.0,0.5,1.0]))
+    assert cache.hits == hits + 1
+    assert np.all(again == phases) and crest_again == crest
+    # other amplitudes are another entry
+    phase_optimizer.optimize_phases(bins,2**14)
+    assert cache.hits == hits + 1
+
+if __name__ == "__main__":
+    test_optimize_phases()
+    test_banks_in_chunks()
+    test_phase_cache()
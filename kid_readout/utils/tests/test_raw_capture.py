@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from kid_readout.utils import raw_capture, roach_interface
+from kid_readout.utils.udp_emulator import RoachUdpEmulator
+from kid_readout.utils.tests.test_udp_emulator import EmulatedRoach
+
+class EmulatedBaseband(EmulatedRoach):
+    """
+    Readout state of a RoachBaseband with 4 tones, plus the emulated stream register
+    """
+    def __init__(self,emulator):
+        EmulatedRoach.__init__(self,emulator)
+        self.nfft = 2**11
+        self.tone_nsamp = 2**16
+        self.fs = 512.0
+        self.wavenorm = 1.0
+        self.wafer = 0
+        self.bank = 0
+        self.tone_bins = np.array([[1001,2023,40007,61001]])
+        self.phases = np.random.uniform(0,2*np.pi,4)
+        self.fft_bins = np.round(self.tone_bins*self.nfft/float(self.tone_nsamp)).astype('int') % self.nfft
+        self.readout_selection = np.arange(4)
+        self.fpga_fft_readout_indexes = self.fft_bins[0] // 2
+        self._window_mag = roach_interface.compute_window(npfb=2*self.nfft,taps=2)
+    __class__ = roach_interface.RoachBaseband
+
+def test_capture_and_decode():
+    addr = ('127.0.0.1',23458)
+    emulator = RoachUdpEmulator(np.arange(4),2**11,addr=addr,mcnt0=2**32-5*2**11*2**10,packet_rate=5000)
+    ri = EmulatedBaseband(emulator)
+    emulator.chans = ri.fpga_fft_readout_indexes + 1
+    tmpdir = tempfile.mkdtemp()
+    try:
+        basename = os.path.join(tmpdir,'capture')
+        emulator.start()
+        try:
+            nrecv = raw_capture.capture_raw(ri,basename,nread=8,addr=addr)
+        finally:
+            emulator.stop()
+        assert nrecv == 8*16*4
+        capture = raw_capture.RawCapture(basename)
+        assert np.all(capture.config['tone_bins'] == ri.tone_bins)
+        assert np.all(capture.config['phases'] == ri.phases)
+        # chunks which do not line up with the 4096 sample frames must still give a contiguous result
+        data,health = capture.decode(demod=False,chunk_packets=37)
+        whole,whole_health = capture.decode(demod=False,chunk_packets=nrecv)
+        assert np.all(data == whole)
+        assert health.as_dict() == whole_health.as_dict()
+        assert np.all(health.gap_positions == whole_health.gap_positions)
+        assert health.mcnt_overflows == 1
+        if health.ok:
+            assert data.shape == (nrecv*256/4,4)
+            assert np.all(data[:,0].real == (data[0,0].real + np.arange(data.shape[0])) % 2**14)
+        demod,health = capture.decode(demod=True,chunk_packets=37)
+        readout = capture.get_readout()
+        assert isinstance(readout,roach_interface.RoachBaseband)
+        assert np.allclose(demod,readout.demodulate_data(whole),rtol=1e-4,atol=1e-3)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    test_capture_and_decode()
@@ -0,0 +1,128 @@
+import struct
+
+import numpy as np
+
+import kid_readout.utils.udp_catcher as udp_catcher
+
+def make_packets(nchunks,chans,nfft,streamid=1,mcnt0=0,drop=(),swap=()):
+    """
+    Build a list of packet strings in the format sent by ppc/kid_ppc.c
+    """
+    nchan = chans.shape[0]
+    mcnt_inc = nfft*2**12/nchan
+    pkts = []
+    for chunk in range(nchunks):
+        mcnt = (mcnt0 + chunk*mcnt_inc) % 2**32
+        for idx in range(16):
+            payload = np.random.random_integers(-2**15,2**15-1,512).astype('>i2').tostring()
+            pkts.append(struct.pack(udp_catcher.hdr_fmt,0,idx,streamid,chans[-1],mcnt) + payload)
+    for a,b in swap:
+        pkts[a],pkts[b] = pkts[b],pkts[a]
+    return [pkt for n,pkt in enumerate(pkts) if n not in drop]
+
+def reference_decode(plist,streamid,chans,nfft,pkts_per_chunk=16):
+    """
+    The original packet-by-packet decoder, without the diagnostic prints
+    """
+    nchan = chans.shape[0]
+    mcnt_inc = nfft*2**12/nchan
+    next_seqno = None
+    mcnt_top = 0
+    dset = []
+    mcntoff = None
+    last_mcnt_ovf = None
+    seqnos = []
+    chan0 = None
+    for pnum,pkt in enumerate(plist):
+        if len(pkt) != udp_catcher.pkt_size:
+            continue
+        pidle,pidx,pstream,pchan,pmcnt = struct.unpack(udp_catcher.hdr_fmt,pkt[:udp_catcher.hdr_size])
+        if pstream != streamid:
+            continue
+        if next_seqno is None:
+            mcnt_top = 0
+            last_mcnt_ovf = pmcnt
+        else:
+            if pmcnt < mcnt_inc:
+                if last_mcnt_ovf != pmcnt:
+                    mcnt_top += 2**32
+                    last_mcnt_ovf = pmcnt
+            else:
+                last_mcnt_ovf = None
+        chunkno,pmcntoff = divmod(pmcnt+mcnt_top,mcnt_inc)
+        seqno = (chunkno)*pkts_per_chunk + pidx
+        seqnos.append(seqno)
+        if next_seqno is None:
+            chan0 = pchan
+            next_seqno = seqno
+            mcntoff = pmcntoff
+        if mcntoff != pmcntoff:
+            continue
+        if seqno - next_seqno < 0:
+            continue
+        if seqno == next_seqno:
+            dset.append(pkt[udp_catcher.hdr_size:])
+            next_seqno += 1
+        else:
+            for k in range(seqno - next_seqno+1):
+                dset.append("\x00"*1024)
+                next_seqno += 1
+    dset = ''.join(dset)
+    ns = (len(dset)//(4*nchan))
+    dset = dset[:ns*(4*nchan)]
+    darray = np.fromstring(dset,dtype='>i2').astype('float32').view('complex64')
+    darray.shape = (ns,nchan)
+    shift = np.flatnonzero(chans==(chan0))[0] - (nchan-1)
+    darray = np.roll(darray,shift,axis=1)
+    return darray,np.array(seqnos)
+
+def check_agreement(plist,chans,nfft):
+    darray,seqnos = udp_catcher.decode_packets(plist,1,chans,nfft,capture_failures=False)
+    ref_darray,ref_seqnos = reference_decode(plist,1,chans,nfft)
+    assert darray.dtype == np.complex64
+    assert darray.shape == ref_darray.shape
+    assert np.all(darray == ref_darray)
+    assert np.all(seqnos == ref_seqnos)
+
+def test_contiguous():
+    chans = np.array([3,17,100,511])
+    check_agreement(make_packets(8,chans,2**11),chans,2**11)
+
+def test_gaps_and_reordering():
+    chans = np.arange(5,13)
+    plist = make_packets(8,chans,2**11,drop=(3,40,41,42,77),swap=((10,12),(60,70)))
+    check_agreement(plist,chans,2**11)
+
+def test_mcnt_overflow():
+    chans = np.array([3,17,100,511])
+    nfft = 2**11
+    mcnt_inc = nfft*2**12/chans.shape[0]
+    plist = make_packets(8,chans,nfft,mcnt0=2**32-3*mcnt_inc,drop=(50,))
+    check_agreement(plist,chans,nfft)
+
+def test_bad_packets_ignored():
+    chans = np.array([3,17,100,511])
+    plist = make_packets(4,chans,2**11)
+    plist.insert(5,plist[5][:100])
+    plist.insert(20,make_packets(1,chans,2**11,streamid=2)[0])
+    check_agreement(plist,chans,2**11)
+
+def test_decode_packet_buffer():
+    chans = np.arange(5,13)
+    plist = make_packets(4,chans,2**11,drop=(7,))
+    plist.insert(9,plist[9][:100])
+    pkts = np.zeros((len(plist),),dtype=udp_catcher.pkt_dtype)
+    for n,pkt in enumerate(plist):
+        pkts.view(np.uint8)[n*udp_catcher.pkt_size:n*udp_catcher.pkt_size+len(pkt)] = np.fromstring(pkt,dtype=np.uint8)
+    lengths = np.array([len(pkt) for pkt in plist])
+    darray,seqnos = udp_catcher.decode_packet_buffer(pkts,lengths,1,chans,2**11,capture_failures=False)
+    ref_darray,ref_seqnos = reference_decode(plist,1,chans,2**11)
+    assert np.all(darray == ref_darray)
+    assert np.all(seqnos == ref_seqnos)
+
+if __name__ == "__main__":
+    test_contiguous()
+    test_gaps_and_reordering()
+    test_mcnt_overflow()
+    test_bad_packets_ignored()
+    test_decode_packet_buffer()
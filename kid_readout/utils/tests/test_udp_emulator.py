@@ -0,0 +1,105 @@
+import socket
+
+import numpy as np
+
+import kid_readout.utils.udp_catcher as udp_catcher
+from kid_readout.utils.udp_emulator import RoachUdpEmulator
+from kid_readout.utils.tests.test_udp_catcher import reference_decode
+
+class EmulatedRegisters(object):
+    """
+    Just enough of an FpgaClient for udp_catcher: the streamid register drives the emulator
+    """
+    def __init__(self,emulator):
+        self.emulator = emulator
+    def write_int(self,reg,value):
+        if reg == 'streamid':
+            self.emulator.streamid = value
+
+class EmulatedRoach(object):
+    def __init__(self,emulator):
+        self.r = EmulatedRegisters(emulator)
+
+def bound_socket():
+    s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,2**22)
+    s.bind(('127.0.0.1',0))
+    s.settimeout(0.5)
+    return s
+
+def test_capture_matches_signal():
+    chans = np.array([10,20,30,40])
+    addr = ('127.0.0.1',23457)
+    emulator = RoachUdpEmulator(chans,2**11,addr=addr,chan_index=1,packet_rate=20000)
+    emulator.start()
+    try:
+        data,seqnos,health = udp_catcher.get_udp_data(EmulatedRoach(emulator),npkts=16*4*4,streamid=1,chans=chans,
+                                               nfft=2**11,addr=addr)
+    finally:
+        emulator.stop()
+    assert np.all(np.diff(seqnos) == 1)
+    assert health.ok
+    start = seqnos[0]*256/chans.shape[0]
+    assert np.all(data == emulator.expected_data(start,data.shape[0]))
+
+def test_loss_reordering_and_overflow():
+    chans = np.arange(8)
+    nfft = 2**11
+    s = bound_socket()
+    emulator = RoachUdpEmulator(chans,nfft,addr=s.getsockname(),streamid=1,mcnt0=2**32-5*nfft*2**12/8,
+                                loss=0.05,reorder=0.05,seed=1)
+    emulator.send(16)
+    assert emulator.packets_dropped > 0
+    assert emulator.packets_reordered > 0
+    nexpected = emulator.packets_sent - emulator.packets_dropped
+    pkts = np.zeros((nexpected,),dtype=udp_catcher.pkt_dtype)
+    lengths = np.zeros((nexpected,),dtype=np.int32)
+    assert udp_catcher.recv_packets(s,pkts,lengths) == nexpected
+    s.close()
+    health = udp_catcher.CaptureHealth()
+    darray,seqnos = udp_catcher.decode_packet_buffer(pkts,lengths,1,chans,nfft,health=health)
+    plist = [pkt.tostring() for pkt in pkts]
+    ref_darray,ref_seqnos = reference_decode(plist,1,chans,nfft)
+    assert np.all(darray == ref_darray)
+    assert np.all(seqnos == ref_seqnos)
+    assert health.mcnt_overflows == 1
+    assert np.all(darray.view('float32').reshape((-1,512))[health.gap_positions] == 0)
+
+def test_multi_stream():
+    # two ROACHs sharing a port, separated by stream id, and a third on its own port
+    shared = ('127.0.0.1',23459)
+    other = ('127.0.0.1',23460)
+    chans = [np.array([10,20,30,40]),np.arange(8),np.array([5,6])]
+    addrs = [shared,shared,other]
+    emulators = [RoachUdpEmulator(chans[k],2**11,addr=addrs[k],packet_rate=10000) for k in range(3)]
+    for emulator in emulators:
+        emulator.start()
+    try:
+        results = udp_catcher.get_udp_data_multi([EmulatedRoach(emulator) for emulator in emulators],
+                                                 npkts=[16*4*4,16*8*2,16*2*3],streamids=[1,2,3],chans=chans,
+                                                 nffts=[2**11]*3,addrs=addrs)
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+    for k,(data,seqnos,health) in enumerate(results):
+        assert health.ok
+        assert data.shape == (16*256*[4,2,3][k],chans[k].shape[0])
+        start = seqnos[0]*256/chans[k].shape[0]
+        assert np.all(data == emulators[k].expected_data(start,data.shape[0]))
+
+def test_multi_stream_needs_separate_roaches():
+    emulator = RoachUdpEmulator(np.arange(4),2**11,addr=('127.0.0.1',23461))
+    roach = EmulatedRoach(emulator)
+    try:
+        udp_catcher.get_udp_packets_multi([roach,roach],npkts=[16,16],streamids=[1,2],
+                                          addrs=[('127.0.0.1',23461)]*2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("two streams from one ROACH were accepted")
+
+if __name__ == "__main__":
+    test_capture_matches_signal()
+    test_loss_reordering_and_overflow()
+    test_multi_stream()
+    test_multi_stream_needs_separate_roaches()
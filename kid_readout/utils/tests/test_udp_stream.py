@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+
+from kid_readout.utils.udp_emulator import RoachUdpEmulator
+from kid_readout.utils.udp_stream import UdpStream
+from kid_readout.utils.tests.test_udp_emulator import EmulatedRoach
+
+def test_stream_read():
+    chans = np.array([3,4,5,6])
+    addr = ('127.0.0.1',23458)
+    emulator = RoachUdpEmulator(chans,2**11,addr=addr,packet_rate=20000)
+    emulator.start()
+    stream = UdpStream(EmulatedRoach(emulator),chans,2**11,addr=addr)
+    stream.start()
+    try:
+        sub = stream.subscribe(maxsize=1)
+        data,seqnos,health = stream.read(3)
+        for k in range(3):
+            data,seqnos,health = stream.read(2)
+            assert data.shape == (2*4096,4)
+            assert health.ok
+            start = seqnos[0]*256/chans.shape[0]
+            assert np.all(data == emulator.expected_data(start,data.shape[0]))
+    finally:
+        stream.stop()
+        emulator.stop()
+    assert sub.dropped > 0
+    assert stream.packets_missing == 0
+
+def test_stream_stays_aligned_after_loss():
+    # with more than 256 channels a row spans packets, so a lost packet must not shift the columns of
+    # the following chunks
+    nchan = 512
+    chans = np.arange(nchan) + 10
+    addr = ('127.0.0.1',23462)
+    emulator = RoachUdpEmulator(chans,2**11,addr=addr,packet_rate=50000,loss=0.001,seed=2)
+    emulator.start()
+    stream = UdpStream(EmulatedRoach(emulator),chans,2**11,addr=addr)
+    stream.start()
+    try:
+        data,seqnos,health = stream.read(4,timeout=10)
+    finally:
+        stream.stop()
+        emulator.stop()
+    assert health.dropped > 0
+    assert data.shape[1] == nchan
+    filled = np.all(data[:,1:] != 0,axis=1)
+    assert filled.sum() > data.shape[0]/2
+    rows = data[filled]
+    assert np.all(rows.imag == np.arange(nchan))
+    assert np.all(rows.real == rows.real[:,:1])
+    # rows are contiguous in time, lost packets having been filled with zeros
+    t = np.flatnonzero(filled)
+    assert np.all((np.diff(rows.real[:,0]) % 2**14)[np.diff(t) == 1] == 1)
+
+def test_switch_channels():
+    chans = np.array([3,4,5,6])
+    addr = ('127.0.0.1',23463)
+    emulator = RoachUdpEmulator(chans,2**11,addr=addr,packet_rate=20000)
+    emulator.start()
+    stream = UdpStream(EmulatedRoach(emulator),chans,2**11,addr=addr)
+    stream.start()
+    try:
+        stream.read(1)
+        emulator.stop()
+        new_chans = chans + 10
+        stream.set_channels(new_chans)
+        time.sleep(0.3)
+        # a bank sent with the old channels arrives after the switch, then the new channels follow
+        emulator.send(1)
+        emulator.chans = new_chans
+        emulator.start()
+        data,seqnos,health = stream.read(2,timeout=2)
+        assert health.ok
+        assert stream.packets_stale >= 16
+        start = seqnos[0]*256/chans.shape[0]
+        assert np.all(data == emulator.expected_data(start,data.shape[0]))
+    finally:
+        stream.stop()
+        emulator.stop()
+
+if __name__ == "__main__":
+    test_stream_read()
+    test_stream_stays_aligned_after_loss()
+    test_switch_channels()
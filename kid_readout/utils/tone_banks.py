@@ -0,0 +1,77 @@
+"""
+Bookkeeping of which tone sets the DRAM banks of a baseband readout hold
+
+The DRAM holds one waveform bank per row of ri.tone_bins, selected with select_bank. Scripts which
+retune after each fit used to append a new bank every time with add_tone_freqs. ToneBankAllocator
+records a key for the tones of each bank so that add_tone_bins can instead
+
+    replace a single bank in place:        ri.add_tone_freqs(freqs,bank=3)
+    reuse banks released with free:        ri.free_tone_bank(3); ri.add_tone_freqs(freqs)
+    skip banks which already hold the tones
+
+synthesizing and loading only the bank which changes, never the others.
+"""
+
+import hashlib
+
+import numpy as np
+
+def tone_bank_key(bins,nsamp,amps,phases,wavenorm):
+    """
+    Hash the arguments which determine the quantized waveform of one bank
+
+    returns : hexadecimal string
+    """
+    h = hashlib.sha1()
+    h.update(repr((int(nsamp),float(wavenorm))))
+    for value in (bins,amps,phases):
+        h.update(np.ascontiguousarray(value,dtype=np.float64).tostring())
+    return h.hexdigest()
+
+class ToneBankAllocator(object):
+    def __init__(self,max_banks,keys=()):
+        """
+        max_banks : number of banks which fit in the DRAM
+        keys : tone_bank_key of each bank already loaded, None where the contents are unknown
+        """
+        self.max_banks = max_banks
+        self.keys = list(keys)
+        self.free_banks = set()
+
+    @property
+    def nbanks(self):
+        return len(self.keys)
+
+    def allocate(self,key,bank=None):
+        """
+        Choose the bank to hold the tones identified by *key*
+
+        bank : bank to replace, or the current number of banks to append one. If None, the lowest
+            free bank is used, or a bank is appended if none is free.
+
+        returns : bank,changed with *changed* False if the bank already holds these tones, so
+            nothing needs to be loaded
+        """
+        if bank is None:
+            if self.free_banks:
+                bank = min(self.free_banks)
+            else:
+                bank = self.nbanks
+        if bank < 0 or bank > self.nbanks:
+            raise ValueError("bank %d is neither an existing bank nor the next new one (%d)" % (bank,self.nbanks))
+        if bank == self.nbanks:
+            if bank >= self.max_banks:
+                raise ValueError("no room in the DRAM for bank %d, it holds %d banks" % (bank,self.max_banks))
+            self.keys.append(None)
+        self.free_banks.discard(bank)
+        changed = key is None or self.keys[bank] != key
+        self.keys[bank] = key
+        return bank,changed
+
+    def free(self,bank):
+        """
+        Release *bank* for reuse by the next allocate. Its contents stay in the DRAM until then.
+        """
+        if bank < 0 or bank >= self.nbanks:
+            raise ValueError("no bank %d" % bank)
+        self.free_banks.add(bank)
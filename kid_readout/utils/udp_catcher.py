@@ -3,128 +3,536 @@ import struct
 import socket
 from contextlib import closing
 import time
-import cPickle
+import os
+import select
+import threading
+import Queue
 
-def get_udp_packets(ri,npkts,streamid,stream_reg='streamid',addr=('192.168.1.1',12345)):
+import recvmmsg
+
+# set to False to force the one packet per system call receive path
+use_recvmmsg = True
+
+def get_udp_packets(ri,npkts,streamid,stream_reg='streamid',addr=('192.168.1.1',12345),pkts=None,lengths=None,
+                    rcvbuf=2**24):
+    """
+    Capture npkts packets from the ROACH
+    
+    Packets are received directly into a preallocated array with one pkt_size slot per packet, so no
+    per-packet strings are created.
+    
+    pkts,lengths : optional arrays of at least npkts entries to receive into (for example memory
+        mapped files), instead of allocating new ones
+    rcvbuf : requested kernel socket receive buffer size in bytes
+    
+    returns : pkts,lengths
+        pkts : array of dtype pkt_dtype
+        lengths : actual size in bytes of each received packet. Oversize packets are truncated in pkts,
+            but their full size is reported here.
+    """
+    if pkts is None:
+        pkts = np.empty((npkts,),dtype=pkt_dtype)
+    if lengths is None:
+        lengths = np.zeros((npkts,),dtype=np.int32)
+    pkts = pkts[:npkts]
+    lengths = lengths[:npkts]
     ri.r.write_int(stream_reg,0)
     
     with closing(socket.socket(socket.AF_INET,socket.SOCK_DGRAM)) as s:
-        s.bind(addr)
-        s.settimeout(0)
-        nstale = 0
         try:
-            while s.recv(2000):
-                nstale +=1
-            if nstale:
-                print "flushed",nstale,"packets"
-        except:
-            pass
+            s.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,rcvbuf)
+        except socket.error:
+            print "could not set receive buffer size to",rcvbuf
+        s.bind(addr)
+        flush_socket(s)
         s.settimeout(1)
         
         ri.r.write_int(stream_reg,streamid)
-        pkts = []
-        while len(pkts) < npkts:
-            pkt = s.recv(2000)
-            if pkt:
-                pkts.append(pkt)
-            else:
-                print "breaking"
+        try:
+            nrecv = recv_packets(s,pkts,lengths)
+        finally:
+            ri.r.write_int(stream_reg,0)
+    if nrecv < npkts:
+        raise socket.timeout("timed out after receiving %d of %d packets" % (nrecv,npkts))
+    
+    return pkts,lengths
+
+def get_udp_packets_multi(ris,npkts,streamids,stream_regs=None,addrs=None,batch_size=1024,rcvbuf=2**24):
+    """
+    Capture several streams at once, each from a different ROACH
+    
+    Streams sharing a local address are received on one socket and separated by stream id, so any
+    mix of shared and separate ports can be used. Each stream is switched off as soon as it has
+    delivered its packets. A ROACH sends a single stream, selected by its stream register, so every
+    stream must come from its own ROACH (or at least its own stream register).
+    
+    ris : list of RoachInterface instances, one per stream, used to toggle the stream registers
+    npkts : list of the number of packets to capture from each stream
+    streamids : list of stream ids, which must be distinct for streams sharing an address
+    stream_regs : list of stream register names (default 'streamid' for every stream)
+    addrs : list of local addresses to bind (default ('192.168.1.1',12345) for every stream)
+    batch_size : number of packets received per call before they are sorted into the streams
+    
+    returns : list of (pkts,lengths) for each stream, as from get_udp_packets
+    """
+    nstream = len(ris)
+    if stream_regs is None:
+        stream_regs = ['streamid']*nstream
+    if addrs is None:
+        addrs = [('192.168.1.1',12345)]*nstream
+    regs = [(id(ris[k].r),stream_regs[k]) for k in range(nstream)]
+    if len(set(regs)) != nstream:
+        raise ValueError("streams must have separate stream registers, each ROACH sends only one stream")
+    by_addr = {}
+    for k,addr in enumerate(addrs):
+        by_addr.setdefault(tuple(addr),[]).append(k)
+    for addr,members in by_addr.items():
+        ids = [streamids[k] for k in members]
+        if len(set(ids)) != len(ids):
+            raise ValueError("streams sharing address %s must have distinct stream ids, got %s" % (addr,ids))
+    outputs = [(np.empty((n,),dtype=pkt_dtype),np.zeros((n,),dtype=np.int32)) for n in npkts]
+    counts = [0]*nstream
+    batch = np.empty((batch_size,),dtype=pkt_dtype)
+    batch_lengths = np.zeros((batch_size,),dtype=np.int32)
+    unmatched = 0
+    for k in range(nstream):
+        ris[k].r.write_int(stream_regs[k],0)
+    sockets = {}
+    try:
+        for addr in by_addr:
+            s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            sockets[s] = addr
+            try:
+                s.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,rcvbuf)
+            except socket.error:
+                print "could not set receive buffer size to",rcvbuf
+            s.bind(addr)
+            flush_socket(s)
+            s.settimeout(0.001)
+        for k in range(nstream):
+            ris[k].r.write_int(stream_regs[k],streamids[k])
+        while True:
+            pending = [s for s,addr in sockets.items() if any([counts[k] < npkts[k] for k in by_addr[addr]])]
+            if not pending:
                 break
-        
-        ri.r.write_int(stream_reg,0)
+            ready,_,_ = select.select(pending,[],[],1.0)
+            if not ready:
+                break
+            for s in ready:
+                nrecv = recv_packets(s,batch,batch_lengths)
+                received = batch['stream'][:nrecv]
+                has_header = batch_lengths[:nrecv] >= hdr_size
+                matched = 0
+                for k in by_addr[sockets[s]]:
+                    sel = np.flatnonzero((received == streamids[k]) & has_header)
+                    matched += sel.shape[0]
+                    sel = sel[:npkts[k]-counts[k]]
+                    if sel.shape[0] == 0:
+                        continue
+                    pkts,lengths = outputs[k]
+                    pkts[counts[k]:counts[k]+sel.shape[0]] = batch[sel]
+                    lengths[counts[k]:counts[k]+sel.shape[0]] = batch_lengths[sel]
+                    counts[k] += sel.shape[0]
+                    if counts[k] == npkts[k]:
+                        ris[k].r.write_int(stream_regs[k],0)
+                unmatched += nrecv - matched
+    finally:
+        for k in range(nstream):
+            ris[k].r.write_int(stream_regs[k],0)
+        for s in sockets:
+            s.close()
+    if unmatched:
+        print "got",unmatched,"packets with unexpected stream ids or truncated headers"
+    short = [k for k in range(nstream) if counts[k] < npkts[k]]
+    if short:
+        raise socket.timeout("timed out after receiving %s of %s packets" % ([counts[k] for k in short],[npkts[k] for k in short]))
+    return outputs
+
+def recv_packets(s,pkts,lengths,start=0):
+    """
+    Receive packets from socket *s* into the preallocated pkts and lengths arrays
+    
+    Slots from *start* onwards are filled until the arrays are full or the socket times out.
+    Uses batched recvmmsg calls when available and *use_recvmmsg* is True, otherwise one recv_into per
+    packet.
+    
+    returns : index one past the last filled slot
+    """
+    if use_recvmmsg and recvmmsg.available:
+        nrecv = recvmmsg.recv_packets(s,pkts,lengths,start=start)
+        if recvmmsg.available:
+            return nrecv
+        start = nrecv
+    return recv_packets_loop(s,pkts,lengths,start=start)
+
+def recv_packets_loop(s,pkts,lengths,start=0):
+    """
+    Receive packets one recv_into call at a time. See recv_packets.
+    """
+    slots = memoryview(pkts.view(np.uint8))
+    nrecv = start
+    try:
+        while nrecv < pkts.shape[0]:
+            offset = nrecv*pkt_size
+            lengths[nrecv] = s.recv_into(slots[offset:offset+pkt_size],pkt_size,recv_flags)
+            nrecv += 1
+    except socket.timeout:
+        pass
+    return nrecv
+
+def flush_socket(s):
+    """
+    Discard any stale packets waiting on socket *s*
+    """
+    s.settimeout(0)
+    nstale = 0
+    try:
+        while s.recv(2000):
+            nstale +=1
+    except socket.error:
+        pass
+    if nstale:
+        print "flushed",nstale,"packets"
+    return nstale
+    
+def get_udp_data(ri,npkts,streamid,chans,nfft,stream_reg='streamid',addr=('192.168.1.1',12345),
+                 capture_failures=False):
+    """
+    Capture and decode npkts packets
+    
+    returns : darray,seqnos,health
+        see decode_packets for darray and seqnos. health is a CaptureHealth instance
+    """
+    pkts,lengths = get_udp_packets(ri, npkts, streamid, stream_reg=stream_reg, addr=addr)
+    health = CaptureHealth()
+    darray,seqnos = decode_packet_buffer(pkts,lengths,streamid,chans,nfft,capture_failures=capture_failures,
+                                         health=health)
+    return darray,seqnos,health
+
+def get_udp_data_multi(ris,npkts,streamids,chans,nffts,stream_regs=None,addrs=None,capture_failures=False):
+    """
+    Capture and decode several streams at once. See get_udp_packets_multi.
     
-    return pkts
+    chans : list of arrays of FPGA channel ids, one per stream
+    nffts : list of the number of FFT bins for each stream
     
-def get_udp_data(ri,npkts,streamid,chans,nfft,stream_reg='streamid',addr=('192.168.1.1',12345)):
-    pkts = get_udp_packets(ri, npkts, streamid, stream_reg=stream_reg, addr=addr)
-    darray,seqnos = decode_packets(pkts,streamid,chans,nfft)
-    return darray,seqnos
+    returns : list of (darray,seqnos,health) for each stream, as from get_udp_data
+    """
+    captures = get_udp_packets_multi(ris,npkts,streamids,stream_regs=stream_regs,addrs=addrs)
+    results = []
+    for k,(pkts,lengths) in enumerate(captures):
+        health = CaptureHealth()
+        darray,seqnos = decode_packet_buffer(pkts,lengths,streamids[k],chans[k],nffts[k],
+                                             capture_failures=capture_failures,health=health)
+        results.append((darray,seqnos,health))
+    return results
 
-ptype = np.dtype([('idle','>i2'),
-                  ('idx', '>i2'),
-                ('stream', '>i2'),
-                ('chan', '>i2'),
-                ('mcntr', '>i4')])
+# header written by ppc/kid_ppc.c, followed by 1024 bytes of payload (256 complex 16 bit samples)
+ptype = np.dtype([('idle','>u2'),
+                  ('idx', '>u2'),
+                ('stream', '>u2'),
+                ('chan', '>u2'),
+                ('mcntr', '>u4')])
 
 hdr_fmt = ">4HI"
 hdr_size = struct.calcsize(hdr_fmt)
 pkt_size = hdr_size + 1024
-null_pkt = "\x00"*1024
-def decode_packets(plist,streamid,chans,nfft,pkts_per_chunk = 16,capture_failures=True):
-    nchan = chans.shape[0]    
-    mcnt_inc = nfft*2**12/nchan    
-    next_seqno = None
-    mcnt_top = 0
-    dset = []
-    mcntoff = None
-    last_mcnt_ovf = None
-    seqnos = []
-    nextseqnos = []
-    chan0 = None
-    for pnum,pkt in enumerate(plist):
-        if len(pkt) != pkt_size:
-            print "got packet size",len(pkt), "expected",pkt_size
-            continue
-        pidle,pidx,pstream,pchan,pmcnt = struct.unpack(hdr_fmt,pkt[:hdr_size])
-        #print pmcnt
-        if pstream != streamid:
-            print "got stream id",pstream,"expected",streamid
-            continue            
-        if next_seqno is None:
-            mcnt_top = 0
-            last_mcnt_ovf = pmcnt
-        else:
-            if pmcnt < mcnt_inc:
-                if last_mcnt_ovf != pmcnt:
-                    print "detected mcnt overflow",last_mcnt_ovf,pmcnt,pidx,next_seqno,(mcnt_top/2**32),pnum,mcntoff
-                    mcnt_top += 2**32
-                    last_mcnt_ovf = pmcnt
-                else:
-#                    print "continuation of previous mcnt overflow",pidx
-                    pass
-            else:
-                last_mcnt_ovf = None
-        chunkno,pmcntoff = divmod(pmcnt+mcnt_top,mcnt_inc)
-        #print chunkno,pmcnt,pmcntoff,pidx
-        seqno = (chunkno)*pkts_per_chunk + pidx
-        #print seqno
-        seqnos.append(seqno)
-        nextseqnos.append(next_seqno)
-        if next_seqno is None:
-            chan0 = pchan
-#            print "found first packet",seqno,pidx
-            next_seqno = seqno
-            mcntoff = pmcntoff
-#            print pchan
-        if mcntoff != pmcntoff:
-            print "mcnt offset jumped. Was",mcntoff,"now",pmcntoff,"dropping.."
-            continue
-        if pchan != chan0:
-            print "warning! channel id changed from",chan0,"to",pchan 
-        if seqno - next_seqno < 0:
-            print "seqno diff",(seqno-next_seqno),seqno,next_seqno
-            continue # trying to go backwards
-        if seqno == next_seqno:
-            dset.append(pkt[hdr_size:])
-            next_seqno += 1
-        else:
-            print "sequence number skip, expected:",next_seqno,"got",seqno,"inserting",(seqno-next_seqno),"null packets",pnum,pidx
-            if capture_failures: #seqno-next_seqno == 32768:
-                print "caught special case, writing to disk"
-                fname = time.strftime("udp_skip_%Y-%m-%d_%H%M%S.pkl")
-                fh = open(fname,'w')
-                cPickle.dump(dict(plist=plist,dset=dset,pnum=pnum,pkt=pkt,streamid=streamid,chans=chans,nfft=nfft),
-                             fh,cPickle.HIGHEST_PROTOCOL)
-                fh.close()
-                print "wrote data to:",fname
-            for k in range(seqno - next_seqno+1):
-                dset.append(null_pkt)
-                next_seqno += 1
-    dset = ''.join(dset)
-    ns = (len(dset)//(4*nchan))
-    dset = dset[:ns*(4*nchan)]
-    darray = np.fromstring(dset,dtype='>i2').astype('float32').view('complex64')
-    darray.shape = (ns,nchan)
-    shift = np.flatnonzero(chans==(chan0))[0] - (nchan-1)
-    darray = np.roll(darray,shift,axis=1)
-    return darray,np.array(seqnos)
\ No newline at end of file
+pkt_dtype = np.dtype(ptype.descr + [('data','>i2',(512,))])
+# MSG_TRUNC makes recv_into report the full size of oversize datagrams on Linux
+recv_flags = getattr(socket,'MSG_TRUNC',0)
+
+class CaptureHealth(object):
+    """
+    Packet stream health of one capture, filled in by the decoder
+    
+    packets : number of packets handed to the decoder
+    size_mismatch : packets with a size other than pkt_size
+    wrong_stream : packets with an unexpected stream id
+    mcnt_overflows : number of 32 bit mcnt counter wraps
+    mcnt_jumps : packets dropped because their mcnt offset did not match the first packet
+    channel_changes : packets reporting a different channel id than the first packet
+    late : packets dropped because their sequence number was not beyond all packets seen so far
+    gaps : number of sequence number skips
+    dropped : number of packets missing from the sequence
+    null_filled : number of packet slots filled with zeros (the packet following each gap is also replaced)
+    gap_positions : packet slot in the output where each gap starts
+    gap_lengths : number of missing packets in each gap
+    """
+    counters = ['packets','size_mismatch','wrong_stream','mcnt_overflows','mcnt_jumps','channel_changes',
+                'late','gaps','dropped','null_filled']
+    def __init__(self):
+        self.epoch = time.time()
+        for name in self.counters:
+            setattr(self,name,0)
+        self.gap_positions = np.zeros((0,),dtype=np.int64)
+        self.gap_lengths = np.zeros((0,),dtype=np.int64)
+        
+    @property
+    def ok(self):
+        return all([getattr(self,name) == 0 for name in self.counters if name not in ('packets','mcnt_overflows')])
+    
+    def accumulate(self,other,slot_offset=0):
+        """
+        Add the counters of *other* to this instance
+        
+        slot_offset : output packet slot at which the capture described by *other* starts, used to
+            shift its gap positions
+        """
+        for name in self.counters:
+            setattr(self,name,getattr(self,name) + getattr(other,name))
+        self.gap_positions = np.concatenate((self.gap_positions,other.gap_positions + slot_offset))
+        self.gap_lengths = np.concatenate((self.gap_lengths,other.gap_lengths))
+        
+    def as_dict(self):
+        d = dict([(name,getattr(self,name)) for name in self.counters])
+        d['epoch'] = self.epoch
+        return d
+    
+    def __repr__(self):
+        problems = ', '.join(['%s=%d' % (name,getattr(self,name)) for name in self.counters[1:] if getattr(self,name)])
+        return "<CaptureHealth %d packets%s>" % (self.packets, (': ' + problems) if problems else ', ok')
+
+class FailureRecorder(object):
+    def __init__(self,directory='.',max_bytes=2**26):
+        """
+        Write the raw packets of captures with sequence problems to disk in a background thread
+        
+        Each capture is saved as an .npz file containing the packet array (dtype pkt_dtype) and the
+        CaptureHealth counters. Recording stops once *max_bytes* have been written.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes_written = 0
+        self.files = []
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def record(self,pkts,health):
+        """
+        Queue a copy of *pkts* for writing, unless doing so would exceed max_bytes
+        
+        returns : True if the packets were queued
+        """
+        if self.bytes_written + pkts.nbytes > self.max_bytes:
+            return False
+        self.bytes_written += pkts.nbytes
+        self._queue.put((pkts.copy(),health.as_dict()))
+        return True
+    
+    def flush(self):
+        """
+        Wait until all queued captures have been written
+        """
+        self._queue.join()
+        
+    def _run(self):
+        while True:
+            pkts,health = self._queue.get()
+            try:
+                fname = os.path.join(self.directory,time.strftime("udp_skip_%Y-%m-%d_%H%M%S",time.localtime(health['epoch'])))
+                fname += "_%06d.npz" % (1e6*(health['epoch'] % 1))
+                np.savez(fname,pkts=pkts,**health)
+                self.files.append(fname)
+            except Exception, e:
+                print "failed to record capture failure:",e
+            finally:
+                self._queue.task_done()
+
+# shared recorder used when capture_failures=True
+_failure_recorder = None
+
+def get_failure_recorder(capture_failures):
+    global _failure_recorder
+    if not capture_failures:
+        return None
+    if isinstance(capture_failures,FailureRecorder):
+        return capture_failures
+    if _failure_recorder is None:
+        _failure_recorder = FailureRecorder()
+    return _failure_recorder
+
+def decode_packets(plist,streamid,chans,nfft,pkts_per_chunk = 16,capture_failures=False,health=None):
+    """
+    Decode a list of UDP packets into a contiguous array of channel data
+    
+    plist : list of packet strings
+    streamid : packets with any other stream id are discarded
+    chans : array of FPGA channel ids being read out (used to undo the channel rotation)
+    nfft : number of FFT bins, used to compute the mcnt increment per chunk
+    pkts_per_chunk : number of packets the PPC sends per BRAM bank
+    capture_failures : False, True or a FailureRecorder. If set, the raw packets of captures with
+        sequence skips are written to disk in the background (True uses a shared FailureRecorder
+        writing to the current directory)
+    health : optional CaptureHealth instance to fill in
+    
+    Missing packets are filled with zeros. The packet immediately following a gap is also replaced by
+    zeros, matching the behavior of the original packet-by-packet decoder.
+    
+    returns : darray,seqnos
+        darray : complex64 array of shape (nsamples,nchan)
+        seqnos : sequence number of each packet with the correct size and stream id
+    """
+    if health is None:
+        health = CaptureHealth()
+    good = [pkt for pkt in plist if len(pkt) == pkt_size]
+    health.packets = len(plist)
+    health.size_mismatch = len(plist) - len(good)
+    if health.size_mismatch:
+        print "got",health.size_mismatch,"packets with size other than",pkt_size
+    pkts = np.fromstring(''.join(good),dtype=pkt_dtype)
+    return decode_packet_array(pkts,streamid,chans,nfft,pkts_per_chunk=pkts_per_chunk,
+                               capture_failures=capture_failures,health=health)
+
+def decode_packet_buffer(pkts,lengths,streamid,chans,nfft,pkts_per_chunk=16,capture_failures=False,health=None):
+    """
+    Decode packets captured by get_udp_packets
+    
+    pkts,lengths : as returned by get_udp_packets
+    
+    The packet buffer is used in place unless some packets have the wrong size.
+    See decode_packets for the other arguments and return values
+    """
+    if health is None:
+        health = CaptureHealth()
+    good = lengths == pkt_size
+    health.packets = pkts.shape[0]
+    health.size_mismatch = (~good).sum()
+    if health.size_mismatch:
+        print "got",health.size_mismatch,"packets with size other than",pkt_size
+        pkts = pkts[good]
+    return decode_packet_array(pkts,streamid,chans,nfft,pkts_per_chunk=pkts_per_chunk,
+                               capture_failures=capture_failures,health=health)
+
+def decode_packet_array(pkts,streamid,chans,nfft,pkts_per_chunk=16,capture_failures=False,health=None):
+    """
+    Vectorized core of decode_packets
+    
+    pkts : array of dtype pkt_dtype
+    
+    See decode_packets for the other arguments and return values
+    """
+    decoder = PacketDecoder(streamid,chans,nfft,pkts_per_chunk=pkts_per_chunk,capture_failures=capture_failures)
+    return decoder.decode(pkts,health=health)
+
+class PacketDecoder(object):
+    def __init__(self,streamid,chans,nfft,pkts_per_chunk=16,capture_failures=False):
+        """
+        Decoder for a packet stream that arrives in pieces, such as a long raw capture read back in chunks
+        
+        The mcnt overflow count, the mcnt offset, the reference channel and the last accepted sequence
+        number are carried from one call of decode to the next, as is any partial row of samples, so
+        concatenating the outputs gives the same result as decoding all of the packets at once.
+        See decode_packets for the arguments.
+        """
+        self.streamid = streamid
+        self.chans = np.asarray(chans)
+        self.nchan = self.chans.shape[0]
+        self.nfft = nfft
+        self.mcnt_inc = nfft*2**12/self.nchan
+        self.pkts_per_chunk = pkts_per_chunk
+        self.capture_failures = capture_failures
+        self.first_seqno = None
+        self.last_seqno = None  # highest sequence number accepted so far
+        self.samples = 0        # number of rows of output produced so far
+        self._last_mcnt = None
+        self._mcnt_top = 0
+        self._mcntoff = None
+        self._chan0 = None
+        self._remainder = np.zeros((0,),dtype='complex64')
+    
+    def decode(self,pkts,health=None):
+        """
+        Decode the next packets of the stream
+        
+        pkts : array of dtype pkt_dtype
+        health : optional CaptureHealth instance to fill in for these packets
+        
+        returns : darray,seqnos as from decode_packets. Rows that span the end of *pkts* are returned by
+            the next call.
+        """
+        if health is None:
+            health = CaptureHealth()
+            health.packets = pkts.shape[0]
+        nchan = self.nchan
+        mcnt_inc = self.mcnt_inc
+        wrong_stream = pkts['stream'] != self.streamid
+        health.wrong_stream = wrong_stream.sum()
+        if health.wrong_stream:
+            print "got",health.wrong_stream,"packets with stream ids",np.unique(pkts['stream'][wrong_stream]),"expected",self.streamid
+            pkts = pkts[~wrong_stream]
+        if pkts.shape[0] == 0:
+            print "no valid packets received"
+            return np.zeros((0,nchan),dtype='complex64'),np.zeros((0,),dtype=np.int64)
+
+        # mcntr is a 32 bit counter. A wrap shows up as a small count which differs from the previous packet's count
+        mcnt = pkts['mcntr'].astype(np.int64)
+        prev = np.empty_like(mcnt)
+        prev[1:] = mcnt[:-1]
+        prev[0] = mcnt[0] if self._last_mcnt is None else self._last_mcnt
+        overflow = (mcnt < mcnt_inc) & (mcnt != prev)
+        self._last_mcnt = mcnt[-1]
+        health.mcnt_overflows = overflow.sum()
+        mcnt += self._mcnt_top
+        if health.mcnt_overflows:
+            mcnt += np.cumsum(overflow)*2**32
+            self._mcnt_top += health.mcnt_overflows*2**32
+        chunkno = mcnt // mcnt_inc
+        pmcntoff = mcnt % mcnt_inc
+        seqnos = chunkno*self.pkts_per_chunk + pkts['idx']
+
+        if self._chan0 is None:
+            self._chan0 = pkts['chan'][0]
+            self._mcntoff = pmcntoff[0]
+            self.first_seqno = seqnos[0]
+            self.last_seqno = seqnos[0] - 1
+        chan0 = self._chan0
+        aligned = pmcntoff == self._mcntoff
+        health.mcnt_jumps = (~aligned).sum()
+        if health.mcnt_jumps:
+            print "mcnt offset jumped. Was",self._mcntoff,"now",np.unique(pmcntoff[~aligned]),"dropping",health.mcnt_jumps,"packets"
+        chan_changed = aligned & (pkts['chan'] != chan0)
+        health.channel_changes = chan_changed.sum()
+        if health.channel_changes:
+            print "warning! channel id changed from",chan0,"to",np.unique(pkts['chan'][chan_changed])
+
+        # a packet is only used if its seqno is beyond every seqno accepted so far; anything else is late
+        aligned_idx = np.flatnonzero(aligned)
+        aligned_seqnos = seqnos[aligned_idx]
+        highest = np.maximum.accumulate(np.concatenate(([self.last_seqno],aligned_seqnos)))
+        accept = aligned_seqnos > highest[:-1]
+        health.late = (~accept).sum()
+        accepted_idx = aligned_idx[accept]
+        if accepted_idx.shape[0] == 0:
+            return np.zeros((0,nchan),dtype='complex64'),seqnos
+        # slots are counted from the first packet after the previous call
+        slots = aligned_seqnos[accept] - self.last_seqno - 1
+        steps = np.diff(np.concatenate(([-1],slots)))
+        contiguous = steps == 1
+        skips = np.flatnonzero(steps > 1)
+        start_slot = self.last_seqno + 1 - self.first_seqno
+        health.gaps = skips.shape[0]
+        health.gap_positions = start_slot + slots[skips] - steps[skips] + 1
+        health.gap_lengths = steps[skips] - 1
+        health.dropped = health.gap_lengths.sum()
+        health.null_filled = health.dropped + health.gaps
+        self.last_seqno = aligned_seqnos[accept][-1]
+        if health.gaps:
+            print "%d sequence number skips, inserted %d null packets" % (health.gaps,health.null_filled)
+            recorder = get_failure_recorder(self.capture_failures)
+            if recorder is not None:
+                recorder.record(pkts,health)
+
+        nslots = slots[-1] + 1
+        darray = np.zeros((nslots*256,),dtype='complex64')
+        darray.view('float32').reshape((nslots,512))[slots[contiguous]] = pkts['data'][accepted_idx[contiguous]]
+        if self._remainder.shape[0]:
+            darray = np.concatenate((self._remainder,darray))
+        ns = darray.shape[0]//nchan
+        self._remainder = darray[ns*nchan:].copy()
+        darray = darray[:ns*nchan].reshape((ns,nchan))
+        self.samples += ns
+        shift = np.flatnonzero(self.chans==(chan0))[0] - (nchan-1)
+        darray = np.roll(darray,shift,axis=1)
+        return darray,seqnos
@@ -0,0 +1,174 @@
+"""
+Emulator for the UDP packet stream produced by the ROACH PPC server (ppc/kid_ppc.c)
+
+Each time the FPGA fills a BRAM bank, kid_ppc.c sends 16 packets of 1036 bytes:
+    word 0 : (idle << 16) + packet index within the bank
+    word 1 : chansel register, (streamid << 16) + channel id
+    word 2 : mcntr register
+    1024 bytes of payload, 256 complex samples as big endian 16 bit pairs
+The emulator reproduces this layout so the receive path can be tested and benchmarked without hardware.
+"""
+
+import numpy as np
+import socket
+import threading
+import time
+
+import udp_catcher
+
+pkts_per_bank = 16
+samples_per_bank = pkts_per_bank*256
+
+def ramp_signal(t,nchan):
+    """
+    Default test signal: real part counts samples (mod 2**14), imaginary part is the channel index
+
+    t : array of sample indexes
+    returns : complex array of shape (len(t),nchan)
+    """
+    return (t % 2**14)[:,None] + 1j*np.arange(nchan)[None,:]
+
+class RoachUdpEmulator(object):
+    def __init__(self,chans,nfft,addr=('127.0.0.1',12345),streamid=0,chan_index=None,mcnt0=0,
+                 packet_rate=None,loss=0.0,reorder=0.0,signal=ramp_signal,seed=None):
+        """
+        chans : array of FPGA channel ids being read out
+        nfft : number of FFT bins, which sets the mcnt increment per bank
+        addr : destination address for the packets
+        streamid : initial stream id. As on the ROACH, nothing is sent while the stream id is 0
+        chan_index : index into chans of the channel id reported in the packet headers. The default,
+            the last channel, means the payload needs no rotation
+        mcnt0 : initial mcnt counter value. Set close to 2**32 to exercise counter overflow
+        packet_rate : packets per second to send, or None to send as fast as possible
+        loss : probability that any given packet is dropped
+        reorder : probability that a packet is swapped with the one after it
+        signal : function of (sample indexes, nchan) returning the complex samples for each channel
+        seed : seed for the loss and reordering random number generator
+        """
+        self.chans = np.array(chans)
+        self.nchan = self.chans.shape[0]
+        if samples_per_bank % self.nchan:
+            raise ValueError("number of channels (%d) must divide %d" % (self.nchan,samples_per_bank))
+        self.nfft = nfft
+        self.addr = addr
+        self.streamid = streamid
+        if chan_index is None:
+            chan_index = self.nchan - 1
+        self.chan_index = chan_index
+        self.mcnt_inc = nfft*2**12/self.nchan
+        self.mcnt = mcnt0 % 2**32
+        self.packet_rate = packet_rate
+        self.loss = loss
+        self.reorder = reorder
+        self.signal = signal
+        self.random = np.random.RandomState(seed)
+        self.sample = 0 # per channel sample index of the next bank
+        self.banks_sent = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self.packets_reordered = 0
+        self._rate_t0 = None
+        self._rate_packets = 0
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def expected_data(self,start,nsamples):
+        """
+        The data the decoder should produce for per channel samples start to start+nsamples when no
+        packets are lost, quantized as the emulator sends it
+        """
+        d = self.signal(np.arange(start,start+nsamples),self.nchan)
+        return (np.round(d.real) + 1j*np.round(d.imag)).astype('complex64')
+
+    def make_banks(self,nbanks=1):
+        """
+        Build the packets for the next *nbanks* BRAM banks and advance the counters
+
+        returns : array of dtype udp_catcher.pkt_dtype with 16 packets per bank
+        """
+        nsamp = nbanks*samples_per_bank/self.nchan
+        d = self.signal(np.arange(self.sample,self.sample+nsamp),self.nchan)
+        # the ROACH reports the channel being written when the bank was read, which rotates the channel order
+        d = np.roll(d,(self.nchan-1)-self.chan_index,axis=1)
+        pkts = np.zeros((nbanks*pkts_per_bank,),dtype=udp_catcher.pkt_dtype)
+        pkts['idle'] = self.random.randint(1,100,size=nbanks).repeat(pkts_per_bank)
+        pkts['idx'] = np.tile(np.arange(pkts_per_bank),nbanks)
+        pkts['stream'] = self.streamid
+        pkts['chan'] = self.chans[self.chan_index]
+        pkts['mcntr'] = ((self.mcnt + self.mcnt_inc*np.arange(nbanks,dtype=np.int64)) % 2**32).repeat(pkts_per_bank)
+        iq = np.empty((d.size*2,),dtype='>i2')
+        iq[0::2] = np.round(d.real).ravel()
+        iq[1::2] = np.round(d.imag).ravel()
+        pkts['data'] = iq.reshape((-1,512))
+        self.sample += nsamp
+        self.mcnt = (self.mcnt + nbanks*self.mcnt_inc) % 2**32
+        self.banks_sent += nbanks
+        return pkts
+
+    def send(self,nbanks):
+        """
+        Send *nbanks* banks of packets, applying the configured loss, reordering and rate
+        """
+        pkts = memoryview(self.make_banks(nbanks).view(np.uint8))
+        npkts = nbanks*pkts_per_bank
+        order = np.arange(npkts)
+        swaps = np.flatnonzero(self.random.random_sample(npkts-1) < self.reorder)
+        for n in swaps:
+            order[n],order[n+1] = order[n+1],order[n]
+        self.packets_reordered += swaps.shape[0]
+        keep = self.random.random_sample(npkts) >= self.loss
+        self.packets_dropped += (~keep).sum()
+        size = udp_catcher.pkt_size
+        sendto = self._socket.sendto
+        if not self.packet_rate:
+            for n in order[keep[order]]:
+                sendto(pkts[n*size:(n+1)*size],self.addr)
+        else:
+            if self._rate_t0 is None:
+                self._rate_t0 = time.time()
+                self._rate_packets = 0
+            for k,n in enumerate(order):
+                if keep[n]:
+                    sendto(pkts[n*size:(n+1)*size],self.addr)
+                if (k+1) % pkts_per_bank == 0:
+                    self._rate_packets += pkts_per_bank
+                    delay = self._rate_t0 + self._rate_packets/float(self.packet_rate) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        self.packets_sent += npkts
+
+    def start(self):
+        """
+        Start sending in a background thread. Banks are only sent while self.streamid is nonzero,
+        mirroring the streamid register on the ROACH.
+        """
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def run(self,stop_event=None,banks_per_send=8):
+        """
+        Send until *stop_event* (by default the one used by stop()) is set
+
+        banks_per_send : number of banks generated at once. Larger values lower the overhead per packet
+            but delay the response to changes of self.streamid
+        """
+        if stop_event is None:
+            stop_event = self._stop_event
+        while not stop_event.is_set():
+            if self.streamid:
+                self.send(banks_per_send)
+            else:
+                self._rate_t0 = None
+                time.sleep(0.001)
@@ -0,0 +1,259 @@
+"""
+Continuous UDP acquisition from the packet server running on the ROACH PPC (ppc/kid_ppc.c)
+
+A UdpStream keeps the socket open and runs a receiver thread. The thread decodes fixed size chunks of
+packets and hands them to any number of subscribers through bounded queues, so consumers such as a
+disk writer, a live PSD or the sweep logic can read without stopping and restarting the stream.
+The chunks are decoded by one udp_catcher.PacketDecoder, as for a raw capture, so they join up into
+a continuous timestream with lost packets filled with zeros, whatever the chunk boundaries.
+"""
+
+import numpy as np
+import threading
+import Queue
+import socket
+import time
+
+import udp_catcher
+
+class StreamChunk(object):
+    def __init__(self,data,seqnos,epoch,chans,health,start_slot=0):
+        """
+        One decoded chunk of the UDP stream
+
+        data : complex64 array of shape (nsamples,nchan)
+        seqnos : packet sequence numbers contained in this chunk
+        epoch : time.time() when the last packet of the chunk arrived
+        chans : FPGA channel ids the chunk was decoded with
+        health : udp_catcher.CaptureHealth for the packets of this chunk, including any missing
+            between the previous chunk and this one. Gap positions count from start_slot.
+        start_slot : packet slot of the stream at which this chunk starts, counted since the
+            channels were last set
+        """
+        self.data = data
+        self.seqnos = seqnos
+        self.epoch = epoch
+        self.chans = chans
+        self.health = health
+        self.start_slot = start_slot
+
+class Subscription(object):
+    def __init__(self,maxsize=16,block=False):
+        """
+        A consumer of a UdpStream
+
+        maxsize : maximum number of chunks waiting in the queue
+        block : if True, the receiver thread waits for room in the queue (backpressure). Otherwise chunks
+            that do not fit are dropped and counted in self.dropped
+        """
+        self.queue = Queue.Queue(maxsize)
+        self.block = block
+        self.delivered = 0
+        self.dropped = 0
+
+    def get(self,timeout=None):
+        """
+        Get the next chunk, waiting up to *timeout* seconds (forever if None)
+
+        Raises Queue.Empty if no chunk arrives in time
+        """
+        return self.queue.get(timeout=timeout)
+
+    def _put(self,chunk,stop_event):
+        if self.block:
+            while not stop_event.is_set():
+                try:
+                    self.queue.put(chunk,timeout=0.1)
+                    self.delivered += 1
+                    return
+                except Queue.Full:
+                    pass
+        else:
+            try:
+                self.queue.put_nowait(chunk)
+                self.delivered += 1
+            except Queue.Full:
+                self.dropped += 1
+
+class UdpStream(object):
+    def __init__(self,ri,chans,nfft,streamid=1,stream_reg='streamid',addr=('192.168.1.1',12345),
+                 reads_per_chunk=1,rcvbuf=2**24):
+        """
+        Long lived receiver for the ROACH UDP data stream
+
+        ri : RoachInterface instance, used to toggle the stream register
+        chans : array of FPGA channel ids being read out
+        nfft : number of FFT bins of the current firmware
+        streamid : stream id to request and accept
+        addr : local address to bind
+        reads_per_chunk : number of BRAM reads (16 packets per channel) per decoded chunk
+        rcvbuf : requested kernel socket receive buffer size in bytes
+        """
+        self.ri = ri
+        self.nfft = nfft
+        self.streamid = streamid
+        self.stream_reg = stream_reg
+        self.addr = addr
+        self.reads_per_chunk = reads_per_chunk
+        self.rcvbuf = rcvbuf
+        self.chunks_received = 0
+        self.packets_received = 0
+        self.packets_missing = 0
+        self.packets_stale = 0
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._socket = None
+        self._decoder = None
+        self._discard = False
+        self.set_channels(chans)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def chunk_packets(self):
+        return 16*self.chans.shape[0]*self.reads_per_chunk
+
+    def set_channels(self,chans):
+        """
+        Change the FPGA channel ids used to decode the stream
+
+        Any partially received chunk is discarded and decoding restarts with a new decoder. Packets
+        already waiting on the socket are flushed, and decoding starts from the first packet which
+        carries one of the new channel ids and begins a row, so nothing captured with the previous
+        selection is decoded with the new one. Stale packets are counted in packets_stale.
+        """
+        with self._lock:
+            self.chans = np.array(chans)
+            self._decoder = udp_catcher.PacketDecoder(self.streamid,self.chans,self.nfft)
+            self._discard = True
+
+    def subscribe(self,maxsize=16,block=False):
+        """
+        Register a new consumer. See Subscription for the arguments.
+
+        returns : Subscription
+        """
+        sub = Subscription(maxsize=maxsize,block=block)
+        with self._lock:
+            self._subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self,sub):
+        with self._lock:
+            if sub in self._subscriptions:
+                self._subscriptions.remove(sub)
+
+    def read(self,nchunks,chans=None,timeout=5.0):
+        """
+        Collect the next *nchunks* chunks from the running stream
+
+        chans : if given and different from the current channels, the stream is switched to them first
+
+        returns : data,seqnos,health as from udp_catcher.get_udp_data, with gap positions counted
+            from the start of the first chunk
+        """
+        if chans is not None and not np.array_equal(chans,self.chans):
+            self.set_channels(chans)
+        sub = self.subscribe(maxsize=nchunks,block=True)
+        try:
+            chunks = [sub.get(timeout=timeout) for k in range(nchunks)]
+        finally:
+            self.unsubscribe(sub)
+        data = np.concatenate([chunk.data for chunk in chunks],axis=0)
+        seqnos = np.concatenate([chunk.seqnos for chunk in chunks])
+        health = udp_catcher.CaptureHealth()
+        for chunk in chunks:
+            health.accumulate(chunk.health,slot_offset=chunk.start_slot-chunks[0].start_slot)
+        return data,seqnos,health
+
+    def start(self):
+        if self.running:
+            return
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,self.rcvbuf)
+        except socket.error:
+            print "could not set receive buffer size to",self.rcvbuf
+        self._socket.bind(self.addr)
+        self.ri.r.write_int(self.stream_reg,0)
+        udp_catcher.flush_socket(self._socket)
+        self._socket.settimeout(0.1)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self.ri.r.write_int(self.stream_reg,self.streamid)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        try:
+            self.ri.r.write_int(self.stream_reg,0)
+        finally:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+            self._socket.close()
+            self._socket = None
+
+    def _run(self):
+        pkts = np.empty((0,),dtype=udp_catcher.pkt_dtype)
+        lengths = np.zeros((0,),dtype=np.int32)
+        nrecv = 0
+        while not self._stop_event.is_set():
+            flush = False
+            with self._lock:
+                if self._discard:
+                    self._discard = False
+                    flush = True
+                    nrecv = 0
+                if pkts.shape[0] != self.chunk_packets:
+                    pkts = np.empty((self.chunk_packets,),dtype=udp_catcher.pkt_dtype)
+                    lengths = np.zeros((self.chunk_packets,),dtype=np.int32)
+                    nrecv = 0
+            if flush:
+                self.packets_stale += udp_catcher.flush_socket(self._socket)
+                self._socket.settimeout(0.1)
+            nrecv = udp_catcher.recv_packets(self._socket,pkts,lengths,start=nrecv)
+            if nrecv < pkts.shape[0]:
+                continue # timed out, check whether we should stop
+            nrecv = 0
+            epoch = time.time()
+            with self._lock:
+                if self._discard:
+                    continue
+                chans = self.chans
+                decoder = self._decoder
+                subscriptions = list(self._subscriptions)
+            health = udp_catcher.CaptureHealth()
+            health.packets = pkts.shape[0]
+            good = lengths == udp_catcher.pkt_size
+            health.size_mismatch = (~good).sum()
+            self.packets_received += pkts.shape[0]
+            valid = pkts[good] if health.size_mismatch else pkts
+            if decoder.first_seqno is None:
+                # packets sent before the channels were switched can still arrive after the flush
+                start = np.flatnonzero(np.in1d(valid['chan'],chans) & ((valid['idx']*256) % chans.shape[0] == 0))
+                skip = start[0] if start.shape[0] else valid.shape[0]
+                self.packets_stale += skip
+                valid = valid[skip:]
+                if valid.shape[0] == 0:
+                    continue
+            # the decoder counts gap positions from its first packet, the chunk from its own start
+            start_slot = 0 if decoder.first_seqno is None else decoder.last_seqno + 1 - decoder.first_seqno
+            data,seqnos = decoder.decode(valid,health=health)
+            health.gap_positions = health.gap_positions - start_slot
+            if data.shape[0] == 0:
+                continue
+            with self._lock:
+                if self._discard:
+                    continue
+            self.chunks_received += 1
+            self.packets_missing += health.dropped
+            chunk = StreamChunk(data,seqnos,epoch,chans,health,start_slot=start_slot)
+            for sub in subscriptions:
+                sub._put(chunk,self._stop_event)
@@ -0,0 +1,182 @@
+"""
+Content addressed cache of the quantized tone waveforms played from the ROACH DRAM
+
+Synthesizing a multi-bank waveform takes an inverse FFT of (nwaves,nsamp/2+1) points, and loading
+it takes tens of seconds, yet scripts often set the same tones again and again, for example once per
+attenuation step. When set_tone_bins is given a phase_seed the waveform is fully determined by its
+arguments, so the quantized waveform is stored on disk under a hash of them:
+
+    <directory>/<key>.npy       qwave, dtype '>i2', opened again with memory mapping
+    <directory>/<key>_meta.npz  phases and wavenorm
+
+Files are written under a temporary name and renamed, so a cache directory can be shared by
+several processes. The least recently used waveforms are deleted once the total size of the
+cache exceeds max_bytes.
+
+The module level cache is disabled by default, since the data disks of the readout computers fill
+up. A script that sets the same tones repeatedly enables it on a disk with room to spare:
+
+    waveform_cache.configure('/home/data2/waveform_cache',max_bytes=2**32)
+
+Which waveform is resident in the DRAM is recorded separately by the readout, in the latched
+settings of its register_shadow.ShadowedFpgaClient, so reselecting a configuration that is already
+loaded skips the DRAM load as well.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+# included in every key, to be incremented whenever the synthesis changes the waveform produced
+synthesis_version = 1
+
+def waveform_key(kind,bins,nsamp,amps,phase_seed,normfact):
+    """
+    Hash the arguments which determine a waveform
+
+    kind : name of the synthesis used, for example the readout class
+    bins,nsamp,amps,normfact : as for RoachBaseband.set_tone_bins
+    phase_seed : seed of the random tone phases
+
+    returns : hexadecimal string
+    """
+    bins = np.asarray(bins,dtype=np.int64)
+    amps = np.asarray(amps,dtype=np.float64)
+    h = hashlib.sha1()
+    h.update(repr((synthesis_version,kind,bins.shape,int(nsamp),amps.shape,phase_seed,normfact)))
+    h.update(bins.tostring())
+    h.update(amps.tostring())
+    return h.hexdigest()
+
+class WaveformCache(object):
+    def __init__(self,directory=None,max_bytes=2**32):
+        """
+        directory : where the waveforms are stored, created when the first waveform is added. If None,
+            the cache is disabled.
+        max_bytes : limit on the total size of the cached waveforms
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self,key):
+        return os.path.join(os.path.expanduser(self.directory),key)
+
+    def get(self,key):
+        """
+        returns : qwave,phases,wavenorm with qwave memory mapped read only, or None if *key* is not
+            cached
+        """
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            qwave = np.load(path + '.npy',mmap_mode='r')
+            meta = np.load(path + '_meta.npz')
+            phases = meta['phases']
+            wavenorm = float(meta['wavenorm'])
+            meta.close()
+        except (IOError,OSError,KeyError,ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path + '.npy',None)
+        except OSError:
+            pass
+        self.hits += 1
+        return qwave,phases,wavenorm
+
+    def _tmp_path(self,key):
+        return '%s.%d.tmp' % (self._path(key),os.getpid())
+
+    def open(self,key,shape):
+        """
+        Create a writable memory mapped waveform file for *key*, so a waveform can be synthesized
+        straight into the cache. Once it is filled, pass it to put.
+
+        returns : memory mapped '>i2' array of *shape*, or None if the cache is disabled or the file
+            cannot be created
+        """
+        if self.directory is None:
+            return None
+        try:
+            directory = os.path.expanduser(self.directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            return np.lib.format.open_memmap(self._tmp_path(key) + '.npy',mode='w+',dtype='>i2',shape=shape)
+        except (IOError,OSError),e:
+            print "could not cache waveform:",e
+            return None
+
+    def put(self,key,qwave,phases,wavenorm):
+        """
+        Store a waveform, either an array or one created with open. Failures to write are reported
+        and otherwise ignored, since the cache is only an optimization.
+        """
+        if self.directory is None:
+            return
+        path = self._path(key)
+        tmp = self._tmp_path(key)
+        try:
+            directory = os.path.expanduser(self.directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            np.savez(tmp + '_meta.npz',phases=phases,wavenorm=wavenorm)
+            if getattr(qwave,'filename',None) == os.path.abspath(tmp + '.npy'):
+                qwave.flush()
+            else:
+                np.save(tmp + '.npy',qwave)
+            os.rename(tmp + '_meta.npz',path + '_meta.npz')
+            os.rename(tmp + '.npy',path + '.npy')
+        except (IOError,OSError),e:
+            print "could not cache waveform:",e
+            for name in (tmp + '_meta.npz',tmp + '.npy'):
+                if os.path.exists(name):
+                    os.remove(name)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used waveforms until the cache is within max_bytes
+        """
+        directory = os.path.expanduser(self.directory)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+                st = os.stat(os.path.join(directory,name))
+                entries.append((st.st_mtime,st.st_size,name[:-len('.npy')]))
+        entries.sort()
+        total = sum([size for mtime,size,key in entries])
+        while entries and total > self.max_bytes:
+            mtime,size,key = entries.pop(0)
+            for name in (key + '.npy',key + '_meta.npz'):
+                try:
+                    os.remove(os.path.join(directory,name))
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        if self.directory is None or not os.path.isdir(os.path.expanduser(self.directory)):
+            return
+        max_bytes = self.max_bytes
+        self.max_bytes = -1
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
+
+cache = WaveformCache()
+
+def configure(directory,max_bytes=2**32):
+    """
+    Enable the module level cache, or disable it if *directory* is None
+
+    directory : where the waveforms are stored
+    max_bytes : limit on the total size of the cached waveforms
+    """
+    cache.directory = directory
+    cache.max_bytes = max_bytes
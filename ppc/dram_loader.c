@@ -0,0 +1,108 @@
+/*
+ * Persistent DRAM upload helper, run on the ROACH PPC through a single ssh session
+ * (see kid_readout/utils/dram_upload.py).
+ *
+ * usage: dram_loader <bof pid>      writes to /proc/<bof pid>/hw/ioreg/dram_memory
+ *        dram_loader <path>         writes to <path>, for testing
+ *
+ * Reads records from stdin until a record with nbytes == 0 or end of file:
+ *     uint32 offset, uint32 nbytes (big endian), then nbytes of data
+ * Each record is written to the DRAM at offset, within the bank selected by the dram_controller
+ * register, and acknowledged on stdout with a big endian uint32: the number of bytes written, or
+ * 0xFFFFFFFF on error.
+ *
+ * Build with the PPC cross compiler, for example
+ *     powerpc-linux-gcc -O2 -o /srv/roach_boot/etch/boffiles/udp/dram_loader dram_loader.c
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/types.h>
+#include <arpa/inet.h>
+
+#define BUFSIZE (1<<20)
+
+int read_full(int fd, char *dest, int bytes) {
+    int got = 0;
+    int rval;
+    while (got < bytes) {
+        rval = read(fd, dest+got, bytes-got);
+        if (rval <= 0)
+            return got;
+        got += rval;
+    }
+    return got;
+}
+
+int write_full(int fd, char *src, int bytes) {
+    int done = 0;
+    int rval;
+    while (done < bytes) {
+        rval = write(fd, src+done, bytes-done);
+        if (rval <= 0)
+            return -1;
+        done += rval;
+    }
+    return done;
+}
+
+void reply(unsigned int value) {
+    unsigned int out = htonl(value);
+    write_full(1, (char *)&out, 4);
+}
+
+int main(int argc, char *argv[]) {
+    char dram_name[256];
+    char *buf;
+    unsigned int header[2];
+    unsigned int offset;
+    unsigned int nbytes;
+    unsigned int left;
+    int n;
+    int fd;
+    int failed;
+
+    if (argc < 2){
+        return -1;
+    }
+    if (argv[1][0] == '/')
+        snprintf(dram_name,sizeof(dram_name),"%s",argv[1]);
+    else
+        snprintf(dram_name,sizeof(dram_name),"/proc/%s/hw/ioreg/dram_memory",argv[1]);
+    buf = malloc(BUFSIZE);
+    if (buf == NULL)
+        return -1;
+
+    while (read_full(0, (char *)header, 8) == 8) {
+        offset = ntohl(header[0]);
+        nbytes = ntohl(header[1]);
+        if (nbytes == 0)
+            break;
+        failed = 0;
+        // reopened for every record, since the bank selected by dram_controller may have changed
+        fd = open(dram_name, O_WRONLY);
+        if (fd < 0 || lseek(fd, offset, SEEK_SET) < 0)
+            failed = 1;
+        left = nbytes;
+        while (left > 0) {
+            n = left < BUFSIZE ? left : BUFSIZE;
+            if (read_full(0, buf, n) != n) {
+                // the host went away
+                if (fd >= 0)
+                    close(fd);
+                return -1;
+            }
+            if (!failed && write_full(fd, buf, n) != n)
+                failed = 1;
+            left -= n;
+        }
+        if (fd >= 0)
+            close(fd);
+        reply(failed ? 0xFFFFFFFF : nbytes);
+    }
+    free(buf);
+    return 0;
+}